@@ -33,6 +33,8 @@ THE SOFTWARE.
 
 import string
 from collections import defaultdict
+
+import utils
 #==================================================================
 #==================HELPER FUNCTIONS================================
 #==================================================================
@@ -74,83 +76,6 @@ def unParseTable(table, output, sep):
     fh_out.close()
 
 
-def importRefseq(refseqFile, returnMultiples = False):
-    '''
-    parser for standard refseq tables downloaded from UCSC
-    '''
-    refseqTable = parseTable(refseqFile,'\t')
-    refseqDict = {}
-    ticker = 1
-    for line in refseqTable[1:]:
-        if refseqDict.has_key(line[1]):
-            refseqDict[line[1]].append(ticker)
-        else:
-            refseqDict[line[1]] = [ticker]
-        ticker = ticker + 1
-
-    multiples = []
-    for i in refseqDict:
-        if len(refseqDict[i]) > 1:
-            multiples.append(i)
-
-    if returnMultiples == True:
-        return refseqTable,refseqDict,multiples
-    else:
-        return refseqTable,refseqDict
-
-def getTSSs(geneList,refseqTable,refseqDict):
-    '''
-    returns all TSSs for each gene in a geneList
-    good for finding multiple starts
-    '''
-    def refseqFromKey(refseqKeyList,refseqDict,refseqTable):
-        typeRefseq = []
-        for name in refseqKeyList:
-            if refseqDict.has_key(name):
-                typeRefseq.append(refseqTable[refseqDict[name][0]])
-        return typeRefseq
-
-    if len(geneList) == 0:
-        refseq = refseqTable
-    else:
-        refseq = refseqFromKey(geneList,refseqDict,refseqTable)
-    TSS = []
-    for line in refseq:
-        if line[3] == '+':
-            TSS.append(line[4])
-        if line[3] == '-':
-            TSS.append(line[5])
-    TSS = map(int,TSS)
-    
-    return TSS
-
-
-def makeStartDict(annotFile,geneList = []):
-    '''makes a dictionary of gene coordinates and names'''
-    if type(geneList) == str:
-        geneList = parseTable(geneList,'\t')
-        geneList = [line[0] for line in geneList]
-            
-    if string.upper(annotFile).count('REFSEQ') == 1:
-        refseqTable,refseqDict = importRefseq(annotFile)
-        if len(geneList) == 0:
-            geneList = refseqDict.keys()
-        startDict = {}
-        for gene in geneList:
-            if refseqDict.has_key(gene) == False:
-                continue
-            startDict[gene]={}
-            startDict[gene]['sense'] = refseqTable[refseqDict[gene][0]][3]
-            startDict[gene]['chr'] = refseqTable[refseqDict[gene][0]][2]
-            startDict[gene]['start'] = getTSSs([gene],refseqTable,refseqDict)
-            if startDict[gene]['sense'] == '+':
-                startDict[gene]['end'] =[int(refseqTable[refseqDict[gene][0]][5])]
-            else:
-                startDict[gene]['end'] = [int(refseqTable[refseqDict[gene][0]][4])]
-            startDict[gene]['name'] = refseqTable[refseqDict[gene][0]][12]
-    return startDict
-
-
 probeAnnotationFile  = '/nfs/young_ata4/gff/tables/platforms/GPL16043_probe_annotation.txt'
 
 annotFile = '/nfs/young_ata4/gff/annotation/hg18/hg18_refseq.ucsc'
@@ -167,7 +92,7 @@ output = '/nfs/young_ata4/pipeline/mm1s_new/expression/11162012_mas5_allGenes.tx
 
 def makeGeneTable(annotFile,probeAnnotationFile,probeExpressionFile,output):
 
-    startDict= makeStartDict(annotFile)
+    startDict= utils.makeStartDict(annotFile)
     refIDList = startDict.keys()
     refIDList.sort()
 
@@ -13,7 +13,7 @@ import utils
 import sys
 # import ROSE_utils
 import time
-import copy
+import math
 import os
 import numpy
 import subprocess
@@ -35,9 +35,6 @@ codeFolder = utils.formatFolder(whereAmI,False)
 
 print('RUNNING ROSE2_META.py FROM %s' % (whereAmI))
 
-#samtools must be installed
-samtoolsPath = 'samtools'
-
 #bamliquidator must be installed
 bamliquidator_path = 'bamliquidator_batch'
 
@@ -51,18 +48,12 @@ def getBamChromList(bamFileList):
     gets the consensus list of chromosomes mapped by the bams
     '''
     
-    #start w/ the first bam
-    cmd = '%s idxstats %s' % (samtoolsPath,bamFileList[0])
-    idxStats = subprocess.Popen(cmd,stdout=subprocess.PIPE,shell=True)
-    idxStats= idxStats.communicate()
-    finalChromList = [line.split('\t')[0] for line in idxStats[0].split('\n')[0:-2]]
+    #start w/ the first bam. chromosomes come from the cached bam stats
+    finalChromList = utils.getBamChromList(bamFileList[0])
     
     #now go through each additional bam
     for bamFile in bamFileList:
-        cmd = '%s idxstats %s' % (samtoolsPath,bamFile)
-        idxStats = subprocess.Popen(cmd,stdout=subprocess.PIPE,shell=True)
-        idxStats= idxStats.communicate()
-        chromList = [line.split('\t')[0] for line in idxStats[0].split('\n')[0:-2]]
+        chromList = utils.getBamChromList(bamFile)
         finalChromList = [chrom for chrom in finalChromList if chromList.count(chrom) != 0]
 
     return utils.uniquify(finalChromList)
@@ -125,39 +116,9 @@ def optimizeStitching(locusCollection, name, outFolder, stepSize=500):
     maxStitch = 15000  # set a hard wired match stitching parameter
 
     stitchTable = [['STEP', 'NUM_REGIONS', 'TOTAL_CONSTIT', 'TOTAL_REGION', 'MEAN_CONSTIT', 'MEDIAN_CONSTIT', 'MEAN_REGION', 'MEDIAN_REGION', 'MEAN_STITCH_FRACTION', 'MEDIAN_STITCH_FRACTION']]
-    # first consolidate the collection
-    locusCollection = locusCollection.stitchCollection(stitchWindow=0)
-    total_constit = sum([locus.len() for locus in locusCollection.getLoci()])
-    step = 0
-    while step <= maxStitch:
-
-        print("Getting stitch stats for %s (bp)" % (step))
-        stitchCollection = locusCollection.stitchCollection(stitchWindow=step)
-        num_regions = len(stitchCollection)
-        stitchLoci = stitchCollection.getLoci()
-        regionLengths = [locus.len() for locus in stitchLoci]
-        total_region = sum(regionLengths)
-        constitLengths = []
-        for locus in stitchLoci:
-
-            constitLoci = locusCollection.getOverlap(locus)
-            constitLengths.append(sum([locus.len() for locus in constitLoci]))
-
-        meanConstit = round(numpy.mean(constitLengths), 2)
-        medianConstit = round(numpy.median(constitLengths), 2)
-
-        meanRegion = round(numpy.mean(regionLengths), 2)
-        medianRegion = round(numpy.median(regionLengths), 2)
-
-        stitchFractions = [float(constitLengths[i]) / float(regionLengths[i]) for i in range(len(regionLengths))]
-        meanStitchFraction = round(numpy.mean(stitchFractions), 2)
-        medianStitchFraction = round(numpy.median(stitchFractions), 2)
-
-        newLine = [step, num_regions, total_constit, total_region, meanConstit, medianConstit, meanRegion, medianRegion, meanStitchFraction, medianStitchFraction]
-
-        stitchTable.append(newLine)
-
-        step += stepSize
+    # consolidates the collection and gets the stats for every step in one pass
+    print("Getting stitch stats for 0 to %s (bp)" % (maxStitch))
+    stitchTable += utils.stitchStats(locusCollection, range(0, maxStitch + 1, stepSize))
 
     # write the stitch table to disk
     stitchParamFile = '%s%s_stitch_params.tmp' % (outFolder, name)
@@ -217,8 +178,9 @@ def regionStitching(referenceCollection, name, outFolder, stitchWindow, tssWindo
         # this loop will check if each bound region is contained by the TSS exclusion zone
         # this will drop out a lot of the promoter only regions that are tiny
         # typical exclusion window is around 2kb
-        for locus in boundLoci:
-            if len(tssCollection.getContainers(locus, 'both')) > 0:
+        tssContainers = utils.overlapSum(boundLoci, tssCollection, mode='containers', sense='both')
+        for locus, containerCount in zip(boundLoci, tssContainers):
+            if containerCount > 0:
 
                 # if true, the bound locus overlaps an active gene
                 referenceCollection.remove(locus)
@@ -230,8 +192,7 @@ def regionStitching(referenceCollection, name, outFolder, stitchWindow, tssWindo
 
     if stitchWindow == '':
         print('DETERMINING OPTIMUM STITCHING PARAMTER')
-        optCollection = copy.deepcopy(referenceCollection)
-        stitchWindow = optimizeStitching(optCollection, name, outFolder, stepSize=500)
+        stitchWindow = optimizeStitching(referenceCollection, name, outFolder, stepSize=500)
     print('USING A STITCHING PARAMETER OF %s' % stitchWindow)
     stitchedCollection = referenceCollection.stitchCollection(stitchWindow, 'both')
 
@@ -297,26 +258,18 @@ def mapCollection(stitchedCollection, referenceCollection, bamFileList, mappedFo
         lociLenList.append(locus.len())
         # numOrder = order(numLociList,decreasing=True)
     lenOrder = utils.order(lociLenList, decreasing=True)
-    ticker = 0
-    for i in lenOrder:
-        ticker += 1
-        if ticker % 1000 == 0:
-            print(ticker)
-        locus = loci[i]
-
-        # First get the size of the enriched regions within the stitched locus
-        refEnrichSize = 0
-        refOverlappingLoci = referenceCollection.getOverlap(locus, 'both')
-        for refLocus in refOverlappingLoci:
-            refEnrichSize += refLocus.len()
+    loci = [loci[i] for i in lenOrder]
 
+    # First get the size of the enriched regions within each stitched locus
+    refEnrichSizes = utils.overlapSum(loci, referenceCollection, 'len', sense='both')
+    for locus, refEnrichSize in zip(loci, refEnrichSizes):
         try:
             stitchCount = int(locus.ID().split('_')[0])
         except ValueError:
             stitchCount = 1
         coords = [int(x) for x in locus.coords()]
 
-        locusTable.append([locus.ID(), locus.chr(), min(coords), max(coords), stitchCount, refEnrichSize])
+        locusTable.append([locus.ID(), locus.chr(), min(coords), max(coords), stitchCount, int(refEnrichSize)])
 
     print('GETTING MAPPED DATA')
     print("USING A BAMFILE LIST:")
@@ -331,35 +284,32 @@ def mapCollection(stitchedCollection, referenceCollection, bamFileList, mappedFo
         # opening up the mapped GFF
         print('OPENING %s%s_%s_MAPPED/matrix.txt' % (mappedFolder, refName, bamFileName))
 
-        mappedGFF = utils.parseTable('%s%s_%s_MAPPED/matrix.txt' % (mappedFolder, refName, bamFileName), '\t')
+        # signals that don't parse come back as nan
+        regionIDs, locusLines, regionSignals = utils.loadColumns('%s%s_%s_MAPPED/matrix.txt' % (mappedFolder, refName, bamFileName),
+                                                                 [0, 1, 2], [str, str, float], header=True, fillValue=float('nan'))
 
         signalDict = defaultdict(float)
         print('MAKING SIGNAL DICT FOR %s' % (bamFile))
         mappedLoci = []
-        for line in mappedGFF[1:]:
-
-            chrom = line[1].split('(')[0]
-            start = int(line[1].split(':')[-1].split('-')[0])
-            end = int(line[1].split(':')[-1].split('-')[1])
-            mappedLoci.append(utils.Locus(chrom, start, end, '.', line[0]))
-            try:
-                signalDict[line[0]] = float(line[2]) * (abs(end - start))
-            except ValueError:
-                print('WARNING NO SIGNAL FOR LINE:')
-                print(line)
+        for regionID, locusLine, signal in zip(regionIDs.tolist(), locusLines.tolist(), regionSignals.tolist()):
+
+            chrom = locusLine.split('(')[0]
+            start = int(locusLine.split(':')[-1].split('-')[0])
+            end = int(locusLine.split(':')[-1].split('-')[1])
+            mappedLoci.append(utils.Locus(chrom, start, end, '.', regionID))
+            if math.isnan(signal):
+                print('WARNING NO SIGNAL FOR REGION %s AT %s' % (regionID, locusLine))
                 continue
+            signalDict[regionID] = signal * (abs(end - start))
 
-        mappedCollection = utils.LocusCollection(mappedLoci, 500)
+        # the collection drops duplicate regions
+        mappedLoci = utils.LocusCollection(mappedLoci, 500).getLoci()
         locusTable[0].append(bamFileName)
 
+        lineLoci = [utils.Locus(line[1], line[2], line[3], '.') for line in locusTable[1:]]
+        signals = utils.overlapSum(lineLoci, mappedLoci, [signalDict[region.ID()] for region in mappedLoci], sense='both')
         for i in range(1, len(locusTable)):
-            signal = 0.0
-            line = locusTable[i]
-            lineLocus = utils.Locus(line[1], line[2], line[3], '.')
-            overlappingRegions = mappedCollection.getOverlap(lineLocus, sense='both')
-            for region in overlappingRegions:
-                signal += signalDict[region.ID()]
-            locusTable[i].append(signal)
+            locusTable[i].append(float(signals[i - 1]))
 
     utils.unParseTable(locusTable, output, '\t')
 
@@ -631,7 +581,8 @@ def main():
 
         # now mask the reference loci
         referenceLoci = referenceCollection.getLoci()
-        filteredLoci = [locus for locus in referenceLoci if len(maskCollection.getOverlap(locus, 'both')) == 0]
+        maskOverlaps = utils.overlapSum(referenceLoci, maskCollection, sense='both')
+        filteredLoci = [locus for locus, maskCount in zip(referenceLoci, maskOverlaps) if maskCount == 0]
         print("FILTERED OUT %s LOCI THAT WERE MASKED IN %s" % (len(referenceLoci) - len(filteredLoci), maskFile))
         referenceCollection = utils.LocusCollection(filteredLoci, 50)
 
@@ -66,6 +66,56 @@ print('RUNNING ROSE2_META.py FROM %s' % (whereAmI))
 #this is the traditional way of running gene mapper
 
 
+def findEnhancerGenes(enhancerLoci,transcribedCollection,tssCollection,startDict,searchWindow=50000):
+
+    '''
+    finds the overlapping, proximal and closest genes for every enhancer locus in one pass
+    returns a list with an (overlappingGenes,proximalGenes,closestGene) tuple per enhancer
+    gene lists are refseq IDs and the closest gene is a gene name ('' if none within 1mb)
+    '''
+    transcribedLoci = transcribedCollection.getLoci()
+    tssIndex = utils.TSSIndex(tssCollection)
+
+    #overlapping genes are transcribed genes whose transcript is directly in the stitchedLocus
+    overlappingGenes = [[] for locus in enhancerLoci]
+    for i,j in zip(*utils.overlapJoin(enhancerLoci,transcribedLoci,'overlap','both')):
+        overlappingGenes[i].append(transcribedLoci[j].ID())
+
+    #proximalGenes are transcribed genes where the tss is within 50kb of the boundary of the stitched loci
+    proximalGenes = [[] for locus in enhancerLoci]
+    for i,j in zip(*tssIndex.within(enhancerLoci,searchWindow)):
+        proximalGenes[i].append(tssIndex.getID(j))
+
+    #the closest gene is the nearest tss within 1mb of the stitched loci unless an overlapping gene's tss is closer
+    nearestIndices,nearestDists = tssIndex.nearest(enhancerLoci,1,1000000)
+
+    enhancerGenes = []
+    for i,enhancerLocus in enumerate(enhancerLoci):
+        overlapping = utils.uniquify(overlappingGenes[i])
+        #technically it is possible for a gene to be overlapping, but not proximal since the
+        #gene could be longer than the 50kb window, but we'll let that slide here
+        overlappingSet = set(overlapping)
+        proximal = [refID for refID in utils.uniquify(proximalGenes[i]) if refID not in overlappingSet]
+
+        enhancerCenter = (enhancerLocus.start() + enhancerLocus.end())/2
+        closestID = ''
+        closestDist = -1
+        for refID in overlapping:
+            dist = abs(enhancerCenter - startDict[refID]['start'][0])
+            if closestDist == -1 or dist < closestDist:
+                closestID,closestDist = refID,dist
+        if nearestIndices[i,0] != -1 and (closestDist == -1 or nearestDists[i,0] < closestDist):
+            closestID = tssIndex.getID(nearestIndices[i,0])
+
+        if len(closestID) > 0:
+            closestGene = startDict[closestID]['name']
+        else:
+            closestGene = ''
+        enhancerGenes.append((overlapping,proximal,closestGene))
+
+    return enhancerGenes
+
+
 def mapEnhancerToGene(annotFile,enhancerFile,transcribedFile='',uniqueGenes=True,searchWindow =50000,noFormatTable = False):
     
     '''
@@ -129,61 +179,13 @@ def mapEnhancerToGene(annotFile,enhancerFile,transcribedFile='',uniqueGenes=True
         
 
 
-    for line in enhancerTable:
-        if line[0][0] =='#' or line[0][0] == 'R':
-            continue
-
-        enhancerString = '%s:%s-%s' % (line[1],line[2],line[3])
-        
-        enhancerLocus = utils.Locus(line[1],line[2],line[3],'.',line[0])
-
-        #overlapping genes are transcribed genes whose transcript is directly in the stitchedLocus         
-        overlappingLoci = transcribedCollection.getOverlap(enhancerLocus,'both')           
-        overlappingGenes =[]
-        for overlapLocus in overlappingLoci:                
-            overlappingGenes.append(overlapLocus.ID())
-
-        #proximalGenes are transcribed genes where the tss is within 50kb of the boundary of the stitched loci
-        proximalLoci = tssCollection.getOverlap(utils.makeSearchLocus(enhancerLocus,searchWindow,searchWindow),'both')           
-        proximalGenes =[]
-        for proxLocus in proximalLoci:
-            proximalGenes.append(proxLocus.ID())
-
-
-        distalLoci = tssCollection.getOverlap(utils.makeSearchLocus(enhancerLocus,1000000,1000000),'both')           
-        distalGenes =[]
-        for proxLocus in distalLoci:
-            distalGenes.append(proxLocus.ID())
+    enhancerLines = [line for line in enhancerTable if line[0][0] != '#' and line[0][0] != 'R']
+    enhancerLoci = [utils.Locus(line[1],line[2],line[3],'.',line[0]) for line in enhancerLines]
+    enhancerGenes = findEnhancerGenes(enhancerLoci,transcribedCollection,tssCollection,startDict,searchWindow)
 
-            
-            
-        overlappingGenes = utils.uniquify(overlappingGenes)
-        proximalGenes = utils.uniquify(proximalGenes)
-        distalGenes = utils.uniquify(distalGenes)
-        allEnhancerGenes = overlappingGenes + proximalGenes + distalGenes
-        #these checks make sure each gene list is unique.
-        #technically it is possible for a gene to be overlapping, but not proximal since the
-        #gene could be longer than the 50kb window, but we'll let that slide here
-        for refID in overlappingGenes:
-            if proximalGenes.count(refID) == 1:
-                proximalGenes.remove(refID)
-
-        for refID in proximalGenes:
-            if distalGenes.count(refID) == 1:
-                distalGenes.remove(refID)
-
-
-        #Now find the closest gene
-        if len(allEnhancerGenes) == 0:
-            closestGene = ''
-        else:
-            #get enhancerCenter
-            enhancerCenter = (int(line[2]) + int(line[3]))/2
+    for line,(overlappingGenes,proximalGenes,closestGene) in zip(enhancerLines,enhancerGenes):
 
-            #get absolute distance to enhancer center
-            distList = [abs(enhancerCenter - startDict[geneID]['start'][0]) for geneID in allEnhancerGenes]
-            #get the ID and convert to name
-            closestGene = startDict[allEnhancerGenes[distList.index(min(distList))]]['name']
+        enhancerString = '%s:%s-%s' % (line[1],line[2],line[3])
 
         #NOW WRITE THE ROW FOR THE ENHANCER TABLE
         if noFormatTable:
@@ -358,65 +360,14 @@ def mapEnhancerToGeneTop(rankByBamFile, controlBamFile, genome, annotFile, enhan
     geneToEnhancerTable = [
         ['GENE_NAME', 'REFSEQ_ID', 'PROXIMAL_ENHANCERS', 'ENHANCER_RANKS', 'IS_SUPER', 'ENHANCER_SIGNAL']]
 
-    for line in enhancerTable:
-        if line[0][0] == '#' or line[0][0] == 'R':
-            continue
-
-        enhancerString = '%s:%s-%s' % (line[1], line[2], line[3])
+    enhancerLines = [line for line in enhancerTable if line[0][0] != '#' and line[0][0] != 'R']
+    enhancerLoci = [utils.Locus(line[1], line[2], line[3], '.', line[0]) for line in enhancerLines]
+    enhancerGenes = findEnhancerGenes(
+        enhancerLoci, transcribedCollection, tssCollection, startDict, searchWindow)
 
-        enhancerLocus = utils.Locus(line[1], line[2], line[3], '.', line[0])
-
-        # overlapping genes are transcribed genes whose transcript is directly
-        # in the stitchedLocus
-        overlappingLoci = transcribedCollection.getOverlap(
-            enhancerLocus, 'both')
-        overlappingGenes = []
-        for overlapLocus in overlappingLoci:
-            overlappingGenes.append(overlapLocus.ID())
-
-        # proximalGenes are transcribed genes where the tss is within 50kb of
-        # the boundary of the stitched loci
-        proximalLoci = tssCollection.getOverlap(
-            utils.makeSearchLocus(enhancerLocus, searchWindow, searchWindow), 'both')
-        proximalGenes = []
-        for proxLocus in proximalLoci:
-            proximalGenes.append(proxLocus.ID())
-
-        distalLoci = tssCollection.getOverlap(
-            utils.makeSearchLocus(enhancerLocus, 1000000, 1000000), 'both')
-        distalGenes = []
-        for proxLocus in distalLoci:
-            distalGenes.append(proxLocus.ID())
-
-        overlappingGenes = utils.uniquify(overlappingGenes)
-        proximalGenes = utils.uniquify(proximalGenes)
-        distalGenes = utils.uniquify(distalGenes)
-        allEnhancerGenes = overlappingGenes + proximalGenes + distalGenes
-        # these checks make sure each gene list is unique.
-        # technically it is possible for a gene to be overlapping, but not proximal since the
-        # gene could be longer than the 50kb window, but we'll let that slide
-        # here
-        for refID in overlappingGenes:
-            if proximalGenes.count(refID) == 1:
-                proximalGenes.remove(refID)
+    for line, (overlappingGenes, proximalGenes, closestGene) in zip(enhancerLines, enhancerGenes):
 
-        for refID in proximalGenes:
-            if distalGenes.count(refID) == 1:
-                distalGenes.remove(refID)
-
-        # Now find the closest gene
-        if len(allEnhancerGenes) == 0:
-            closestGene = ''
-        else:
-            # get enhancerCenter
-            enhancerCenter = (int(line[2]) + int(line[3])) / 2
-
-            # get absolute distance to enhancer center
-            distList = [abs(enhancerCenter - startDict[geneID]['start'][0])
-                        for geneID in allEnhancerGenes]
-            # get the ID and convert to name
-            closestGene = startDict[
-                allEnhancerGenes[distList.index(min(distList))]]['name']
+        enhancerString = '%s:%s-%s' % (line[1], line[2], line[3])
 
         # NOW WRITE THE ROW FOR THE ENHANCER TABLE
         if noFormatTable:
@@ -459,16 +410,10 @@ def mapEnhancerToGeneTop(rankByBamFile, controlBamFile, genome, annotFile, enhan
     overallGeneList = utils.uniquify(overallGeneList)
 
     #get the chromLists from the various bams here
-    cmd = 'samtools idxstats %s' % (rankByBamFile)
-    idxStats = subprocess.Popen(cmd,stdout=subprocess.PIPE,shell=True)
-    idxStats= idxStats.communicate()
-    bamChromList = [line.split('\t')[0] for line in idxStats[0].split('\n')[0:-2]]
+    bamChromList = utils.getBamChromList(rankByBamFile)
     
     if len(controlBamFile) > 0:
-        cmd = 'samtools idxstats %s' % (controlBamFile)
-        idxStats = subprocess.Popen(cmd,stdout=subprocess.PIPE,shell=True)
-        idxStats= idxStats.communicate()
-        bamChromListControl = [line.split('\t')[0] for line in idxStats[0].split('\n')[0:-2]]
+        bamChromListControl = utils.getBamChromList(controlBamFile)
         bamChromList = [chrom for chrom in bamChromList if bamChromListControl.count(chrom) != 0]
 
 
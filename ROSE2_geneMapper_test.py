@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+
+import ROSE2_geneMapper
+import utils
+
+class FindEnhancerGenesTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.startDict = {}
+        for i in range(5000):
+            start = rng.randint(1, 30000000)
+            self.add_gene('NM_%d' % i, start, start + rng.randint(1000, 100000), rng.choice('+-'))
+        # dystrophin sized and larger transcripts covering hundreds of other genes and enhancers
+        self.add_gene('NM_long1', 2000000, 4300000, '+')
+        self.add_gene('NM_long2', 10000000, 15000000, '-')
+
+        transcriptLoci = [utils.Locus(gene['chr'], gene['start'][0], gene['end'][0], gene['sense'], refID)
+                          for refID, gene in self.startDict.items()]
+        self.transcribedCollection = utils.LocusCollection(transcriptLoci, 500)
+        self.tssCollection = utils.LocusCollection([utils.makeTSSLocus(refID, self.startDict, 0, 0)
+                                                    for refID in self.startDict], 50)
+        self.enhancerLoci = []
+        for i in range(5000):
+            start = rng.randint(1, 30000000)
+            self.enhancerLoci.append(utils.Locus('chr1', start, start + rng.randint(500, 20000), '.', 'enhancer_%d' % i))
+
+    def add_gene(self, refID, start, end, sense):
+        tss, txEnd = (start, end) if sense == '+' else (end, start)
+        self.startDict[refID] = {'sense': sense, 'chr': 'chr1', 'start': [tss], 'end': [txEnd], 'name': refID.lower()}
+
+    def test_long_transcripts(self):
+        enhancerGenes = ROSE2_geneMapper.findEnhancerGenes(self.enhancerLoci, self.transcribedCollection,
+                                                           self.tssCollection, self.startDict)
+        self.assertEqual(len(enhancerGenes), len(self.enhancerLoci))
+
+        transcripts = self.transcribedCollection.getLoci()
+        for locus, (overlapping, proximal, closestGene) in zip(self.enhancerLoci, enhancerGenes)[:50]:
+            self.assertEqual(sorted(overlapping),
+                             sorted(t.ID() for t in transcripts if t.overlaps(locus) or t.overlapsAntisense(locus)))
+
+        for refID in ['NM_long1', 'NM_long2']:
+            tss, txEnd = self.startDict[refID]['start'][0], self.startDict[refID]['end'][0]
+            inside = [i for i, locus in enumerate(self.enhancerLoci)
+                      if locus.end() >= min(tss, txEnd) and locus.start() <= max(tss, txEnd)]
+            self.assertTrue(len(inside) > 300)
+            for i in inside:
+                self.assertTrue(refID in enhancerGenes[i][0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+BENCHMARKS utils.Bam READ FETCHING ON DENSELY TILED REGIONS
+COMPARES ONE getReadArray CALL PER REGION WITH A SINGLE fetchMany CALL
+'''
+
+import time
+
+import utils
+
+
+#==================================================================
+#=====================HELPER FUNCTIONS=============================
+#==================================================================
+
+def tileLoci(chrom, start, nRegions, regionSize, step):
+    '''
+    nRegions loci of regionSize, one every step bp from start
+    '''
+    return [utils.Locus(chrom, start + i * step, start + i * step + regionSize - 1, '+', 'region_%s' % (i)) for i in range(nRegions)]
+
+
+def blocksRead(bam):
+    '''
+    bgzf blocks the bam's reader has decompressed, or NA for backends that don't say
+    '''
+    reader = bam.getReader()
+    if isinstance(reader, utils.NativeBamReader):
+        return reader._bgzf.blocksRead
+    return 'NA'
+
+
+def benchmarkFetch(name, bam, fetch, loci):
+    '''
+    prints regions/reads per second for a fetch function that returns a read array per locus
+    '''
+    startTime = time.time()
+    readArrays = fetch(bam, loci)
+    fetchTime = time.time() - startTime
+    nReads = sum([len(reads) for reads in readArrays])
+
+    print('%s:' % (name))
+    print('\tREADS: %s IN %s REGIONS' % (nReads, len(loci)))
+    print('\tTIME: %.3f SECONDS' % (fetchTime))
+    print('\tREGIONS PER SECOND: %.1f' % (len(loci) / fetchTime))
+    print('\tREADS PER SECOND: %.1f' % (nReads / fetchTime))
+    print('\tBLOCKS DECOMPRESSED: %s' % (blocksRead(bam)))
+    return readArrays
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    from optparse import OptionParser
+    usage = "usage: %prog [options] -b [SORTED_INDEXED_BAM]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-b", "--bam", dest="bam", nargs=1, default=None,
+                      help="Enter a sorted and indexed bam file")
+    parser.add_option("-c", "--chrom", dest="chrom", nargs=1, default=None,
+                      help="Chromosome to tile, defaults to the first one in the bam")
+    parser.add_option("-s", "--start", dest="start", nargs=1, default=1000000,
+                      help="Start of the first region, default 1000000")
+    parser.add_option("-n", "--n_regions", dest="nRegions", nargs=1, default=10000,
+                      help="Number of regions, default 10000")
+    parser.add_option("-w", "--width", dest="width", nargs=1, default=200,
+                      help="Region size, default 200")
+    parser.add_option("--step", dest="step", nargs=1, default=100,
+                      help="Distance between region starts, default 100 so neighboring regions overlap")
+    parser.add_option("--backend", dest="backend", nargs=1, default=None,
+                      help="Bam backend: pysam, native or samtools. defaults to the first available")
+
+    (options, args) = parser.parse_args()
+    if not options.bam:
+        parser.print_help()
+        exit()
+
+    chrom = options.chrom or utils.Bam(options.bam, options.backend).getReader().getChromList()[0]
+    loci = tileLoci(chrom, int(options.start), int(options.nRegions), int(options.width), int(options.step))
+    print('FETCHING %s REGIONS OF %s BP ON %s FROM %s' % (len(loci), options.width, chrom, options.bam))
+
+    single = benchmarkFetch('ONE REGION PER CALL (getReadArray)', utils.Bam(options.bam, options.backend),
+                            lambda bam, loci: [bam.getReadArray(locus) for locus in loci], loci)
+    batch = benchmarkFetch('BATCHED (fetchMany)', utils.Bam(options.bam, options.backend),
+                           lambda bam, loci: bam.fetchMany(loci), loci)
+
+    mismatches = len([i for i in range(len(loci)) if single[i]['name'].tolist() != batch[i]['name'].tolist()])
+    print('REGIONS WITH DIFFERENT READS: %s' % (mismatches))
+
+
+if __name__ == "__main__":
+    main()
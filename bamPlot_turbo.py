@@ -31,22 +31,28 @@ THE SOFTWARE.
 #=======================DEPENDENCIES=======================================
 #==========================================================================
 import argparse
-import cPickle
 import sys
 import utils
 import pipeline_dfci
 import subprocess
 import os
 import string
-import tempfile
-import zlib
 from distutils.spawn import find_executable
 
-# Try to use the bamliquidatior script on cluster, otherwise, failover to local default, otherwise fail.
+# bamliquidator_regions can liquidate every gff line of a bam in one run if it's built and pytables is installed
+try:
+    from bamliquidator_internal.bamliquidatorbatch import bamliquidator_batch
+except ImportError:
+    bamliquidator_batch = None
+useRegionLiquidator = bamliquidator_batch is not None and bamliquidator_batch.executable_path('bamliquidator_regions') is not None
+# the bamliquidator_worker, if built, serves the remaining per line liquidations
+workerPath = utils.findBamliquidator('bamliquidator_worker')
+
+# Otherwise try to use the bamliquidatior script on cluster, otherwise, failover to local default, otherwise fail.
 bamliquidatorString = '/ark/home/cl512/pipeline/bamliquidator'
 if not os.path.isfile(bamliquidatorString):
     bamliquidatorString = find_executable('bamliquidator')
-    if bamliquidatorString is None:
+    if bamliquidatorString is None and not useRegionLiquidator and workerPath is None:
         raise ValueError('bamliquidator not found in path')
 
 # as of now the number of bins to sample the space is hard wired
@@ -86,41 +92,11 @@ def loadAnnotFile(genome, skip_cache=False):
     annotFile = whereAmI + '/' + genomeDict[genome]
 
 
-    if not skip_cache:
-        # Try loading from a cache, if the crc32 matches
-        annotPathHash = zlib.crc32(annotFile) & 0xFFFFFFFF  # hash the entire location of this script
-        annotFileHash = zlib.crc32(open(annotFile, "rb").read()) & 0xFFFFFFFF
-
-        cache_file_name = "%s.%s.%s.cache" % (genome, annotPathHash, annotFileHash)
-
-        cache_file_path = '%s/%s' % (tempfile.gettempdir(), cache_file_name)
-
-        if os.path.isfile(cache_file_path):
-            # Cache exists! Load it!
-            try:
-                print('\tLoading genome data from cache.')
-                with open(cache_file_path, 'rb') as cache_fh:
-                    cached_data = cPickle.load(cache_fh)
-                    print('\tCache loaded.')
-                return cached_data
-            except (IOError, cPickle.UnpicklingError):
-                # Pickle corrupt? Let's get rid of it.
-                print('\tWARNING: Cache corrupt or unreadable. Ignoring.')
-        else:
-            print('\tNo cache exists: Loading annotation (slow).')
-
-
-    # We're still here, so either caching was disabled, or the cache doesn't exist
-
-    # geneList =['NM_002460','NM_020185']
-    geneList = []
-    geneDict = utils.makeGenes(annotFile, geneList, True)
-    txCollection = utils.makeTranscriptCollection(annotFile, 0, 0, 500, geneList)
-
-    if not skip_cache:
-        print('Writing cache for the first time.')
-        with open(cache_file_path, 'wb') as cache_fh:
-            cPickle.dump((geneDict, txCollection), cache_fh, cPickle.HIGHEST_PROTOCOL)
+    # the annotation store caches the parsed annotation by content hash, and
+    # only makes the Gene objects that actually get looked up
+    store = utils.getAnnotationStore(annotFile, not skip_cache)
+    geneDict = store.getGenes([], True)
+    txCollection = store.getTranscriptCollection(0, 0, 500)
 
     return geneDict, txCollection
 
@@ -287,8 +263,11 @@ def mapGFFLineToBed(gffLine, outFolder, nBins, bedCollection, header=''):
     utils.unParseTable(nameTable, outFolder + gffString + '_bedNameTemp.txt', '\t')
 
 
-def mapBamToGFFLine(bamFile, MMR, name, gffLine, color, nBins, sense='both', extension=200):
-    '''maps reads from a bam to a gff'''
+def mapBamToGFFLine(bamFile, MMR, name, gffLine, color, nBins, sense='both', extension=200, binCounts=None):
+    '''
+    maps reads from a bam to a gff
+    binCounts are the line's bins from bamliquidator_batch.liquidate_region_bins, if it's already been liquidated
+    '''
 
     print('using a MMR/scaling denominator value of %s' % (MMR))
 
@@ -307,6 +286,10 @@ def mapBamToGFFLine(bamFile, MMR, name, gffLine, color, nBins, sense='both', ext
         clusterLine += ['NA'] * int(nBins)
         return clusterLine
 
+    if binCounts is not None:
+        denList = [round(float(x) / binSize / MMR, 4) for x in binCounts]
+        return clusterLine + denList
+
     # flippy flip if sense is negative
     senseTrans = string.maketrans('-+.', '+-+')
     if sense == '-':
@@ -318,11 +301,15 @@ def mapBamToGFFLine(bamFile, MMR, name, gffLine, color, nBins, sense='both', ext
     # using the bamLiquidator to get the readstring
     # print('using nBin of %s' % nBin)
 
-    bamCommand = "%s %s %s %s %s %s %s %s" % (bamliquidatorString, bamFile, gffLocus.chr(), gffLocus.start(), gffLocus.end(), bamSense, nBins, extension)
-    # print(bamCommand)
-    getReads = subprocess.Popen(bamCommand, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-    readString = getReads.communicate()
-    denList = readString[0].split('\n')[:-1]
+    if workerPath is not None:
+        # the shared pool keeps one bamliquidator_worker per bam open across lines
+        denList = utils.getLiquidatorPool().liquidate(bamFile, gffLocus.chr(), gffLocus.start(), gffLocus.end(), bamSense, nBins, extension).tolist()
+    else:
+        bamCommand = "%s %s %s %s %s %s %s %s" % (bamliquidatorString, bamFile, gffLocus.chr(), gffLocus.start(), gffLocus.end(), bamSense, nBins, extension)
+        # print(bamCommand)
+        getReads = subprocess.Popen(bamCommand, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+        readString = getReads.communicate()
+        denList = readString[0].split('\n')[:-1]
 
     # flip the denList if the actual gff region is -
     if gffLocus.sense() == '-':
@@ -375,14 +362,8 @@ def makeBamPlotTables(gff, genome, bamFileList, colorList, nBins, sense, extensi
 
     #now iterate through the bam files
     for i,bamFile in enumerate(bamFileList):
-        # millionMappedReads
-        idxCmd = 'samtools idxstats %s' % (bamFile)
-        idxPipe = subprocess.Popen(idxCmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        idxStats = idxPipe.communicate()
-        idxStats = idxStats[0].split('\n')
-        idxStats = [line.split('\t') for line in idxStats]
-
-        rawCount = sum([int(line[2]) for line in idxStats[:-1]])
+        # millionMappedReads, from the cached bam stats
+        rawCount = utils.getBamStats(bamFile)['mapped']
 
         #implement scaling
         readScaleFactor = scaleList[i]
@@ -395,10 +376,20 @@ def makeBamPlotTables(gff, genome, bamFileList, colorList, nBins, sense, extensi
             MMR = round(1/float(readScaleFactor),4)
         mmrDict[bamFile] = MMR
 
+    # liquidate all of the gff lines of each bam at once, instead of one bamliquidator call per line and bam
+    binCountsDict = {}
+    if useRegionLiquidator:
+        for bamFile in bamFileList:
+            print('liquidating all regions in %s' % (bamFile))
+            lineBins = bamliquidator_batch.liquidate_region_bins(bamFile, gff, sense, extension, number_of_bins=int(nBins),
+                                                               idxstats=utils.getBamIdxStats)
+            # lines left out by bamliquidator_regions (e.g. chromosomes not in the bam) have no reads
+            binCountsDict[bamFile] = [[0] * int(nBins) if bins is None else bins.tolist() for bins in lineBins]
+
     ticker = 1
     # go line by line in the gff
     summaryTable = [['DIAGRAM_TABLE', 'NAME_TABLE', 'BED_DIAGRAM_TABLE', 'BED_NAME_TABLE', 'PLOT_TABLE', 'CHROM', 'ID', 'SENSE', 'START', 'END']]
-    for gffLine in gff:
+    for lineIndex, gffLine in enumerate(gff):
         gffString = 'line_%s_%s_%s_%s_%s_%s' % (ticker, gffLine[0], gffLine[1], gffLine[6], gffLine[3], gffLine[4])
         ticker += 1
         print('writing the gene diagram table for region %s' % (gffLine[1]))
@@ -415,7 +406,8 @@ def makeBamPlotTables(gff, genome, bamFileList, colorList, nBins, sense, extensi
             color = colorList[i]
             print('getting data for location %s in dataset %s' % (gffLine[1], bamFile))
             mmr = mmrDict[bamFile]
-            newLine = mapBamToGFFLine(bamFile, mmr, name, gffLine, color, nBins, sense, extension)
+            binCounts = binCountsDict[bamFile][lineIndex] if binCountsDict.has_key(bamFile) else None
+            newLine = mapBamToGFFLine(bamFile, mmr, name, gffLine, color, nBins, sense, extension, binCounts)
 
             outTable.append(newLine)
 
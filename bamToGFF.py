@@ -30,10 +30,13 @@ THE SOFTWARE.
 
 from utils import *
 
-from collections import defaultdict
+from collections import defaultdict,deque
 
+import itertools
+import multiprocessing
 import os
 import string
+import numpy
 
 def parseSamHeader(samFile):
     '''parses any sam type file with a 3 column tab del header'''
@@ -80,16 +83,145 @@ def getUniquelyMappingReads(bamFile):
         return int(samDict['UniquelyMappingSequenceTags'])
 
     else:
-        print('no precomputed stats file found for %s.' % (bamFile))
-        return None
+        #otherwise count reads w/ duplicates collapsed by position in one pass over the bam (cached per bam)
+        print('no precomputed stats file found for %s, counting unique reads' % (bamFile))
+        return getUniqueReadCount(bamFile)
         
         
 
 
 
-def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,density = False,rpm = False,binSize = 25,clusterGram = None,matrix = None,raw = False,includeJxnReads = False):
-    '''maps reads from a bam to a gff'''
+def mapBamToGFFLine(bam,line,sense,unique,extension,floor,density,rpm,MMR,binSize,clusterGram,matrix,raw,includeJxnReads):
+    '''maps reads from an open Bam to a single gff line. unique is a bool here, see mapBamToGFF'''
+    senseTrans = maketrans('-+.','+-+')
+    line = line[0:9]
+    gffLocus = Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
+    searchLocus = makeSearchLocus(gffLocus,int(extension),int(extension))
+    
+    reads = bam.getReadArray(searchLocus,'both',unique,includeJxnReads)
+
+    #at this point can output starts onto the GFF unless density is called
+
+    if density:
+
+        #per base coverage of the gff line by the extended reads on each strand
+        plusCoverage,minusCoverage = bam.strandCoverage(gffLocus,int(extension),unique,includeJxnReads,reads)
+        if gffLocus.sense() == '+' or gffLocus.sense == '.':
+            senseCoverage,antiCoverage = plusCoverage,minusCoverage
+        else:
+            senseCoverage,antiCoverage = minusCoverage,plusCoverage
+        if not (sense == '+' or sense == 'both' or sense =='.'):
+            senseCoverage = numpy.zeros_like(senseCoverage)
+        if not (sense == '-' or sense == 'both' or sense == '.'):
+            antiCoverage = numpy.zeros_like(antiCoverage)
+
+        #now apply flooring and filtering for coordinates
+        #a base counts if its coverage is over the floor and it's strictly inside the gff line
+        keep = (senseCoverage + antiCoverage) > floor
+        keep[0] = keep[-1] = False
+        senseCoverage = senseCoverage*keep
+        antiCoverage = antiCoverage*keep
+
+        if clusterGram or matrix:
+            clusterLine = [gffLocus.ID(),gffLocus.__str__()]
+            if matrix:
+                binSize = (gffLocus.len()-1)/int(matrix)
+                nBins = int(matrix)
+            if clusterGram:
+                nBins = gffLocus.len()/binSize
+            if binSize == 0:
+                clusterLine+=['NA']*int(matrix)
+                return clusterLine
+            #bins run 5' to 3' along the line and leave out the bases on their edges
+            totalCoverage = senseCoverage + antiCoverage
+            if not (gffLocus.sense() == '+' or gffLocus.sense() =='.' or gffLocus.sense() == 'both'):
+                totalCoverage = totalCoverage[::-1]
+            cumulativeCoverage = numpy.append(0,numpy.cumsum(totalCoverage))
+            binStarts = numpy.arange(nBins)*binSize
+            binTotals = cumulativeCoverage[binStarts + binSize] - cumulativeCoverage[binStarts + 1]
+            clusterLine+=[round(float(binTotal)/binSize/MMR,4) for binTotal in binTotals.tolist()]
+            return clusterLine
+    
+        #for regular old density calculation
+        else:
+            senseTotalDen = float(senseCoverage.sum())/gffLocus.len()
+            antiTotalDen = float(antiCoverage.sum())/gffLocus.len()
+            if rpm:
+                senseTotalDen = senseTotalDen/MMR
+                antiTotalDen = antiTotalDen/MMR
+            if sense == 'both' or sense == '.':
+                if gffLocus.sense() == '+' or gffLocus.sense() == '.':
+                    readLine = '+'+':%s' % (round(senseTotalDen,4)) + ';' +'-' + ':%s' % (round(antiTotalDen,4))
+                else:
+                    readLine = '+'+':%s' % (round(antiTotalDen,4)) + ';' +'-' + ':%s' % (round(senseTotalDen,4))
+            elif sense == '+':
+                readLine = '+'+':%s' % (round(senseTotalDen,4))
+            elif sense == '-':
+                readLine = '-' + ':%s' % (round(antiTotalDen,4))
+            return line + [readLine]             
+    #if not cluster or density simply return reads 
+    else:
+        #now extend the reads and make a list of extended reads
+        extendedReads = []
+        for locus in bam.readArrayToLoci(reads,gffLocus.chr(),'none'):
+            if locus.sense() == '+' or locus.sense() == '.':
+                locus = Locus(locus.chr(),locus.start(),locus.end()+extension,locus.sense(), locus.ID())
+            if locus.sense() == '-':
+                locus = Locus(locus.chr(),locus.start()-extension,locus.end(),locus.sense(),locus.ID())
+            extendedReads.append(locus)
+        if gffLocus.sense() == '+' or gffLocus.sense == '.':
+            senseReads = filter(lambda x:x.sense() == '+' or x.sense() == '.',extendedReads)
+            antiReads = filter(lambda x:x.sense() == '-',extendedReads)
+        else:
+            senseReads = filter(lambda x:x.sense() == '-' or x.sense() == '.',extendedReads)
+            antiReads = filter(lambda x:x.sense() == '+',extendedReads)
+
+        if raw:
+            if sense == 'both' or sense == '.':
+                if gffLocus.sense() == '+' or gffLocus.sense() == '.':
+                    readLine = '+'+':'+ join([str(locus.start()) for locus in senseReads],',') +';' + '-'+':'+ join([str(locus.start()) for locus in antiReads],',')
+                else:
+                    readLine = '+'+':'+ join([str(locus.start()) for locus in antiReads],',')+';'+'-'+':'+ join([str(locus.start()) for locus in senseReads],',')
+            elif sense == '+':
+                readLine = gffLocus.sense()+':'+ join([str(locus.start()) for locus in senseReads],',')
+            elif sense == '-':
+                readLine = string.translate(gffLocus.sense(),senseTrans)+':'+ join([str(locus.start()) for locus in antiReads],',')
+            return line+[readLine]
+        #if not raw and not density gives total
+        else:
+
+
+            if sense == 'both' or sense == '.':
+                readLine = str((len(antiReads) + len(senseReads))/MMR)   
+            elif sense == '+':
+                readLine = str(len(senseReads)/MMR)
+            elif sense == '-':
+                readLine = str(len(antiReads)/MMR)
+            return line+[readLine]
+
+
+#workers of the process pool each open the bam once and keep it
+_mapWorkerBam = None
+_mapWorkerArgs = None
+
+def _initMapWorker(bamFile,lineArgs):
+    global _mapWorkerBam,_mapWorkerArgs
+    _mapWorkerBam = Bam(bamFile)
+    _mapWorkerArgs = lineArgs
+
+def _mapGFFChunk(lines):
+    return [mapBamToGFFLine(_mapWorkerBam,line,*_mapWorkerArgs) for line in lines]
+
+
+def iterMapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,density = False,rpm = False,binSize = 25,clusterGram = None,matrix = None,raw = False,includeJxnReads = False,threads = 1,chunkSize = 100):
+    '''
+    generator version of mapBamToGFF, yields the output rows in gff order
+    a gff filename is read a line at a time. w/ threads > 1 chunks of chunkSize gff lines
+    are mapped in a process pool and only a few chunks per process are held at once
+    '''
     floor = int(floor)
+    extension = int(extension)
+    threads = int(threads)
     bam = Bam(bamFile)
     #if cluster is specified, override certain flags
     if clusterGram:
@@ -100,11 +232,8 @@ def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,
 
     if matrix:
         density = True
-    #new GFF to write to
-    newGFF = []
-    #millionMappedReads
-
 
+    #millionMappedReads
     #SECTION CHANGED FOR BRIAN BEING THAT GUY
     if float(unique) == 0.0:
         unique = False
@@ -123,162 +252,76 @@ def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,
 
 
     print('using a MMR value of %s' % (MMR))
-    
-    senseTrans = maketrans('-+.','+-+')
 
-    
-    if type(gff) == str:
-        gff = parseTable(gff,'\t')
+    def gffLines():
+        if type(gff) == str:
+            return iterTable(gff,'\t')
+        return iter(gff)
 
     #setting up a clustergram table
     if clusterGram:
         #first grab a header line
-        line = gff[0]
+        line = next(gffLines())
         gffLocus = Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
         
         nBins = gffLocus.len()/binSize
         binSizeList = [nBins]
 
         #now go through each line of the gff and make sure they're all the same length
-        for i in range(0,len(gff),1):
-            line = gff[i]
+        for line in gffLines():
             gffLocus = Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
             binSizeList.append(gffLocus.len()/binSize)
         binSizeList = uniquify(binSizeList)
         if len(binSizeList) > 1: 
             print('WARNING: lines in gff are of different length. Output clustergram will have variable row length')
-        newGFF.append(['GENE_ID','locusLine'] + [str(x*binSize)+'_'+bamFile.split('/')[-1] for x in range(1,max(binSizeList)+1,1)])        
+        yield ['GENE_ID','locusLine'] + [str(x*binSize)+'_'+bamFile.split('/')[-1] for x in range(1,max(binSizeList)+1,1)]
         
     #setting up a maxtrix table
     if matrix:
-        newGFF.append(['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)])        
+        yield ['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)]
 
     #getting and processing reads for gff lines
+    lineArgs = (sense,unique,extension,floor,density,rpm,MMR,binSize,clusterGram,matrix,raw,includeJxnReads)
+    if threads > 1:
+        rows = iterMapInPool(bamFile,gffLines(),lineArgs,threads,chunkSize)
+    else:
+        rows = (mapBamToGFFLine(bam,line,*lineArgs) for line in gffLines())
+
     ticker = 0
     print('Number lines processed')
-    for line in gff:
-        line = line[0:9]
+    for row in rows:
         if ticker%100 == 0:
             print ticker
         ticker+=1
-        gffLocus = Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
-        searchLocus = makeSearchLocus(gffLocus,int(extension),int(extension))
-        
-        reads = bam.getReadsLocus(searchLocus,'both',unique,'none',includeJxnReads)
-        #now extend the reads and make a list of extended reads
-        extendedReads = []
-        for locus in reads:
-            if locus.sense() == '+' or locus.sense() == '.':
-                locus = Locus(locus.chr(),locus.start(),locus.end()+extension,locus.sense(), locus.ID())
-            if locus.sense() == '-':
-                locus = Locus(locus.chr(),locus.start()-extension,locus.end(),locus.sense(),locus.ID())
-            extendedReads.append(locus)
-        if gffLocus.sense() == '+' or gffLocus.sense == '.':
-            senseReads = filter(lambda x:x.sense() == '+' or x.sense() == '.',extendedReads)
-            antiReads = filter(lambda x:x.sense() == '-',extendedReads)
-        else:
-            senseReads = filter(lambda x:x.sense() == '-' or x.sense() == '.',extendedReads)
-            antiReads = filter(lambda x:x.sense() == '+',extendedReads)
-    
-        #at this point can output starts onto the GFF unless density is called
-
-        if density:
-
-            senseHash = defaultdict(int)
-            antiHash = defaultdict(int)
-
-            #filling in the readHashes             
-            if sense == '+' or sense == 'both' or sense =='.':
-                for read in senseReads:
-                    for x in range(read.start(),read.end()+1,1):
-                        senseHash[x]+=1
-            if sense == '-' or sense == 'both' or sense == '.':
-                #print('foo')
-                for read in antiReads:
-                    for x in range(read.start(),read.end()+1,1):
-                        antiHash[x]+=1
-
-            #now apply flooring and filtering for coordinates
-            keys = uniquify(senseHash.keys()+antiHash.keys())
-            if floor > 0:
-                    
-                keys = filter(lambda x: (senseHash[x]+antiHash[x]) > floor,keys)
-            #coordinate filtering
-            keys = filter(lambda x: gffLocus.start() < x < gffLocus.end(),keys)
-
-            if clusterGram or matrix:
-                clusterLine = [gffLocus.ID(),gffLocus.__str__()]
-                if matrix:
-                    binSize = (gffLocus.len()-1)/int(matrix)
-                    nBins = int(matrix)
-                if clusterGram:
-                    nBins = gffLocus.len()/binSize
-                if binSize == 0:
-                    clusterLine+=['NA']*int(matrix)
-                    newGFF.append(clusterLine)
-                    continue
-                n=0
-                if gffLocus.sense() == '+' or gffLocus.sense() =='.' or gffLocus.sense() == 'both':
-                    i = gffLocus.start()
-                    
-                    while n <nBins:
-                        n+=1
-                        binKeys = filter(lambda x: i < x < i+binSize,keys)
-                        binDen = float(sum([senseHash[x]+antiHash[x] for x in binKeys]))/binSize
-                        clusterLine+=[round(binDen/MMR,4)]
-                        i = i+binSize
-                else:
-                    i = gffLocus.end()
-                    while n < nBins:
-                        n+=1
-                        binKeys = filter(lambda x: i-binSize < x < i,keys)
-                        binDen = float(sum([senseHash[x]+antiHash[x] for x in binKeys]))/binSize
-                        clusterLine+=[round(binDen/MMR,4)]
-                        i = i-binSize
-                newGFF.append(clusterLine)
-        
-            #for regular old density calculation
-            else:
-                senseTotalDen = float(sum([senseHash[x] for x in keys]))/gffLocus.len()
-                antiTotalDen = float(sum([antiHash[x] for x in keys]))/gffLocus.len()
-                if rpm:
-                    senseTotalDen = senseTotalDen/MMR
-                    antiTotalDen = antiTotalDen/MMR
-                if sense == 'both' or sense == '.':
-                    if gffLocus.sense() == '+' or gffLocus.sense() == '.':
-                        readLine = '+'+':%s' % (round(senseTotalDen,4)) + ';' +'-' + ':%s' % (round(antiTotalDen,4))
-                    else:
-                        readLine = '+'+':%s' % (round(antiTotalDen,4)) + ';' +'-' + ':%s' % (round(senseTotalDen,4))
-                elif sense == '+':
-                    readLine = '+'+':%s' % (round(senseTotalDen,4))
-                elif sense == '-':
-                    readLine = '-' + ':%s' % (round(antiTotalDen,4))
-                newGFF.append(line + [readLine])             
-        #if not cluster or density simply return reads 
-        elif raw:
-            if sense == 'both' or sense == '.':
-                if gffLocus.sense() == '+' or gffLocus.sense() == '.':
-                    readLine = '+'+':'+ join([str(locus.start()) for locus in senseReads],',') +';' + '-'+':'+ join([str(locus.start()) for locus in antiReads],',')
-                else:
-                    readLine = '+'+':'+ join([str(locus.start()) for locus in antiReads],',')+';'+'-'+':'+ join([str(locus.start()) for locus in senseReads],',')
-            elif sense == '+':
-                readLine = gffLocus.sense()+':'+ join([str(locus.start()) for locus in senseReads],',')
-            elif sense == '-':
-                readLine = string.translate(gffLocus.sense(),senseTrans)+':'+ join([str(locus.start()) for locus in antiReads],',')
-            newGFF.append(line+[readLine])
-        #if not raw and not density gives total
-        else:
+        yield row
 
 
-            if sense == 'both' or sense == '.':
-                readLine = str((len(antiReads) + len(senseReads))/MMR)   
-            elif sense == '+':
-                readLine = str(len(senseReads)/MMR)
-            elif sense == '-':
-                readLine = str(len(antiReads)/MMR)
-            newGFF.append(line+[readLine])
-            
-    return newGFF
+def iterMapInPool(bamFile,lines,lineArgs,threads,chunkSize):
+    '''
+    maps chunks of gff lines in a pool of threads processes, yielding rows in the original order
+    at most 4 chunks per process are queued or waiting to be yielded
+    '''
+    pool = multiprocessing.Pool(threads,_initMapWorker,(bamFile,lineArgs))
+    try:
+        pending = deque()
+        chunks = iter(lambda: list(itertools.islice(lines,chunkSize)),[])
+        for chunk in chunks:
+            pending.append(pool.apply_async(_mapGFFChunk,(chunk,)))
+            if len(pending) >= 4*threads:
+                for row in pending.popleft().get():
+                    yield row
+        while len(pending) > 0:
+            for row in pending.popleft().get():
+                yield row
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,density = False,rpm = False,binSize = 25,clusterGram = None,matrix = None,raw = False,includeJxnReads = False,threads = 1):
+    '''maps reads from a bam to a gff'''
+    return list(iterMapBamToGFF(bamFile,gff,sense,unique,extension,floor,density,rpm,binSize,clusterGram,matrix,raw,includeJxnReads,threads))
         
                 
                 
@@ -288,6 +331,32 @@ def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,
             
                 
     
+def mapBamsToCube(bamFiles,gff,sense = 'both',unique = 0,extension = 200,floor = 0,rpm = False,binSize = 25,clusterGram = None,matrix = None,includeJxnReads = False,threads = 1):
+    '''
+    maps several bams to the same gff in matrix or clustergram mode. the gff is only parsed once
+    returns the header of the wide matrix and regionIDs,locusLines,signal where signal is a
+    regions x bins x samples array, see utils.writeSignalCube and utils.writeSignalMatrix
+    '''
+    if not (clusterGram or matrix):
+        raise ValueError('mapping several bams needs matrix or clustergram mode')
+    if type(gff) == str:
+        gff = parseTable(gff,'\t')
+
+    header = ['GENE_ID','locusLine']
+    signal = []
+    for bamFile in bamFiles:
+        print('mapping %s' % (bamFile))
+        rows = iterMapBamToGFF(bamFile,gff,sense,unique,extension,floor,True,rpm,binSize,clusterGram,matrix,False,includeJxnReads,threads)
+        bamHeader = next(rows)
+        rows = list(rows)
+        if len(signal) == 0:
+            regionIDs = [row[0] for row in rows]
+            locusLines = [row[1] for row in rows]
+        header += bamHeader[2:]
+        signal.append(matrixRowsToArray(rows,len(bamHeader) - 2))
+    return header,regionIDs,locusLines,numpy.dstack(signal)
+
+
 def convertEnrichedRegionsToGFF(enrichedRegionFile):
     '''converts a young lab enriched regions file into a gff'''
     newGFF = []
@@ -310,12 +379,12 @@ def main():
     parser = OptionParser(usage = usage)
     #required flags
     parser.add_option("-b","--bam", dest="bam",nargs = 1, default=None,
-                      help = "Enter .bam file to be processed.")
+                      help = "Enter .bam file to be processed. Several comma separated bams make one matrix w/ -m or -c")
     parser.add_option("-i","--input", dest="input",nargs = 1, default=None,
                       help = "Enter .gff or ENRICHED REGION file to be processed.")
     #output flag
     parser.add_option("-o","--output", dest="output",nargs = 1, default=None,
-                      help = "Enter the output filename.")
+                      help = "Enter the output filename. A .npz output w/ -m or -c is a regions x bins x bams signal cube")
     #additional options
     parser.add_option("-s","--sense", dest="sense",nargs = 1, default='both',
                       help = "Map to '+','-' or 'both' strands. Default maps to both.")
@@ -337,26 +406,30 @@ def main():
                       help = "Outputs a variable bin sized matrix. User must specify number of bins.")
     parser.add_option("-j","--jxn", dest="jxn",action = 'store_true', default=False,
                       help = "if flagged, includes jxn reads")
+    parser.add_option("--threads", dest="threads",nargs = 1, default=1,
+                      help = "Number of processes to map gff lines with. Default is 1")
+    parser.add_option("-n","--names", dest="names",nargs = 1, default=None,
+                      help = "Comma separated sample names for the bams in a signal cube. Defaults to the bam file names")
     (options,args) = parser.parse_args()
 
     print(options)
     print(args)
 
     if options.bam:
-        bamFile = options.bam
-        fullPath = os.path.abspath(bamFile)
-        bamName = fullPath.split('/')[-1].split('.')[0]
-        pathFolder = join(fullPath.split('/')[0:-1],'/')
-        fileList = os.listdir(pathFolder)
-        hasBai = False
-        for fileName in fileList:
-            if fileName.count(bamName) == 1 and fileName.count('.bai') == 1:
-                hasBai = True
-
-        if not hasBai:
-            print('ERROR: no associated .bai file found with bam. Must use a sorted bam with accompanying index file')
-            parser.print_help()
-            exit()
+        for bamFile in options.bam.split(','):
+            fullPath = os.path.abspath(bamFile)
+            bamName = fullPath.split('/')[-1].split('.')[0]
+            pathFolder = join(fullPath.split('/')[0:-1],'/')
+            fileList = os.listdir(pathFolder)
+            hasBai = False
+            for fileName in fileList:
+                if fileName.count(bamName) == 1 and fileName.count('.bai') == 1:
+                    hasBai = True
+
+            if not hasBai:
+                print('ERROR: no associated .bai file found with bam. Must use a sorted bam with accompanying index file')
+                parser.print_help()
+                exit()
    
     if options.sense:
         if ['+','-','.','both'].count(options.sense) == 0:
@@ -396,26 +469,53 @@ def main():
             gffFile = inputFile
 
         bamFile = options.bam
+        threads = int(options.threads)
         
         if options.output == None:
             output = os.getcwd() + inputFile.split('/')[-1]+'.mapped'
         else:
             output = options.output
+        bamFiles = bamFile.split(',')
+        if len(bamFiles) > 1 or output.endswith('.npz'):
+            if not (options.cluster or options.matrix):
+                print('ERROR: Mapping several bams or making a signal cube needs the matrix or clustergram flag')
+                parser.print_help()
+                exit()
+            if options.names:
+                names = options.names.split(',')
+            else:
+                names = [x.split('/')[-1] for x in bamFiles]
+            if len(names) != len(bamFiles):
+                print('ERROR: Need one name per bam')
+                parser.print_help()
+                exit()
+            if options.cluster:
+                binSize,clusterGram = options.cluster,True
+            else:
+                binSize,clusterGram = 25,None
+            print('mapping %s bams to GFF and making one matrix' % (len(bamFiles)))
+            header,regionIDs,locusLines,signal = mapBamsToCube(bamFiles,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.rpm,binSize,clusterGram,options.matrix,options.jxn,threads)
+            if output.endswith('.npz'):
+                writeSignalCube(output,regionIDs,locusLines,names,signal)
+            else:
+                writeSignalMatrix(output,header,regionIDs,locusLines,signal)
+            return
         if options.cluster:
             print('mapping to GFF and making clustergram with fixed bin width')
-            newGFF = mapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,options.cluster,True,None,False,options.jxn)
+            newGFF = iterMapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,options.cluster,True,None,False,options.jxn,threads)
         elif options.matrix:
             print('mapping to GFF and making a matrix with fixed bin number')
-            newGFF = mapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,options.matrix,False,options.jxn)
+            newGFF = iterMapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,options.matrix,False,options.jxn,threads)
             
         else:
             print('mapping to GFF and returning reads')
             if options.total:
 
-                newGFF = mapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,None,False,options.jxn)
+                newGFF = iterMapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,None,False,options.jxn,threads)
             else:
-                newGFF = mapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,None,True)
-        unParseTable(newGFF,output,'\t')
+                newGFF = iterMapBamToGFF(bamFile,gffFile,options.sense,options.unique,int(options.extension),options.floor,options.density,options.rpm,25,None,None,True,False,threads)
+        #rows are written as they're mapped
+        writeTable(newGFF,output,'\t')
     else:
         parser.print_help()
         
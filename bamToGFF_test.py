@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+
+import numpy
+
+import bamToGFF
+import utils
+from utils_test import random_reads, write_bam
+
+def per_base_line(bam, line, sense, unique, extension, floor, clusterGram=None, matrix=None):
+    '''
+    the per base dict density that mapBamToGFF used before it went through Bam.strandCoverage
+    '''
+    gffLocus = utils.Locus(line[0], int(line[3]), int(line[4]), line[6], line[1])
+    searchLocus = utils.makeSearchLocus(gffLocus, extension, extension)
+    extendedReads = []
+    for locus in bam.getReadsLocus(searchLocus, 'both', unique, 'none'):
+        if locus.sense() == '+' or locus.sense() == '.':
+            locus = utils.Locus(locus.chr(), locus.start(), locus.end() + extension, locus.sense(), locus.ID())
+        if locus.sense() == '-':
+            locus = utils.Locus(locus.chr(), locus.start() - extension, locus.end(), locus.sense(), locus.ID())
+        extendedReads.append(locus)
+    if gffLocus.sense() == '+' or gffLocus.sense == '.':
+        senseReads = filter(lambda x: x.sense() == '+' or x.sense() == '.', extendedReads)
+        antiReads = filter(lambda x: x.sense() == '-', extendedReads)
+    else:
+        senseReads = filter(lambda x: x.sense() == '-' or x.sense() == '.', extendedReads)
+        antiReads = filter(lambda x: x.sense() == '+', extendedReads)
+
+    senseHash = defaultdict(int)
+    antiHash = defaultdict(int)
+    if sense == '+' or sense == 'both' or sense == '.':
+        for read in senseReads:
+            for x in range(read.start(), read.end() + 1, 1):
+                senseHash[x] += 1
+    if sense == '-' or sense == 'both' or sense == '.':
+        for read in antiReads:
+            for x in range(read.start(), read.end() + 1, 1):
+                antiHash[x] += 1
+    keys = utils.uniquify(senseHash.keys() + antiHash.keys())
+    if floor > 0:
+        keys = filter(lambda x: (senseHash[x] + antiHash[x]) > floor, keys)
+    keys = filter(lambda x: gffLocus.start() < x < gffLocus.end(), keys)
+
+    if clusterGram or matrix:
+        clusterLine = [gffLocus.ID(), gffLocus.__str__()]
+        if matrix:
+            binSize = (gffLocus.len() - 1) / int(matrix)
+            nBins = int(matrix)
+        if clusterGram:
+            binSize = int(clusterGram)
+            nBins = gffLocus.len() / binSize
+        if binSize == 0:
+            return clusterLine + ['NA'] * int(matrix)
+        n = 0
+        if gffLocus.sense() == '+' or gffLocus.sense() == '.' or gffLocus.sense() == 'both':
+            i = gffLocus.start()
+            while n < nBins:
+                n += 1
+                binKeys = filter(lambda x: i < x < i + binSize, keys)
+                clusterLine += [round(float(sum([senseHash[x] + antiHash[x] for x in binKeys])) / binSize, 4)]
+                i = i + binSize
+        else:
+            i = gffLocus.end()
+            while n < nBins:
+                n += 1
+                binKeys = filter(lambda x: i - binSize < x < i, keys)
+                clusterLine += [round(float(sum([senseHash[x] + antiHash[x] for x in binKeys])) / binSize, 4)]
+                i = i - binSize
+        return clusterLine
+
+    senseTotalDen = float(sum([senseHash[x] for x in keys])) / gffLocus.len()
+    antiTotalDen = float(sum([antiHash[x] for x in keys])) / gffLocus.len()
+    if sense == 'both' or sense == '.':
+        if gffLocus.sense() == '+' or gffLocus.sense() == '.':
+            readLine = '+' + ':%s' % (round(senseTotalDen, 4)) + ';' + '-' + ':%s' % (round(antiTotalDen, 4))
+        else:
+            readLine = '+' + ':%s' % (round(antiTotalDen, 4)) + ';' + '-' + ':%s' % (round(senseTotalDen, 4))
+    elif sense == '+':
+        readLine = '+' + ':%s' % (round(senseTotalDen, 4))
+    elif sense == '-':
+        readLine = '-' + ':%s' % (round(antiTotalDen, 4))
+    return line + [readLine]
+
+class MapBamToGFFTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        chrom_lengths = [('chr1', 100000), ('chr2', 50000)]
+        self.bam_file = write_bam(os.path.join(self.folder, 'test.bam'), chrom_lengths, random_reads(3000, chrom_lengths, seed=3))
+        self.bam = utils.Bam(self.bam_file, 'native')
+        rng = random.Random(4)
+        self.gff = []
+        for i in range(40):
+            chrom, length = rng.choice(chrom_lengths)
+            start = rng.randint(1, length - 5000)
+            end = start + rng.choice([1, 2, 30, 499, 1000, 4001])
+            self.gff.append([chrom, 'region_%d' % i, '', str(start), str(end), '', rng.choice('+-.'), '', 'region_%d' % i])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_density_parity(self):
+        for sense, unique, extension, floor in [('both', 0, 200, 0), ('+', 1, 0, 0), ('-', 0, 50, 2), ('.', 0, 200, 1)]:
+            newGFF = bamToGFF.mapBamToGFF(self.bam_file, self.gff, sense, unique, extension, floor, True)
+            self.assertEqual(newGFF, [per_base_line(self.bam, line, sense, bool(unique), extension, floor) for line in self.gff])
+
+    def test_matrix_and_clustergram_parity(self):
+        for sense, floor in [('both', 0), ('-', 1)]:
+            newGFF = bamToGFF.mapBamToGFF(self.bam_file, self.gff, sense, 0, 200, floor, False, False, 25, None, 10)
+            self.assertEqual(newGFF[1:], [per_base_line(self.bam, line, sense, False, 200, floor, matrix=10) for line in self.gff])
+            newGFF = bamToGFF.mapBamToGFF(self.bam_file, self.gff, sense, 0, 200, floor, False, False, 50, True)
+            self.assertEqual(newGFF[1:], [per_base_line(self.bam, line, sense, False, 200, floor, clusterGram=50) for line in self.gff])
+
+    def test_threads_keep_order(self):
+        gff_file = os.path.join(self.folder, 'regions.gff')
+        utils.writeTable(self.gff, gff_file, '\t')
+        for args in [('both', 0, 200, 0, True), ('+', 1, 0, 0, False, False, 25, None, None, True),
+                     ('both', 0, 200, 1, False, False, 25, None, 10), ('-', 0, 200, 0, False, False, 50, True)]:
+            single = bamToGFF.mapBamToGFF(self.bam_file, self.gff, *args)
+            pooled = list(bamToGFF.iterMapBamToGFF(self.bam_file, gff_file, *args, threads=3, chunkSize=4))
+            self.assertEqual(single, pooled)
+
+    def test_bams_to_cube(self):
+        chrom_lengths = [('chr1', 100000), ('chr2', 50000)]
+        other_bam = write_bam(os.path.join(self.folder, 'other.bam'), chrom_lengths, random_reads(2000, chrom_lengths, seed=5))
+        header, regionIDs, locusLines, signal = bamToGFF.mapBamsToCube([self.bam_file, other_bam], self.gff, 'both', 0, 200, 0, False, 25, None, 10)
+        self.assertEqual(signal.shape, (len(self.gff), 10, 2))
+        singles = [bamToGFF.mapBamToGFF(bam_file, self.gff, 'both', 0, 200, 0, False, False, 25, None, 10) for bam_file in [self.bam_file, other_bam]]
+        self.assertEqual(regionIDs, [row[0] for row in singles[0][1:]])
+        self.assertEqual(header, singles[0][0] + singles[1][0][2:])
+
+        cube_file = utils.writeSignalCube(os.path.join(self.folder, 'cube.npz'), regionIDs, locusLines, ['a', 'b'], signal)
+        cubeIDs, cubeLines, samples, cube = utils.loadSignalCube(cube_file, ['b'])
+        self.assertEqual(cubeIDs.tolist(), regionIDs)
+        self.assertEqual(samples.tolist(), ['b'])
+        self.assertTrue(numpy.array_equal(numpy.isnan(cube[:, :, 0]), numpy.isnan(signal[:, :, 1])))
+        self.assertTrue(numpy.allclose(numpy.nan_to_num(cube[:, :, 0]), numpy.nan_to_num(signal[:, :, 1])))
+        self.assertRaises(ValueError, utils.loadSignalCube, cube_file, ['c'])
+
+        matrix_file = utils.writeSignalMatrix(os.path.join(self.folder, 'matrix.txt'), header, regionIDs, locusLines, signal)
+        joined = [[str(x) for x in row] for row in singles[0]]
+        joined = [row + [str(x) for x in other[2:]] for row, other in zip(joined, singles[1])]
+        self.assertEqual(utils.parseTable(matrix_file, '\t'), joined)
+
+    def test_coverage(self):
+        for line in self.gff:
+            locus = utils.Locus(line[0], int(line[3]), int(line[4]), line[6], line[1])
+            reads = self.bam.getReadsLocus(utils.makeSearchLocus(locus, 100, 100), 'both', False, 'none')
+            plus, minus = [0] * locus.len(), [0] * locus.len()
+            for read in reads:
+                start, end = (read.start() - 100, read.end()) if read.sense() == '-' else (read.start(), read.end() + 100)
+                for x in range(max(start, locus.start()), min(end, locus.end()) + 1):
+                    (minus if read.sense() == '-' else plus)[x - locus.start()] += 1
+            if locus.sense() == '-':
+                plus, minus = minus[::-1], plus[::-1]
+            coverage = self.bam.coverage(locus, 100)
+            self.assertEqual(coverage.tolist(), [a + b for a, b in zip(plus, minus)])
+            self.assertEqual(self.bam.coverage(locus, 100, '-').tolist(), minus)
+            self.assertEqual(self.bam.coverage(locus, 100, '+', binSize=7).tolist(),
+                             [sum(plus[i:i + 7]) for i in range(0, locus.len() - 6, 7)])
+            binned = self.bam.coverage(locus, 100, nBins=10)
+            self.assertEqual(binned.sum(), coverage.sum())
+            self.assertEqual(len(binned), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,8 +34,15 @@ THE SOFTWARE.
 import os
 import string
 import subprocess
+import numpy
 import utils
 
+# bamliquidator_regions can liquidate a whole gff in one run if it's built and pytables is installed
+try:
+    from bamliquidator_internal.bamliquidatorbatch import bamliquidator_batch
+except ImportError:
+    bamliquidator_batch = None
+
 def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram = None,matrix = None):
     '''maps reads from a bam to a gff'''
 
@@ -78,17 +85,32 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
         newGFF.append(['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)])
         nBin = int(matrix)
 
-    # Try to use the bamliquidatior script on cluster, otherwise, failover to local (in path), otherwise fail.
-    bamliquidatorString = '/usr/bin/bamliquidator'
-    if not os.path.isfile(bamliquidatorString):
-        bamliquidatorString = './bamliquidator'
+    #liquidate every line at once w/ bamliquidator_regions, which returns bins already flipped for - lines
+    regionBins = None
+    worker = None
+    if bamliquidator_batch is not None and bamliquidator_batch.executable_path('bamliquidator_regions') is not None:
+        print('liquidating all gff lines with bamliquidator_regions')
+        if clusterGram:
+            regionBins = bamliquidator_batch.liquidate_region_bins(bamFile,gff,sense,extension,region_bin_size=int(clusterGram),
+                                                                   idxstats=utils.getBamIdxStats)
+        else:
+            regionBins = bamliquidator_batch.liquidate_region_bins(bamFile,gff,sense,extension,number_of_bins=nBin,
+                                                                   idxstats=utils.getBamIdxStats)
+    elif utils.findBamliquidator('bamliquidator_worker') is not None:
+        #otherwise one bamliquidator_worker keeps the bam open for all of the lines
+        worker = utils.LiquidatorWorker(bamFile)
+    else:
+        # Try to use the bamliquidatior script on cluster, otherwise, failover to local (in path), otherwise fail.
+        bamliquidatorString = '/usr/bin/bamliquidator'
         if not os.path.isfile(bamliquidatorString):
-            raise ValueError('bamliquidator not found in path')
+            bamliquidatorString = './bamliquidator'
+            if not os.path.isfile(bamliquidatorString):
+                raise ValueError('bamliquidator not found in path')
 
     #getting and processing reads for gff lines
     ticker = 0
     print('Number lines processed')
-    for line in gff:
+    for i,line in enumerate(gff):
         line = line[0:9]
         if ticker%100 == 0:
             print(ticker)
@@ -109,6 +131,16 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
                 continue
 
 
+        if regionBins is not None:
+            #lines that bamliquidator_regions left out (e.g. chromosomes not in the bam) have no reads
+            if regionBins[i] is None:
+                denList = [0]*nBin
+            else:
+                denList = regionBins[i].tolist()
+            denList = [round(float(x)/binSize/MMR,4) for x in denList]
+            newGFF.append([gffLocus.ID(),gffLocus.__str__()] + denList)
+            continue
+
         #flippy flip if sense is negative
         if sense == '-':
             bamSense = string.translate(gffLocus.sense(),senseTrans)
@@ -116,15 +148,19 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
             bamSense = gffLocus.sense()
         else:
             bamSense = '.'
-        #using the bamLiquidator to get the readstring            
-        #print('using nBin of %s' % nBin)
-        bamCommand = "%s %s %s %s %s %s %s %s" % (bamliquidatorString,bamFile,line[0],gffLocus.start(),gffLocus.end(),bamSense,nBin,extension)
-        #print(bamCommand)
-        getReads = subprocess.Popen(bamCommand,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-        readString, stderr = getReads.communicate()
-        if stderr:
-            print("STDERR out: %s" % (stderr))
-        denList = readString.split('\n')[:-1]
+        if worker is not None:
+            #clustergram lines shorter than a bin have no bins, which bamliquidator won't take
+            denList = [] if nBin == 0 else worker.liquidate(line[0],gffLocus.start(),gffLocus.end(),bamSense,nBin,extension).tolist()
+        else:
+            #using the bamLiquidator to get the readstring            
+            #print('using nBin of %s' % nBin)
+            bamCommand = "%s %s %s %s %s %s %s %s" % (bamliquidatorString,bamFile,line[0],gffLocus.start(),gffLocus.end(),bamSense,nBin,extension)
+            #print(bamCommand)
+            getReads = subprocess.Popen(bamCommand,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
+            readString, stderr = getReads.communicate()
+            if stderr:
+                print("STDERR out: %s" % (stderr))
+            denList = readString.split('\n')[:-1]
         #print("denlist is: %s" % denList)
         #flip the denList if the actual gff region is -
         if gffLocus.sense() == '-':
@@ -139,10 +175,33 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
         clusterLine = [gffLocus.ID(),gffLocus.__str__()] + denList
         newGFF.append(clusterLine)
 
+    if worker is not None:
+        worker.close()
     return newGFF
         
 
     
+def mapBamsToCube(bamFiles,gff,sense = '.',extension = 200,rpm = False,clusterGram = None,matrix = None):
+    '''
+    maps several bams to the same gff, parsing the gff once
+    returns the header of the wide matrix and regionIDs,locusLines,signal where signal is a
+    regions x bins x samples array, see utils.writeSignalCube and utils.writeSignalMatrix
+    '''
+    if type(gff) == str:
+        gff = utils.parseTable(gff,'\t')
+
+    header = ['GENE_ID','locusLine']
+    signal = []
+    for bamFile in bamFiles:
+        print('mapping %s' % (bamFile))
+        newGFF = mapBamToGFF(bamFile,gff,sense,extension,rpm,clusterGram,matrix)
+        if len(signal) == 0:
+            regionIDs = [line[0] for line in newGFF[1:]]
+            locusLines = [line[1] for line in newGFF[1:]]
+        header += newGFF[0][2:]
+        signal.append(utils.matrixRowsToArray(newGFF[1:],len(newGFF[0]) - 2))
+    return header,regionIDs,locusLines,numpy.dstack(signal)
+
 def convertEnrichedRegionsToGFF(enrichedRegionFile):
     '''converts a young lab enriched regions file into a gff'''
     newGFF = []
@@ -165,12 +224,12 @@ def main():
     parser = OptionParser(usage = usage)
     #required flags
     parser.add_option("-b","--bam", dest="bam",nargs = 1, default=None,
-                      help = "Enter .bam file to be processed.")
+                      help = "Enter .bam file to be processed. Several comma separated bams make one matrix")
     parser.add_option("-i","--input", dest="input",nargs = 1, default=None,
                       help = "Enter .gff or ENRICHED REGION file to be processed.")
     #output flag
     parser.add_option("-o","--output", dest="output",nargs = 1, default=None,
-                      help = "Enter the output filename.")
+                      help = "Enter the output filename. A .npz output is a regions x bins x bams signal cube")
     #additional options
     parser.add_option("-s","--sense", dest="sense",nargs = 1, default='.',
                       help = "Map to '+','-' or 'both' strands. Default maps to both.")
@@ -182,6 +241,8 @@ def main():
                       help = "Outputs a fixed bin size clustergram. user must specify bin size.")
     parser.add_option("-m","--matrix", dest="matrix",nargs = 1, default=None,
                       help = "Outputs a variable bin sized matrix. User must specify number of bins.")
+    parser.add_option("-n","--names", dest="names",nargs = 1, default=None,
+                      help = "Comma separated sample names for the bams in a signal cube. Defaults to the bam file names")
     (options,args) = parser.parse_args()
 
     print(options)
@@ -231,6 +292,36 @@ def main():
             output = os.getcwd() + inputFile.split('/')[-1]+'.mapped'
         else:
             output = options.output
+        bamFiles = bamFile.split(',')
+        if len(bamFiles) > 1 or output.endswith('.npz'):
+            if not (options.cluster or options.matrix):
+                print('ERROR: Mapping several bams or making a signal cube needs the matrix or clustergram flag')
+                parser.print_help()
+                exit()
+            if options.names:
+                names = options.names.split(',')
+            else:
+                names = [x.split('/')[-1] for x in bamFiles]
+            if len(names) != len(bamFiles):
+                print('ERROR: Need one name per bam')
+                parser.print_help()
+                exit()
+            clusterGram = options.cluster and int(options.cluster)
+            matrix = options.matrix and int(options.matrix)
+            print('mapping %s bams to GFF and making one matrix' % (len(bamFiles)))
+            header,regionIDs,locusLines,signal = mapBamsToCube(bamFiles,gffFile,options.sense,int(options.extension),options.rpm,clusterGram,matrix)
+
+            print('bamToGFF_turbo writing output to: %s' % (output))
+            try:
+                os.mkdir(os.path.dirname(output))
+            except OSError:
+                pass
+            if output.endswith('.npz'):
+                utils.writeSignalCube(output,regionIDs,locusLines,names,signal)
+            else:
+                utils.writeSignalMatrix(output,header,regionIDs,locusLines,signal)
+            return
+
         if options.cluster:
             print('mapping to GFF and making clustergram with fixed bin width')
             newGFF = mapBamToGFF(bamFile,gffFile,options.sense,int(options.extension),options.rpm,int(options.cluster),None)
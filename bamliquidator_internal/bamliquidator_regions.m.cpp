@@ -1,10 +1,12 @@
 #include "bamliquidator.h"
 #include "bamliquidator_util.h"
 
+#include <algorithm>
 #include <cmath>
 #include <fstream>
 #include <iostream>
 #include <map>
+#include <numeric>
 #include <sstream>
 #include <stdexcept>
 #include <string>
@@ -64,12 +66,26 @@ std::ostream& operator<<(std::ostream& os, const Region& r)
   return os;
 }
 
+// default_strand: _ uses the region file strand, ~ uses the opposite of it (with . treated as +,
+//                 matching bamToGFF), and any other value is used for every region
+char region_strand(const char default_strand, const char file_strand)
+{
+  switch (default_strand)
+  {
+    case '_': return file_strand;
+    case '~': return file_strand == '+' ? '-' : '+';
+    default:  return default_strand;
+  }
+}
+
 // default_strand: optional argument, default _ indicates to use 
-//                 gff strand column or . (both) for .bed region file
+//                 gff strand column or . (both) for .bed region file, see region_strand
+// reversed:       filled with whether each returned region is - strand in the region file
 std::vector<Region> parse_regions(const std::string& region_file_path,
                                   const std::string& region_format,
                                   const unsigned int bam_file_key,
                                   const std::map<std::string, size_t>& chromosome_to_length, 
+                                  std::vector<bool>& reversed,
                                   const char default_strand = '_') 
 {
   int chromosome_column = 0;
@@ -143,6 +159,7 @@ std::vector<Region> parse_regions(const std::string& region_file_path,
       std::swap(region.start, region.stop);
     }
 
+    char file_strand = '.';
     if (columns.size() > strand_column)
     {
       if (columns[strand_column].size() != 1)
@@ -151,22 +168,16 @@ std::vector<Region> parse_regions(const std::string& region_file_path,
         ss << "error parsing strand: '" << columns[strand_column] << "' on line " << line_number;
         throw std::runtime_error(ss.str());
       }
-      region.strand = default_strand == '_'
-                    ? columns[strand_column][0]
-                    : default_strand;
-    }
-    else
-    {
-      region.strand = default_strand == '_'
-                    ? '.'
-                    : default_strand; 
+      file_strand = columns[strand_column][0];
     }
+    region.strand = region_strand(default_strand, file_strand);
     region.count = 0;
     region.normalized_count = 0.0;
 
     if (region.is_valid(chromosome_to_length))
     {
       regions.push_back(region);
+      reversed.push_back(file_strand == '-');
     }
     else
     {
@@ -209,6 +220,52 @@ void write(hid_t& file, std::vector<Region>& regions)
   }
 }
 
+// bins: 0 for just the region count, n > 0 for n bins per region,
+//       or -n for as many n base pair bins as fit in each region (like bamToGFF clustergrams)
+size_t number_of_bins(const Region& region, const int bins)
+{
+  if (bins > 0)
+  {
+    return bins;
+  }
+  if (bins < 0)
+  {
+    return (region.stop - region.start + 1) / -bins;
+  }
+  return 0;
+}
+
+// writes the bin counts of every region, one after another, as the 1d dataset
+// /region_bin_counts/file_<bam_file_key>, w/ the bins argument stored in its "bins" attribute
+void write_bin_counts(hid_t& file, const unsigned int bam_file_key, const int bins,
+                      const std::vector<double>& bin_counts)
+{
+  const std::string group_name = "/region_bin_counts";
+  if (H5Lexists(file, group_name.c_str(), H5P_DEFAULT) <= 0)
+  {
+    hid_t group = H5Gcreate2(file, group_name.c_str(), H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    if (group < 0)
+    {
+      throw std::runtime_error("Error creating group " + group_name);
+    }
+    H5Gclose(group);
+  }
+
+  const std::string dataset_name = group_name + "/file_" + boost::lexical_cast<std::string>(bam_file_key);
+  const hsize_t dims[] = { bin_counts.size() };
+  herr_t status = H5LTmake_dataset_double(file, dataset_name.c_str(), 1, dims, bin_counts.data());
+  if (status >= 0)
+  {
+    status = H5LTset_attribute_int(file, dataset_name.c_str(), "bins", &bins, 1);
+  }
+  if (status < 0)
+  {
+    std::stringstream ss;
+    ss << "Error writing " << dataset_name << ", status = " << status;
+    throw std::runtime_error(ss.str());
+  }
+}
+
 class Liquidator 
 {
 public:
@@ -247,6 +304,12 @@ public:
     return counts[0];
   }
 
+  std::vector<double> liquidate_bins(const std::string& chromosome, int start, int stop, char strand,
+                                     unsigned int number_of_bins, unsigned int extension)
+  {
+    return ::liquidate(fp, bamidx, chromosome, start, stop, strand, number_of_bins, extension);
+  }
+
 private:
   std::string bam_file_path;
   samfile_t* fp;
@@ -273,8 +336,12 @@ typedef tbb::enumerable_thread_specific<Liquidator,
                                         tbb::ets_key_per_instance>
         Liquidators;
 
-void liquidate_regions(std::vector<Region>& regions, const std::string& bam_file_path,
-                       size_t region_begin, size_t region_end, unsigned int extension,
+// w/ bins, region i's counts go in bin_counts from bin_offsets[i] to bin_offsets[i+1],
+// 5' to 3' along the region (so flipped for reversed regions), and its count is their sum;
+// regions w/o bins (always the case when bins is 0) are liquidated as a whole
+void liquidate_regions(std::vector<Region>& regions, size_t region_begin, size_t region_end,
+                       unsigned int extension, const int bins, const std::vector<bool>& reversed,
+                       const std::vector<size_t>& bin_offsets, std::vector<double>& bin_counts,
                        Liquidators& liquidators)
 {
   Liquidator& liquidator = liquidators.local();
@@ -283,11 +350,29 @@ void liquidate_regions(std::vector<Region>& regions, const std::string& bam_file
   {
     try
     {
-      regions[i].count = liquidator.liquidate(regions[i].chromosome,
-                                              regions[i].start, 
-                                              regions[i].stop, 
-                                              regions[i].strand,
-                                              extension);
+      if (bin_offsets[i+1] == bin_offsets[i])
+      {
+        regions[i].count = liquidator.liquidate(regions[i].chromosome,
+                                                regions[i].start, 
+                                                regions[i].stop, 
+                                                regions[i].strand,
+                                                extension);
+      }
+      else
+      {
+        std::vector<double> counts = liquidator.liquidate_bins(regions[i].chromosome,
+                                                               regions[i].start,
+                                                               regions[i].stop,
+                                                               regions[i].strand,
+                                                               bin_offsets[i+1] - bin_offsets[i],
+                                                               extension);
+        if (reversed[i])
+        {
+          std::reverse(counts.begin(), counts.end());
+        }
+        std::copy(counts.begin(), counts.end(), bin_counts.begin() + bin_offsets[i]);
+        regions[i].count = std::accumulate(counts.begin(), counts.end(), 0.0);
+      }
     } catch(const std::exception& e)
     {
       Logger::error() << "Aborting because failed to parse region " << i+1 << " (" << regions[i] << ") due to error: "
@@ -297,34 +382,50 @@ void liquidate_regions(std::vector<Region>& regions, const std::string& bam_file
   }
 }
 
-void liquidate_and_write(hid_t& file, std::vector<Region>& regions,
-                         unsigned int extension, const std::string& bam_file_path)
+void liquidate_and_write(hid_t& file, std::vector<Region>& regions, const std::vector<bool>& reversed,
+                         unsigned int extension, const std::string& bam_file_path,
+                         const unsigned int bam_file_key, const int bins)
 {
   Liquidators liquidators((Liquidator(bam_file_path))); 
 
+  std::vector<size_t> bin_offsets(regions.size() + 1, 0);
+  for (size_t i=0; i < regions.size(); ++i)
+  {
+    bin_offsets[i+1] = bin_offsets[i] + number_of_bins(regions[i], bins);
+  }
+  std::vector<double> bin_counts(bin_offsets.back(), 0.0);
+
   tbb::parallel_for(
     tbb::blocked_range<int>(0, regions.size(), 1),
     [&](const tbb::blocked_range<int>& range)
     {
-      liquidate_regions(regions, bam_file_path, range.begin(), range.end(), extension, liquidators);
+      liquidate_regions(regions, range.begin(), range.end(), extension, bins, reversed,
+                        bin_offsets, bin_counts, liquidators);
     },
     tbb::auto_partitioner());
 
   write(file, regions);
+  if (bins != 0)
+  {
+    write_bin_counts(file, bam_file_key, bins, bin_counts);
+  }
 }
 
 int main(int argc, char* argv[])
 {
   try
   {
-    if (argc < 13 || argc % 2 != 1)
+    if (argc < 14 || argc % 2 != 0)
     {
       std::cerr << "usage: " << argv[0] << " number_of_threads region_file gff_or_bed_format extension bam_file bam_file_key hdf5_file "
-                << "log_file write_warnings_to_stderr strand chr1 length1 ...\n"
+                << "log_file write_warnings_to_stderr strand bins chr1 length1 ...\n"
         << "\ne.g. " << argv[0] << " /grail/annotations/HG19_SUM159_BRD4_-0_+0.gff gff"
         << "\n      /ifs/labs/bradner/bam/hg18/mm1s/04032013_D1L57ACXX_4.TTAGGC.hg18.bwt.sorted.bam 137 counts.hdf5 "
-        << "\n      output/log.txt 1 _ chr1 247249719 chr2 242951149 chr3 199501827\n"
+        << "\n      output/log.txt 1 _ 0 chr1 247249719 chr2 242951149 chr3 199501827\n"
         << "\nstrand value of _ means use strand that is specified in region file (and use . if strand not specified in region file)."
+        << "\nstrand value of ~ means use the opposite of the strand in the region file (and use + if it is .)."
+        << "\nbins of 0 gives one count per region, n > 0 gives n bins per region and -n gives bins of n base pairs."
+        << "\nbins are written 5' to 3' along each region to the hdf5 dataset /region_bin_counts/file_<bam_file_key>."
         << "\nnumber of threads <= 0 means use a number of threads equal to the number of logical cpus."
         << "\nnote that this application is intended to be run from bamliquidator_batch.py -- see"
         << "\nhttps://github.com/BradnerLab/pipeline/wiki for more information"
@@ -342,7 +443,8 @@ int main(int argc, char* argv[])
     const std::string log_file_path = argv[8];
     const bool write_warnings_to_stderr = boost::lexical_cast<bool>(argv[9]);
     const char strand = boost::lexical_cast<char>(argv[10]);
-    const std::vector<std::pair<std::string, size_t>> chromosome_lengths = extract_chromosome_lengths(argc, argv, 11);
+    const int bins = boost::lexical_cast<int>(argv[11]);
+    const std::vector<std::pair<std::string, size_t>> chromosome_lengths = extract_chromosome_lengths(argc, argv, 12);
 
     tbb::task_scheduler_init init( number_of_threads <= 0 
                                  ? tbb::task_scheduler_init::automatic
@@ -367,10 +469,12 @@ int main(int argc, char* argv[])
       chromosome_to_length[chr_length.first] = chr_length.second;
     }
 
+    std::vector<bool> reversed;
     std::vector<Region> regions = parse_regions(region_file_path,
                                                 region_format,
                                                 bam_file_key,
                                                 chromosome_to_length,
+                                                reversed,
                                                 strand);
     #ifdef time_region_parsing 
     timer.stop();
@@ -382,7 +486,7 @@ int main(int argc, char* argv[])
       return 0;
     }
 
-    liquidate_and_write(h5file, regions, extension, bam_file_path);
+    liquidate_and_write(h5file, regions, reversed, extension, bam_file_path, bam_file_key, bins);
    
     H5Fclose(h5file);
 
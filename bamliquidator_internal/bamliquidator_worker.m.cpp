@@ -0,0 +1,158 @@
+#include <stdint.h>
+#include <stdio.h>
+
+#include <exception>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include "bamliquidator.h"
+
+// bamliquidator_worker keeps a bam file and its index open and liquidates regions read from stdin,
+// writing the counts to stdout, so a caller can liquidate many regions without starting a
+// bamliquidator process (and loading the index) for each one.  See utils.LiquidatorWorker.
+//
+// All integers are little endian.  Each request is:
+//
+//   uint16 chromosome length (0 to shut down), the chromosome, then
+//   uint32 start, uint32 stop, char strand (+, - or .), uint32 number of bins, uint32 extension
+//
+// and gets one response, in the order the requests were sent:
+//
+//   int32 n, then n doubles with the count of each bin (same as bamliquidator's output), or
+//   if n is negative, an error message of -n characters
+
+#pragma pack(push, 1)
+struct Request
+{
+  uint32_t start;
+  uint32_t stop;
+  char strand;
+  uint32_t number_of_bins;
+  uint32_t extension;
+};
+#pragma pack(pop)
+
+bool read_exactly(void* buffer, size_t size)
+{
+  return fread(buffer, 1, size, stdin) == size;
+}
+
+void write_counts(const std::vector<double>& counts)
+{
+  const int32_t n = counts.size();
+  fwrite(&n, sizeof(n), 1, stdout);
+  fwrite(counts.data(), sizeof(double), counts.size(), stdout);
+  fflush(stdout);
+}
+
+void write_error(const std::string& message)
+{
+  const int32_t n = -static_cast<int32_t>(message.size());
+  fwrite(&n, sizeof(n), 1, stdout);
+  fwrite(message.data(), 1, message.size(), stdout);
+  fflush(stdout);
+}
+
+// returns an error message for an invalid request (matching bamliquidator's argument checks), or ""
+std::string check(const Request& request)
+{
+  std::stringstream ss;
+  if (request.stop <= request.start)
+  {
+    ss << "wrong stop (" << request.stop << ")";
+  }
+  else if (request.strand != '+' && request.strand != '-' && request.strand != '.')
+  {
+    ss << "wrong strand, must be +/-/.";
+  }
+  else if (request.number_of_bins == 0)
+  {
+    ss << "wrong spnum (" << request.number_of_bins << ")";
+  }
+  return ss.str();
+}
+
+int main(int argc, char* argv[])
+{
+  if (argc != 2)
+  {
+    fprintf(stderr, "usage: %s bam_file\n\nliquidates regions of bam_file sent over stdin, see bamliquidator_worker.m.cpp "
+                    "or utils.LiquidatorWorker for the protocol\n", argv[0]);
+    return 1;
+  }
+
+  samfile_t* fp = samopen(argv[1], "rb", 0);
+  if (fp == NULL)
+  {
+    fprintf(stderr, "samopen() error with %s\n", argv[1]);
+    return 2;
+  }
+  bam_index_t* bamidx = bam_index_load(argv[1]);
+  if (bamidx == NULL)
+  {
+    fprintf(stderr, "bam_index_load() error with %s\n", argv[1]);
+    samclose(fp);
+    return 2;
+  }
+
+  for (;;)
+  {
+    uint16_t chromosome_length = 0;
+    if (!read_exactly(&chromosome_length, sizeof(chromosome_length)) || chromosome_length == 0)
+    {
+      break;
+    }
+    std::string chromosome(chromosome_length, '\0');
+    Request request;
+    if (!read_exactly(&chromosome[0], chromosome_length) || !read_exactly(&request, sizeof(request)))
+    {
+      break;
+    }
+
+    const std::string error = check(request);
+    if (!error.empty())
+    {
+      write_error(error);
+      continue;
+    }
+
+    try
+    {
+      write_counts(liquidate(fp, bamidx, chromosome, request.start, request.stop, request.strand,
+                             request.number_of_bins, request.extension));
+    }
+    catch(const std::exception& e)
+    {
+      write_error(e.what());
+    }
+  }
+
+  bam_index_destroy(bamidx);
+  samclose(fp);
+
+  return 0;
+}
+
+/* The MIT License (MIT)
+
+   Copyright (c) 2013 Xin Zhong and Charles Lin
+
+   Permission is hereby granted, free of charge, to any person obtaining a copy
+   of this software and associated documentation files (the "Software"), to deal
+   in the Software without restriction, including without limitation the rights
+   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+   copies of the Software, and to permit persons to whom the Software is
+   furnished to do so, subject to the following conditions:
+
+   The above copyright notice and this permission notice shall be included in
+   all copies or substantial portions of the Software.
+
+   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+   THE SOFTWARE.
+ */
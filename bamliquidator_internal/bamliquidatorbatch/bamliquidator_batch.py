@@ -14,16 +14,47 @@ import logging
 import sys
 import abc
 import collections
+import multiprocessing
 import numpy
+import shutil
+import tempfile
 
 from time import time 
+from time import sleep
 from os.path import basename
 from os.path import dirname
+from distutils.spawn import find_executable
+from xml.sax.saxutils import quoteattr
 
 __version__ = '1.3.0'
 
 default_black_list = ["chrUn", "_random", "Zv9_", "_hap"]
 
+# The liquidators take the function that gets these rows as their idxstats argument, so callers
+# with their own source of bam stats (like the pipeline's cached utils.getBamIdxStats) can pass it in.
+def bam_idxstats(bam_file_path):
+    '''
+    returns samtools idxstats style [chromosome, length, mapped, unmapped] rows for a bam
+    '''
+    output = subprocess.check_output(["samtools", "idxstats", bam_file_path])
+    # skip last two lines: the unmapped chromosome line and the empty line
+    return list(csv.reader(output.split('\n')[:-2], delimiter='\t'))
+
+def executable_path(executable):
+    '''
+    returns the path of a bamliquidator executable, or None if it can't be found
+    '''
+    # This script may be run by either a developer install from a git pipeline checkout,
+    # or from a user install so that the exectuable is on the path.  First we try to
+    # find the exectuable for a developer install, and if that fails we look on the
+    # standard path.
+    if basename(dirname(dirname(os.path.realpath(__file__)))) == 'bamliquidator_internal':
+        # look for developer executable location 
+        path = os.path.join(dirname(dirname(os.path.realpath(__file__))), executable)
+        return path if os.path.isfile(path) else None
+    # just look on standard path
+    return find_executable(executable)
+
 def create_files_table(h5file):
     class Files(tables.IsDescription):
         key       = tables.UInt32Col(    pos=0) # is there an easier way to assign keys?
@@ -69,7 +100,7 @@ class BaseLiquidator(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidation_args(self, bam_file_path, extension, sense, counts_file_path, number_of_threads):
         pass
 
     @abc.abstractmethod
@@ -81,7 +112,8 @@ class BaseLiquidator(object):
         pass
 
     def __init__(self, executable, counts_table_name, output_directory, bam_file_path,
-                 include_cpp_warnings_in_stderr = True, counts_file_path = None, number_of_threads = 0):
+                 include_cpp_warnings_in_stderr = True, counts_file_path = None, number_of_threads = 0,
+                 parallel_files = 1, idxstats = bam_idxstats):
         # clear all memoized values from any prior runs
         nps.file_keys_memo = {}
 
@@ -91,20 +123,13 @@ class BaseLiquidator(object):
         self.counts_file_path = counts_file_path
         self.include_cpp_warnings_in_stderr = include_cpp_warnings_in_stderr
         self.number_of_threads = number_of_threads
+        self.parallel_files = max(1, parallel_files)
+        self.idxstats = idxstats
         self.chromosome_patterns_to_skip = [] 
 
-        # This script may be run by either a developer install from a git pipeline checkout,
-        # or from a user install so that the exectuable is on the path.  First we try to
-        # find the exectuable for a developer install, and if that fails we look on the
-        # standard path.
-        if basename(dirname(dirname(os.path.realpath(__file__)))) == 'bamliquidator_internal':
-            # look for developer executable location 
-            self.executable_path = os.path.join(dirname(dirname(os.path.realpath(__file__))), executable)
-            if not os.path.isfile(self.executable_path):
-                exit("%s is missing -- try cd'ing into the directory and running 'make'" % self.executable_path)
-        else:
-            # just look on standard path
-            self.executable_path = executable 
+        self.executable_path = executable_path(executable)
+        if self.executable_path is None:
+            exit("%s is missing -- try cd'ing into the bamliquidator_internal directory and running 'make'" % executable)
 
         mkdir_if_not_exists(output_directory)
 
@@ -161,10 +186,7 @@ class BaseLiquidator(object):
         next_file_key += 1
 
         for bam_file_path in self.bam_file_paths:
-            args = ["samtools", "idxstats", bam_file_path]
-            output = subprocess.check_output(args)
-            # skip last two lines: the unmapped chromosome line and the empty line
-            reader = csv.reader(output.split('\n')[:-2], delimiter='\t')
+            reader = self.idxstats(bam_file_path)
             file_name = basename(bam_file_path)
             file_count = 0
             
@@ -196,13 +218,31 @@ class BaseLiquidator(object):
         assert(len(file_names) - 1 == len(files))
         assert(len(file_names) == next_file_key)
 
+    def liquidate(self, bam_file_path, extension, sense = None):
+        args = self.liquidation_args(bam_file_path, extension, sense, self.counts_file_path, self.number_of_threads)
+
+        start = time()
+        return_code = subprocess.call(args)
+        self.log_liquidation(bam_file_path, time() - start)
+
+        return return_code
+
+    def log_liquidation(self, bam_file_path, duration):
+        logging.info("Liquidation completed: %f seconds", duration)
+        self.log_time('liquidation %s' % basename(bam_file_path), duration)
+
     def batch(self, extension, sense):
-        for i, bam_file_path in enumerate(self.bam_file_paths):
-            logging.info("Liquidating %s (file %d of %d)", bam_file_path, i+1, len(self.bam_file_paths))
+        start = time()
+        if self.parallel_files > 1 and len(self.bam_file_paths) > 1:
+            self.batch_parallel(extension, sense)
+        else:
+            for i, bam_file_path in enumerate(self.bam_file_paths):
+                logging.info("Liquidating %s (file %d of %d)", bam_file_path, i+1, len(self.bam_file_paths))
 
-            return_code = self.liquidate(bam_file_path, extension, sense)
-            if return_code != 0:
-                raise Exception("%s failed with exit code %d" % (self.executable_path, return_code))
+                return_code = self.liquidate(bam_file_path, extension, sense)
+                if return_code != 0:
+                    raise Exception("%s failed with exit code %d" % (self.executable_path, return_code))
+        self.log_time('liquidation', time() - start)
 
         start = time()
         self.normalize()
@@ -210,6 +250,83 @@ class BaseLiquidator(object):
         logging.info("Post liquidation processing took %f seconds", duration)
         self.log_time('post_liquidation', duration)
 
+    # Liquidates up to parallel_files bam files at once.  Each liquidation writes to its own HDF5 shard
+    # holding just the counts, since HDF5 files can't be written by several processes, and the shards
+    # are appended to counts.h5 in bam file order once they are all done, so counts.h5 ends up the same
+    # as with liquidating one file at a time.  The files and file_names tables were already filled in
+    # by preprocess, so file keys are the same either way.
+    def batch_parallel(self, extension, sense):
+        number_of_threads = self.number_of_threads
+        if number_of_threads == 0:
+            # split the cpus between the files instead of each liquidation using all of them
+            number_of_threads = max(1, multiprocessing.cpu_count() // self.parallel_files)
+
+        shard_directory = tempfile.mkdtemp(prefix='shards_', dir=self.output_directory)
+        running = []
+        try:
+            shard_file_paths = []
+            pending = list(enumerate(self.bam_file_paths))
+            failures = []
+            while len(running) > 0 or (len(pending) > 0 and len(failures) == 0):
+                while len(pending) > 0 and len(running) < self.parallel_files and len(failures) == 0:
+                    i, bam_file_path = pending.pop(0)
+                    logging.info("Liquidating %s (file %d of %d)", bam_file_path, i+1, len(self.bam_file_paths))
+                    shard_file_path = self.create_shard(shard_directory, bam_file_path)
+                    shard_file_paths.append(shard_file_path)
+                    args = self.liquidation_args(bam_file_path, extension, sense, shard_file_path, number_of_threads)
+                    running.append((bam_file_path, subprocess.Popen(args), time()))
+
+                sleep(0.05)
+                still_running = []
+                for bam_file_path, process, start in running:
+                    return_code = process.poll()
+                    if return_code is None:
+                        still_running.append((bam_file_path, process, start))
+                    elif return_code != 0:
+                        failures.append((bam_file_path, return_code))
+                    else:
+                        self.log_liquidation(bam_file_path, time() - start)
+                running = still_running
+
+            if len(failures) > 0:
+                raise Exception("%s failed with exit code %d for %s" % (self.executable_path, failures[0][1],
+                                                                        failures[0][0]))
+
+            start = time()
+            self.merge_shards(shard_file_paths)
+            duration = time() - start
+            logging.info("Merging %d shards took %f seconds", len(shard_file_paths), duration)
+            self.log_time('merging shards', duration)
+        finally:
+            # only left running if something went wrong
+            for _, process, _ in running:
+                process.kill()
+                process.wait()
+            shutil.rmtree(shard_directory)
+
+    def create_shard(self, shard_directory, bam_file_path):
+        shard_file_path = os.path.join(shard_directory, "file_%d.h5" % self.file_to_key[basename(bam_file_path)])
+        with tables.open_file(shard_file_path, mode = "w") as shard_file:
+            self.create_counts_table(shard_file)
+        return shard_file_path
+
+    # appends the counts tables of the shards to the tables of the same name in counts.h5, and copies
+    # over the datasets in any groups (e.g. /region_bin_counts)
+    def merge_shards(self, shard_file_paths):
+        with tables.open_file(self.counts_file_path, mode = "r+") as counts_file:
+            for shard_file_path in shard_file_paths:
+                with tables.open_file(shard_file_path, mode = "r") as shard_file:
+                    for node in shard_file.root:
+                        if isinstance(node, tables.Table):
+                            table = counts_file.get_node("/", node._v_name)
+                            table.append(node.read())
+                            table.flush()
+                        elif isinstance(node, tables.Group):
+                            if "/" + node._v_name not in counts_file:
+                                counts_file.create_group("/", node._v_name)
+                            for child in node:
+                                child._f_copy(newparent = counts_file.get_node("/", node._v_name))
+
     def flatten(self):
         logging.info("Flattening HDF5 tables into text files")
         start = time()
@@ -241,46 +358,46 @@ class BaseLiquidator(object):
         with open(os.path.join(self.output_directory, 'timings.xml'), 'w') as xml:
             xml.write('<testsuite tests="%d">\n' % len(self.timings.keys()))
             for title in self.timings:
-                xml.write('\t<testcase classname="bamliquidator" name="%s" time="%f"/>\n' % (title, self.timings[title]))
+                xml.write('\t<testcase classname="bamliquidator" name=%s time="%f"/>\n' % (quoteattr(title), self.timings[title]))
             xml.write('</testsuite>\n')
 
 class BinLiquidator(BaseLiquidator):
     def __init__(self, bin_size, output_directory, bam_file_path,
                  counts_file_path = None, extension = 0, sense = '.', skip_plot = False,
-                 include_cpp_warnings_in_stderr = True, number_of_threads = 0, blacklist = default_black_list):
+                 include_cpp_warnings_in_stderr = True, number_of_threads = 0, blacklist = default_black_list,
+                 parallel_files = 1, idxstats = bam_idxstats):
         self.bin_size = bin_size
         self.skip_plot = skip_plot
         super(BinLiquidator, self).__init__("bamliquidator_bins", "bin_counts", output_directory, bam_file_path,
-                                            include_cpp_warnings_in_stderr, counts_file_path, number_of_threads)
+                                            include_cpp_warnings_in_stderr, counts_file_path, number_of_threads,
+                                            parallel_files, idxstats)
         self.chromosome_patterns_to_skip = blacklist
         self.batch(extension, sense)
 
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidation_args(self, bam_file_path, extension, sense, counts_file_path, number_of_threads):
         if sense is None: sense = '.'
 
         cell_type = basename(dirname(bam_file_path))
         if cell_type == '':
             cell_type = '-'
         bam_file_name = basename(bam_file_path)
-        args = [self.executable_path, str(self.number_of_threads), cell_type, str(self.bin_size), str(extension), sense, bam_file_path, 
-                str(self.file_to_key[bam_file_name]), self.counts_file_path]
+        args = [self.executable_path, str(number_of_threads), cell_type, str(self.bin_size), str(extension), sense, bam_file_path, 
+                str(self.file_to_key[bam_file_name]), counts_file_path]
         args.extend(self.logging_cpp_args())
         args.extend(self.chromosome_args(bam_file_name, skip_non_canonical=True))
+        return args
 
-        start = time()
-        return_code = subprocess.call(args)
-        duration = time() - start
-
-        reads = self.file_to_count[bam_file_name]
+    def log_liquidation(self, bam_file_path, duration):
+        reads = self.file_to_count[basename(bam_file_path)]
         rate = reads / (10**6) / duration
         logging.info("Liquidation completed: %f seconds, %d reads, %f millions of reads per second", duration, reads, rate)
-        self.log_time('liquidation', duration)
-
-        return return_code
+        self.log_time('liquidation %s' % basename(bam_file_path), duration)
        
     def normalize(self):
+        # when appending to a counts file that was already normalized, just the new bam files are normalized
         with tables.open_file(self.counts_file_path, mode = "r+") as counts_file:
-            nps.normalize_plot_and_summarize(counts_file, self.output_directory, self.bin_size, self.skip_plot) 
+            nps.normalize_plot_and_summarize(counts_file, self.output_directory, self.bin_size, self.skip_plot,
+                                             new_file_keys = self.file_to_key.values())
 
     def create_counts_table(self, h5file):
         class BinCount(tables.IsDescription):
@@ -294,11 +411,17 @@ class BinLiquidator(BaseLiquidator):
         table.flush()
         return table
 
+# With number_of_bins or region_bin_size, each region is also split into bins (like bamToGFF's
+# matrix and clustergram modes), which are written to /region_bin_counts -- see read_region_bin_counts.
+# A sense of '~' counts the strand opposite to each region's strand.
 class RegionLiquidator(BaseLiquidator):
     def __init__(self, regions_file, output_directory, bam_file_path,
                  region_format=None, counts_file_path = None, extension = 0, sense = '.',
-                 include_cpp_warnings_in_stderr = True, number_of_threads = 0):
+                 include_cpp_warnings_in_stderr = True, number_of_threads = 0,
+                 number_of_bins = 0, region_bin_size = 0, parallel_files = 1, idxstats = bam_idxstats):
         self.regions_file = regions_file
+        # the executable takes n > 0 for n bins per region and -n for n base pair bins
+        self.bins = number_of_bins if number_of_bins else -region_bin_size
         self.region_format = region_format
         if self.region_format is None:
             _, self.region_format = os.path.splitext(regions_file)
@@ -309,29 +432,23 @@ class RegionLiquidator(BaseLiquidator):
                                % str(self.region_format))
 
         super(RegionLiquidator, self).__init__("bamliquidator_regions", "region_counts", output_directory, 
-                                               bam_file_path, include_cpp_warnings_in_stderr, counts_file_path, number_of_threads)
+                                               bam_file_path, include_cpp_warnings_in_stderr, counts_file_path, number_of_threads,
+                                               parallel_files, idxstats)
         
         self.batch(extension, sense)
 
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidation_args(self, bam_file_path, extension, sense, counts_file_path, number_of_threads):
         bam_file_name = basename(bam_file_path)
-        args = [self.executable_path, str(self.number_of_threads), self.regions_file, str(self.region_format), str(extension), bam_file_path, 
-                str(self.file_to_key[bam_file_name]), self.counts_file_path]
+        args = [self.executable_path, str(number_of_threads), self.regions_file, str(self.region_format), str(extension), bam_file_path, 
+                str(self.file_to_key[bam_file_name]), counts_file_path]
         args.extend(self.logging_cpp_args())
         if sense is None:
             args.append('_') # _ means use strand specified in region file (or . if none specified)
         else:
             args.append(sense)
+        args.append(str(self.bins))
         args.extend(self.chromosome_args(bam_file_name, skip_non_canonical=False))
-
-        start = time()
-        return_code = subprocess.call(args)
-        duration = time() - start
-
-        logging.info("Liquidation completed: %f seconds", duration)
-        self.log_time('liquidation', duration)
-
-        return return_code
+        return args
 
     def normalize(self):
         with tables.open_file(self.counts_file_path, mode = "r+") as counts_file:
@@ -352,6 +469,61 @@ class RegionLiquidator(BaseLiquidator):
         table.flush()
         return table
 
+def read_region_bin_counts(counts_file, file_key):
+    '''
+    returns the region_counts records of a file liquidated with number_of_bins or region_bin_size,
+    and a list with the bin counts of each region, 5' to 3' along the region
+    '''
+    bin_counts = counts_file.get_node("/region_bin_counts", "file_%d" % file_key)
+    bins = int(bin_counts.attrs.bins)
+    counts = bin_counts.read()
+    regions = counts_file.root.region_counts.read_where("file_key == %d" % file_key)
+
+    if bins > 0:
+        offsets = numpy.arange(len(regions) + 1) * bins
+    else:
+        lengths = (regions["stop"] - regions["start"] + 1).astype(numpy.int64)
+        offsets = numpy.append(0, numpy.cumsum(lengths // -bins))
+    return regions, [counts[offsets[i]:offsets[i+1]] for i in range(len(regions))]
+
+def liquidate_region_bins(bam_file_path, gff, sense = '.', extension = 0, number_of_bins = 0, region_bin_size = 0,
+                          number_of_threads = 0, idxstats = bam_idxstats):
+    '''
+    liquidates the bins of every line of a gff (a list of rows) in a single bamliquidator_regions run,
+    returning a list w/ each line's bin counts 5' to 3' along the line, or None for lines that were
+    excluded (e.g. chromosomes not in the bam). sense '+' counts reads on each line's strand, '-' reads
+    on the other strand, and anything else both strands, like bamToGFF_turbo
+    '''
+    strand = {'+': '_', '-': '~'}.get(sense, '.')
+    output_directory = tempfile.mkdtemp(prefix='bamliquidator_regions_')
+    try:
+        regions_file = os.path.join(output_directory, "regions.gff")
+        with open(regions_file, "w") as regions:
+            for line in gff:
+                regions.write("\t".join(line[0:9]) + "\n")
+
+        liquidator = RegionLiquidator(regions_file, output_directory, bam_file_path, "gff", extension = extension,
+                                      sense = strand, include_cpp_warnings_in_stderr = False,
+                                      number_of_threads = number_of_threads, number_of_bins = number_of_bins,
+                                      region_bin_size = region_bin_size, idxstats = idxstats)
+        with tables.open_file(liquidator.counts_file_path, "r") as counts_file:
+            regions, bin_counts = read_region_bin_counts(counts_file, liquidator.file_to_key[basename(bam_file_path)])
+    finally:
+        shutil.rmtree(output_directory)
+
+    # regions are liquidated in gff order, but invalid ones are left out
+    line_bins = []
+    i = 0
+    for line in gff:
+        start, stop = sorted([int(line[3]), int(line[4])])
+        if (i < len(regions) and regions[i]["chromosome"] == line[0]
+            and regions[i]["start"] == start and regions[i]["stop"] == stop):
+            line_bins.append(bin_counts[i])
+            i += 1
+        else:
+            line_bins.append(None)
+    return line_bins
+
 def write_bamToGff_matrix(output_file_path, h5_region_counts_file_path):
     with tables.open_file(h5_region_counts_file_path, "r") as counts_file:
         with open(output_file_path, "w") as output:
@@ -472,9 +644,14 @@ def main():
     parser.add_argument('-n', '--number_of_threads', type=int, default=0,
                         help='Number of threads to run concurrently during liquidation.  Defaults to the total number of logical '
                              'cpus on the system.')
+    parser.add_argument('-p', '--parallel_files', type=int, default=1,
+                        help='Number of bam files to liquidate at once, each into its own HDF5 shard that is merged into the '
+                             'counts file afterwards.  The threads of each liquidation default to the number of logical cpus '
+                             'divided by this.  Default is 1.')
     parser.add_argument('--xml_timings', action='store_true',
-                        help='Write performance timings to junit style timings.xml in output folder, which is useful for '
-                             'tracking performance over time with automatically generated Jenkins graphs')
+                        help='Write performance timings (including the liquidation time of each bam file) to junit style '
+                             'timings.xml in output folder, which is useful for tracking performance over time with '
+                             'automatically generated Jenkins graphs')
     parser.add_argument('--version', action='version', version='%s %s' % (basename(sys.argv[0]), __version__))
     parser.add_argument('bam_file_path', 
                         help='The directory to recursively search for .bam files for counting.  Every .bam file must '
@@ -500,7 +677,7 @@ def main():
     if args.regions_file is None:
         liquidator = BinLiquidator(args.bin_size, args.output_directory, args.bam_file_path,
                                    args.counts_file, args.extension, args.sense, args.skip_plot,
-                                   not args.quiet, args.number_of_threads, args.black_list)
+                                   not args.quiet, args.number_of_threads, args.black_list, args.parallel_files)
     else:
         if args.counts_file:
             raise Exception("Appending to a prior regions counts.h5 file is not supported at this time -- "
@@ -509,7 +686,7 @@ def main():
         ## review matrix output, specifically the assumption that each file has the exact same regions in the same order
         liquidator = RegionLiquidator(args.regions_file, args.output_directory, args.bam_file_path, 
                                       args.region_format, args.counts_file, args.extension, args.sense,
-                                      not args.quiet, args.number_of_threads)
+                                      not args.quiet, args.number_of_threads, parallel_files = args.parallel_files)
 
     if args.flatten:
         liquidator.flatten()
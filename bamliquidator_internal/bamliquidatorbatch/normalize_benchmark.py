@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Times the stages of normalize_plot_and_summarize on a synthetic counts.h5 with bin counts for
+# several cell types and bam files, like bamliquidator_bins would write, and prints checksums of
+# the resulting tables so runs before and after a change can be compared.  With --append, also times
+# normalizing the last bam files incrementally after appending them to an already normalized counts.h5.
+
+from __future__ import division
+
+import bamliquidator_batch as blb
+import normalize_plot_and_summarize as nps
+
+import argparse
+import collections
+import hashlib
+import numpy
+import os
+import shutil
+import tables
+import tempfile
+
+from time import time
+
+stages = ['populate_normalized_counts', 'populate_percentiles', 'populate_normalized_counts_for_cell_type',
+          'populate_summary']
+
+def create_counts_file(path, number_of_cell_types, files_per_cell_type, number_of_chromosomes, bins_per_chromosome,
+                       seed=0):
+    rng = numpy.random.RandomState(seed)
+    with tables.open_file(path, mode = "w") as counts_file:
+        counts = blb.BinLiquidator.__new__(blb.BinLiquidator).create_counts_table(counts_file)
+        files = blb.create_files_table(counts_file)
+        file_names = blb.create_file_names_array(counts_file)
+
+        file_key = 1
+        for cell_type_index in range(number_of_cell_types):
+            cell_type = "cell_type_%d" % cell_type_index
+            for i in range(files_per_cell_type):
+                # bamliquidator_bins appends a file's chromosomes in order, one bin after another
+                rows = numpy.empty(number_of_chromosomes * bins_per_chromosome, dtype=counts.dtype)
+                rows["bin_number"] = numpy.tile(numpy.arange(bins_per_chromosome), number_of_chromosomes)
+                rows["cell_type"] = cell_type
+                rows["chromosome"] = numpy.repeat(["chr%d" % (c + 1) for c in range(number_of_chromosomes)],
+                                                  bins_per_chromosome)
+                # a few hot bins on a noisy background, so percentiles have ties and spread
+                rows["count"] = rng.poisson(rng.gamma(1.0, 2000, len(rows)))
+                rows["file_key"] = file_key
+                counts.append(rows)
+
+                files.row["key"] = file_key
+                files.row["length"] = max(1, rows["count"].sum() // 100)
+                files.row.append()
+                file_names.append("%s_%d.bam" % (cell_type, i))
+                file_key += 1
+        counts.flush()
+        files.flush()
+        file_names.flush()
+
+# removes the last number_of_files bam files from the counts file, returning their bin_counts and files rows
+def remove_files(counts_file_path, number_of_files):
+    with tables.open_file(counts_file_path, mode = "r+") as counts_file:
+        counts = counts_file.root.bin_counts
+        files = counts_file.root.files
+        removed_files = files.read(files.nrows - number_of_files)
+        first_row = counts.get_where_list("file_key >= %d" % removed_files["key"].min(), sort=True)[0]
+        removed_counts = counts.read(first_row)
+        counts.remove_rows(first_row)
+        files.remove_rows(files.nrows - number_of_files)
+    return removed_counts, removed_files
+
+def append_files(counts_file_path, removed_counts, removed_files):
+    with tables.open_file(counts_file_path, mode = "r+") as counts_file:
+        counts_file.root.bin_counts.append(removed_counts)
+        counts_file.root.files.append(removed_files)
+
+def sorted_rows(table):
+    rows = table.read()
+    order = numpy.lexsort([rows[name] for name in reversed(rows.dtype.names)])
+    return rows[order]
+
+def table_checksum(table):
+    return hashlib.md5(sorted_rows(table).tostring()).hexdigest()
+
+# true if the normalized_counts and summary tables have the same rows, allowing for floating point rounding
+def tables_match(counts_file_path, other_counts_file_path):
+    with tables.open_file(counts_file_path, mode = "r") as counts_file:
+        with tables.open_file(other_counts_file_path, mode = "r") as other_counts_file:
+            for name in ["normalized_counts", "summary"]:
+                rows = counts_file.get_node("/", name).read()
+                other_rows = other_counts_file.get_node("/", name).read()
+                if len(rows) != len(other_rows):
+                    return False
+                keys = [field for field in rows.dtype.names if rows.dtype[field].kind != 'f']
+                rows = rows[numpy.lexsort([rows[field] for field in reversed(keys)])]
+                other_rows = other_rows[numpy.lexsort([other_rows[field] for field in reversed(keys)])]
+                for field in rows.dtype.names:
+                    if field in keys:
+                        if not numpy.array_equal(rows[field], other_rows[field]):
+                            return False
+                    elif not numpy.allclose(rows[field], other_rows[field], equal_nan=True):
+                        return False
+    return True
+
+def benchmark(counts_file_path, output_directory, bin_size, new_file_keys=None):
+    timings = collections.OrderedDict((stage, 0.0) for stage in stages)
+    originals = dict((stage, getattr(nps, stage)) for stage in stages)
+
+    def timed(stage):
+        def call(*args, **kwargs):
+            start = time()
+            try:
+                return originals[stage](*args, **kwargs)
+            finally:
+                timings[stage] += time() - start
+        return call
+
+    for stage in stages:
+        setattr(nps, stage, timed(stage))
+    try:
+        nps.file_keys_memo = {}
+        start = time()
+        with tables.open_file(counts_file_path, mode = "r+") as counts_file:
+            nps.normalize_plot_and_summarize(counts_file, output_directory, bin_size, skip_plot=True,
+                                             new_file_keys=new_file_keys)
+        timings['total'] = time() - start
+    finally:
+        for stage in stages:
+            setattr(nps, stage, originals[stage])
+
+    with tables.open_file(counts_file_path, mode = "r") as counts_file:
+        checksums = collections.OrderedDict((name, table_checksum(counts_file.get_node("/", name)))
+                                            for name in ["normalized_counts", "summary"])
+    return timings, checksums
+
+def main():
+    parser = argparse.ArgumentParser(description='Time normalize_plot_and_summarize on a synthetic counts.h5')
+    parser.add_argument('--cell_types', type=int, default=3, help='number of cell types (default 3)')
+    parser.add_argument('--files_per_cell_type', type=int, default=4, help='bam files per cell type (default 4)')
+    parser.add_argument('--chromosomes', type=int, default=4, help='number of chromosomes (default 4)')
+    parser.add_argument('--bins', type=int, default=5000, help='bins per chromosome (default 5000)')
+    parser.add_argument('--bin_size', type=int, default=100000, help='bin size used for normalizing (default 100000)')
+    parser.add_argument('--append', type=int, default=0,
+                        help='also time normalizing this many of the bam files after appending them to an already '
+                             'normalized counts.h5 (default 0)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='normalize_benchmark_')
+    try:
+        counts_file_path = os.path.join(directory, "counts.h5")
+        create_counts_file(counts_file_path, args.cell_types, args.files_per_cell_type, args.chromosomes, args.bins)
+        print "%d files, %d bins each" % (args.cell_types * args.files_per_cell_type, args.chromosomes * args.bins)
+
+        if args.append:
+            appended_file_path = os.path.join(directory, "appended_counts.h5")
+            shutil.copy(counts_file_path, appended_file_path)
+            removed_counts, removed_files = remove_files(appended_file_path, args.append)
+            benchmark(appended_file_path, directory, args.bin_size)
+            append_files(appended_file_path, removed_counts, removed_files)
+            incremental_timings, _ = benchmark(appended_file_path, directory, args.bin_size,
+                                               new_file_keys=removed_files["key"].tolist())
+
+        timings, checksums = benchmark(counts_file_path, directory, args.bin_size)
+        for stage, seconds in timings.iteritems():
+            print "%-42s %8.3f seconds" % (stage, seconds)
+        for name, checksum in checksums.iteritems():
+            print "%-42s %s" % (name + " md5", checksum)
+
+        if args.append:
+            print "after appending %d bam files:" % args.append
+            for stage, seconds in incremental_timings.iteritems():
+                print "%-42s %8.3f seconds" % (stage, seconds)
+            print "%-42s %s" % ("matches normalizing everything", tables_match(appended_file_path, counts_file_path))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
+
+'''
+   The MIT License (MIT)
+
+   Copyright (c) 2013 John DiMatteo (jdimatteo@gmail.com)
+
+   Permission is hereby granted, free of charge, to any person obtaining a copy
+   of this software and associated documentation files (the "Software"), to deal
+   in the Software without restriction, including without limitation the rights
+   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+   copies of the Software, and to permit persons to whom the Software is
+   furnished to do so, subject to the following conditions:
+
+   The above copyright notice and this permission notice shall be included in
+   all copies or substantial portions of the Software.
+
+   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+   THE SOFTWARE.
+'''
@@ -33,6 +33,7 @@ import tables
 import scipy.stats as stats
 import collections
 import logging
+import numpy
 
 try:
     try:
@@ -64,12 +65,20 @@ except:
 chromosome_name_length = 64 # Includes 1 for null terminator, so really max of 63 characters.
                             # Note that changing this value requires updating C++ code as well.
 
+rows_per_block = 1000000 # rows read into memory at once when normalizing
+
+high_percentile = 95 # the summary's 95th percentile columns
+low_percentile  = 5  # the summary's 5th percentile columns
+
 def delete_all_but_bin_counts_and_files_table(h5file):
     for table in h5file.root:
         if table.name != "bin_counts" and table.name != "files" and table.name != "file_names":
-            for index in table.colindexes.values():
-                index.column.remove_index()
-            table.remove()
+            delete_table(table)
+
+def delete_table(table):
+    for index in table.colindexes.values():
+        index.column.remove_index()
+    table.remove()
 
 def create_normalized_counts_table(h5file):
     class BinCount(tables.IsDescription):
@@ -89,31 +98,35 @@ def create_normalized_counts_table(h5file):
 def all_cell_types(counts):
     types = set()
 
-    for row in counts:
-        types.add(row["cell_type"])
+    for start in xrange(0, counts.nrows, rows_per_block):
+        types.update(numpy.unique(counts.read(start, start + rows_per_block, field="cell_type")).tolist())
 
     return types 
 
+# chromosomes in the order they first appear in the table
 def all_chromosomes(counts):
     chromosomes = collections.OrderedDict() 
 
-    for row in counts:
-        chromosomes[row["chromosome"]] = None
+    for start in xrange(0, counts.nrows, rows_per_block):
+        for chromosome in unique_in_order(counts.read(start, start + rows_per_block, field="chromosome")):
+            chromosomes[chromosome] = None
 
     return chromosomes.keys() 
 
+# the unique values of a numpy array, in the order they first appear
+def unique_in_order(values):
+    unique_values, first_indexes = numpy.unique(values, return_index=True)
+    return unique_values[numpy.argsort(first_indexes)].tolist()
+
 # todo: if this used the files table and we added the cell_type to the files table, this would be much faster,
 #       but it is probably necessary to leave cell_type in counts table as well (for queries)
 file_keys_memo = {}
 def file_keys(counts, cell_type):
     if not cell_type in file_keys_memo:
-        file_keys = set() 
-       
         logging.debug("Getting file keys for cell type %s", cell_type)
-        for row in counts.where("cell_type == '%s'" % cell_type):
-            file_keys.add(row["file_key"])
+        file_keys = counts.read_where("cell_type == '%s'" % cell_type, field="file_key")
 
-        file_keys_memo[cell_type] = file_keys
+        file_keys_memo[cell_type] = set(numpy.unique(file_keys).tolist())
 
         logging.debug("memoizing files for %s: %s", cell_type, str(file_keys_memo[cell_type]))
         
@@ -193,15 +206,20 @@ def populate_normalized_counts(normalized_counts, counts, file_key, bin_size, fi
     '''
     factor = (1 / bin_size) * (1 / (total_count / 10**6))
 
-    for count_row in counts.where("file_key == %d" % file_key):
-        normalized_counts.row["bin_number"] = count_row["bin_number"]
-        normalized_counts.row["cell_type"] = count_row["cell_type"] 
-        normalized_counts.row["chromosome"] = count_row["chromosome"] 
-        assert file_key == count_row["file_key"]
-        normalized_counts.row["file_key"] = file_key
-        normalized_counts.row["count"] = count_row["count"] * factor 
-        normalized_counts.row["percentile"] = -1
-        normalized_counts.row.append()
+    # the file's counts are read into numpy, scaled and appended a block of rows at a time instead of
+    # row by row; blocks bound the memory used for small bin sizes
+    for start in xrange(0, counts.nrows, rows_per_block):
+        count_rows = counts.read_where("file_key == %d" % file_key, start=start, stop=start + rows_per_block)
+        if len(count_rows) == 0:
+            continue
+        normalized_rows = numpy.empty(len(count_rows), dtype=normalized_counts.dtype)
+        normalized_rows["bin_number"] = count_rows["bin_number"]
+        normalized_rows["cell_type"] = count_rows["cell_type"]
+        normalized_rows["chromosome"] = count_rows["chromosome"]
+        normalized_rows["file_key"] = file_key
+        normalized_rows["count"] = count_rows["count"] * factor
+        normalized_rows["percentile"] = -1
+        normalized_counts.append(normalized_rows)
 
     normalized_counts.flush()
   
@@ -229,59 +247,102 @@ def normalize_regions(region_counts, files):
 
     region_counts.flush()
 
-# leave off file_key argument to calculate percentiles for the cell_type averaged normalized counts
+# percentiles of each count among the counts with the same key, the same as
+# (stats.rankdata(counts) - 1) / (len(counts) - 1) * 100 for each key's counts,
+# but ranking every key at once
+def grouped_percentiles(keys, counts):
+    if len(numpy.unique(keys)) == 1:
+        return (stats.rankdata(counts) - 1) / (len(counts)-1) * 100
+        # percentiles calculated in bulk as suggested at 
+        # http://grokbase.com/t/python/python-list/092235vj27/faster-scipy-percentileofscore
+
+    order = numpy.lexsort((counts, keys))
+    sorted_keys = keys[order]
+    sorted_counts = counts[order]
+    positions = numpy.arange(len(order))
+
+    new_key = numpy.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    key_ids = numpy.cumsum(new_key) - 1
+    key_starts = positions[new_key]
+    key_sizes = numpy.diff(numpy.r_[key_starts, len(order)])
+
+    # tied counts share the average of their ranks, like rankdata
+    new_count = new_key | numpy.r_[True, sorted_counts[1:] != sorted_counts[:-1]]
+    tie_starts = positions[new_count]
+    tie_ends = numpy.r_[tie_starts[1:], len(order)] - 1
+    ranks = ((tie_starts + tie_ends) / 2)[numpy.cumsum(new_count) - 1] - key_starts[key_ids]
+
+    percentiles = numpy.empty(len(order))
+    percentiles[order] = ranks / (key_sizes[key_ids] - 1) * 100
+    return percentiles
+
+# leave off file_key argument to calculate percentiles for the cell_type averaged normalized counts,
+# or pass None to calculate percentiles for each of the cell type's files at once
 def populate_percentiles(normalized_counts, cell_type, file_key = 0):
-    bin_numbers = []
-    normalized_count_list = []
-
-    condition = "(cell_type == '%s') & (file_key == %d)" % (cell_type, file_key)
-
-    for row in normalized_counts.where(condition):
-        bin_numbers.append(row["bin_number"])
-        normalized_count_list.append(row["count"])
-
-    percentiles = (stats.rankdata(normalized_count_list) - 1) / (len(normalized_count_list)-1) * 100
-    # percentiles calculated in bulk as suggested at 
-    # http://grokbase.com/t/python/python-list/092235vj27/faster-scipy-percentileofscore
+    if file_key is None:
+        condition = "(cell_type == '%s') & (file_key != 0)" % cell_type
+    else:
+        condition = "(cell_type == '%s') & (file_key == %d)" % (cell_type, file_key)
 
-    for i, row in enumerate(normalized_counts.where(condition)):
-        assert bin_numbers[i] == row["bin_number"]
-        row["percentile"] = percentiles[i]
-        row.update()
+    coordinates = normalized_counts.get_where_list(condition, sort=True)
+    if len(coordinates) == 0:
+        return
+    rows = normalized_counts.read_coordinates(coordinates)
+    modify_column_at(normalized_counts, coordinates, grouped_percentiles(rows["file_key"], rows["count"]),
+                     "percentile")
     normalized_counts.flush()
 
+# writes column to the rows at the sorted coordinates, a run of consecutive rows at a time -- the rows are
+# normally one run (they were appended together), and unlike modify_coordinates, only the column's index
+# (if any) needs updating
+def modify_column_at(table, coordinates, column, colname):
+    run_starts = numpy.flatnonzero(numpy.r_[True, numpy.diff(coordinates) != 1])
+    run_stops = numpy.r_[run_starts[1:], len(coordinates)]
+    for start, stop in zip(run_starts, run_stops):
+        table.modify_column(start=coordinates[start], stop=coordinates[stop - 1] + 1, column=column[start:stop],
+                            colname=colname)
+
 # the cell type normalized counts are the averages of the genomes in the cell type
 def populate_normalized_counts_for_cell_type(normalized_counts, cell_type, file_keys):
-    processed_a_single_file = False
-    chromosome_to_summed_counts = collections.OrderedDict() 
-
-    for file_key in file_keys:
-        condition = "(file_key == %d) & (cell_type == '%s')" % (file_key, cell_type)
-        for row in normalized_counts.where(condition):
-            if processed_a_single_file:
-                chromosome_to_summed_counts[row["chromosome"]][row["bin_number"]] += row["count"]
-            else:
-                if not chromosome_to_summed_counts.has_key(row["chromosome"]):
-                    chromosome_to_summed_counts[row["chromosome"]] = []
-                chromosome_to_summed_counts[row["chromosome"]].append(row["count"])
-        processed_a_single_file = True
-            
-    cell_type_condition = "(file_key == 0) & (cell_type == '%s')" % cell_type
-
-    len_file_keys = len(file_keys)
-
-    for chromosome, summed_counts in chromosome_to_summed_counts.iteritems():
-        for i, summed_count in enumerate(summed_counts):
-            normalized_counts.row["bin_number"] = i
-            normalized_counts.row["cell_type"] = cell_type 
-            normalized_counts.row["chromosome"] = chromosome 
-            normalized_counts.row["file_key"] = 0 
-            normalized_counts.row["count"] = chromosome_to_summed_counts[chromosome][i] / len_file_keys
-            normalized_counts.row["percentile"] = -1
-            normalized_counts.row.append()
+    if len(file_keys) == 0:
+        return
 
+    normalized_counts.append(normalized_counts_for_cell_type(normalized_counts, cell_type, file_keys))
     normalized_counts.flush()
 
+# returns the cell type rows (file_key 0) of the normalized counts, with percentiles of -1
+def normalized_counts_for_cell_type(normalized_counts, cell_type, file_keys):
+    # each file's rows are contiguous, so reading them all at once in table order gives one row of bins per file
+    rows = normalized_counts.read_where("(file_key != 0) & (cell_type == '%s')" % cell_type)
+    layout = rows[["chromosome", "bin_number"]]
+    bins_per_file = len(rows) // len(file_keys)
+
+    if bins_per_file * len(file_keys) == len(rows) and \
+            (layout.reshape(len(file_keys), bins_per_file) == layout[:bins_per_file]).all():
+        summed_counts = rows["count"].reshape(len(file_keys), bins_per_file).sum(axis=0)
+    else:
+        # the files don't all have the same bins, so add each file's counts into the bins of the first file
+        logging.warning("bam files of cell type %s don't all have the same bins", cell_type)
+        first_file_key = rows[0]["file_key"]
+        bins_per_file = numpy.count_nonzero(rows["file_key"] == first_file_key)
+        bin_index = dict((tuple(bin), i) for i, bin in enumerate(layout[:bins_per_file].tolist()))
+        summed_counts = numpy.zeros(bins_per_file)
+        for file_key in file_keys:
+            file_rows = rows[rows["file_key"] == file_key]
+            indexes = [bin_index.get(bin, -1) for bin in file_rows[["chromosome", "bin_number"]].tolist()]
+            indexes = numpy.array(indexes, dtype=numpy.int64)
+            found = indexes >= 0
+            summed_counts[indexes[found]] += file_rows["count"][found]
+
+    cell_type_rows = numpy.empty(bins_per_file, dtype=normalized_counts.dtype)
+    cell_type_rows["bin_number"] = rows["bin_number"][:bins_per_file]
+    cell_type_rows["cell_type"] = cell_type
+    cell_type_rows["chromosome"] = rows["chromosome"][:bins_per_file]
+    cell_type_rows["file_key"] = 0
+    cell_type_rows["count"] = summed_counts / len(file_keys)
+    cell_type_rows["percentile"] = -1
+    return cell_type_rows
+
 def create_summary_table(h5file):
     class Summary(tables.IsDescription):
         bin_number = tables.UInt32Col(                    pos=0)
@@ -303,75 +364,135 @@ def create_summary_table(h5file):
     return table
    
 
-def populate_summary(summary, normalized_counts, chromosome):
-    high = 95 # 95th percentile
-    low  = 5  # 5th percentile
-
-    summed_cell_type_percentiles_by_bin = collections.defaultdict(float) 
-    cell_types_gte_high_percentile_by_bin = collections.defaultdict(int)
-    cell_types_lt_high_percentile_by_bin = collections.defaultdict(int)
-    lines_gte_high_percentile_by_bin = collections.defaultdict(int)
-    lines_lt_high_percentile_by_bin = collections.defaultdict(int)
-    cell_types_gte_low_percentile_by_bin = collections.defaultdict(int)
-    cell_types_lt_low_percentile_by_bin = collections.defaultdict(int)
-    lines_gte_low_percentile_by_bin = collections.defaultdict(int)
-    lines_lt_low_percentile_by_bin = collections.defaultdict(int)
-    lines = set()
-    cell_types = set()
-    max_bin = 0
-
-    # note populating the dictionaries this way is much faster than looping through
-    # each bin and finding the matching fraction rows
-    for row in normalized_counts.where("chromosome == '%s'" % chromosome):
-        bin_number = row["bin_number"]
-        max_bin = max(max_bin, bin_number)
-        percentile = row["percentile"]
-
-        if row["file_key"] == 0:
-            cell_types.add(row["cell_type"])
-            summed_cell_type_percentiles_by_bin[bin_number] += percentile
-            if percentile >= high:
-                cell_types_gte_high_percentile_by_bin[bin_number] += 1
-            else:
-                cell_types_lt_high_percentile_by_bin[bin_number] += 1
-
-            if percentile >= low:
-                cell_types_gte_low_percentile_by_bin[bin_number] += 1
-            else:
-                cell_types_lt_low_percentile_by_bin[bin_number] += 1
-        else:
-            lines.add(row["file_key"])
-            if percentile >= high:
-                lines_gte_high_percentile_by_bin[bin_number] += 1
-            else:
-                lines_lt_high_percentile_by_bin[bin_number] += 1
+# number of rows in each of a summary's bins, counting only the rows meeting the condition if given
+def count_per_bin(bin_numbers, number_of_bins, condition = None):
+    return numpy.bincount(bin_numbers, weights=condition, minlength=number_of_bins).astype(numpy.uint32)
+
+# sets the cell type columns of summary_rows (one per bin) from all the cell type rows of the chromosome
+def summarize_cell_types(summary_rows, cell_type_rows):
+    number_of_bins = len(summary_rows)
+    bins = cell_type_rows["bin_number"]
+    percentiles = cell_type_rows["percentile"]
+    cell_types_per_bin = count_per_bin(bins, number_of_bins)
+
+    summed_percentiles = numpy.bincount(bins, weights=percentiles, minlength=number_of_bins)
+    number_of_cell_types = len(numpy.unique(cell_type_rows["cell_type"]))
+    summary_rows["avg_cell_type_percentile"] = summed_percentiles / number_of_cell_types
+
+    summary_rows["cell_types_gte_95th_percentile"] = count_per_bin(bins, number_of_bins, percentiles >= high_percentile)
+    summary_rows["cell_types_lt_95th_percentile"] = cell_types_per_bin - summary_rows["cell_types_gte_95th_percentile"]
+    summary_rows["cell_types_gte_5th_percentile"] = count_per_bin(bins, number_of_bins, percentiles >= low_percentile)
+    summary_rows["cell_types_lt_5th_percentile"] = cell_types_per_bin - summary_rows["cell_types_gte_5th_percentile"]
+
+# adds the bam file rows (lines) of the chromosome to the line columns of summary_rows
+def summarize_lines(summary_rows, line_rows):
+    number_of_bins = len(summary_rows)
+    bins = line_rows["bin_number"]
+    percentiles = line_rows["percentile"]
+    lines_per_bin = count_per_bin(bins, number_of_bins)
+
+    lines_gte_high = count_per_bin(bins, number_of_bins, percentiles >= high_percentile)
+    summary_rows["lines_gte_95th_percentile"] += lines_gte_high
+    summary_rows["lines_lt_95th_percentile"] += lines_per_bin - lines_gte_high
+    lines_gte_low = count_per_bin(bins, number_of_bins, percentiles >= low_percentile)
+    summary_rows["lines_gte_5th_percentile"] += lines_gte_low
+    summary_rows["lines_lt_5th_percentile"] += lines_per_bin - lines_gte_low
 
-            if percentile >= low:
-                lines_gte_low_percentile_by_bin[bin_number] += 1
-            else:
-                lines_lt_low_percentile_by_bin[bin_number] += 1
+def populate_summary(summary, normalized_counts, chromosome):
+    rows = normalized_counts.read_where("chromosome == '%s'" % chromosome)
+    if len(rows) == 0:
+        return
 
     logging.debug(" - populating summary table with calculated summaries")
 
-    for bin_number in xrange(max_bin+1):
-        summary.row["bin_number"] = bin_number
-        summary.row["chromosome"] = chromosome
-        summary.row["avg_cell_type_percentile"] = summed_cell_type_percentiles_by_bin[bin_number] / len(cell_types)
-        summary.row["cell_types_gte_95th_percentile"] = cell_types_gte_high_percentile_by_bin[bin_number]
-        summary.row["cell_types_lt_95th_percentile"] = cell_types_lt_high_percentile_by_bin[bin_number]
-        summary.row["lines_gte_95th_percentile"] = lines_gte_high_percentile_by_bin[bin_number]
-        summary.row["lines_lt_95th_percentile"] = lines_lt_high_percentile_by_bin[bin_number]
-        summary.row["cell_types_gte_5th_percentile"] = cell_types_gte_low_percentile_by_bin[bin_number]
-        summary.row["cell_types_lt_5th_percentile"] = cell_types_lt_low_percentile_by_bin[bin_number]
-        summary.row["lines_gte_5th_percentile"] = lines_gte_low_percentile_by_bin[bin_number]
-        summary.row["lines_lt_5th_percentile"] = lines_lt_low_percentile_by_bin[bin_number]
-        summary.row.append()
+    is_cell_type = rows["file_key"] == 0
+    summary_rows = numpy.zeros(rows["bin_number"].max() + 1, dtype=summary.dtype)
+    summary_rows["bin_number"] = numpy.arange(len(summary_rows))
+    summary_rows["chromosome"] = chromosome
+    summarize_cell_types(summary_rows, rows[is_cell_type])
+    summarize_lines(summary_rows, rows[~is_cell_type])
+    summary.append(summary_rows)
     summary.flush()
 
-def normalize_plot_and_summarize(counts_file, output_directory, bin_size, skip_plot):
+# updates the chromosome's summary rows in place for new cell type percentiles and the rows of newly
+# normalized bam files (new_line_rows), appending rows for any bins the chromosome didn't have before
+def update_summary(summary, normalized_counts, chromosome, new_line_rows):
+    coordinates = summary.get_where_list("chromosome == '%s'" % chromosome, sort=True)
+    prior_rows = summary.read_coordinates(coordinates)
+    cell_type_rows = normalized_counts.read_where("(file_key == 0) & (chromosome == '%s')" % chromosome)
+
+    number_of_bins = max([len(prior_rows)] + [rows["bin_number"].max() + 1
+                                               for rows in [cell_type_rows, new_line_rows] if len(rows) > 0])
+    summary_rows = numpy.zeros(number_of_bins, dtype=summary.dtype)
+    summary_rows[:len(prior_rows)] = prior_rows
+    summary_rows["bin_number"] = numpy.arange(number_of_bins)
+    summary_rows["chromosome"] = chromosome
+    summarize_cell_types(summary_rows, cell_type_rows)
+    summarize_lines(summary_rows, new_line_rows)
+
+    if len(coordinates) > 0:
+        summary.modify_coordinates(coordinates, summary_rows[:len(coordinates)])
+    if number_of_bins > len(coordinates):
+        summary.append(summary_rows[len(coordinates):])
+    summary.flush()
+
+def plot_all(output_directory, normalized_counts, chromosomes, cell_types):
+    if bp is None:
+        logging.error('Skipping plotting because plots require a compatible version of bokeh -- '
+                      'see https://github.com/BradnerLab/pipeline/wiki/bamliquidator#Install . %s'
+                      % bokeh_import_error)
+    else:
+        logging.info("Plotting")
+        for chromosome in chromosomes:
+            plot(output_directory, normalized_counts, chromosome, cell_types)
+        plot_summaries(output_directory, normalized_counts, chromosomes)
+
+def create_sorted_summary(summary):
+    # Iterating over this index in reverse order is hundreds of times slower than iterating
+    # in ascending order in my tests, but copying into a reverse sorted table is very fast.
+    # So we create a sorted summary table sorted in decreasing percentile order.  If we need to
+    # iterate in the reverse sorted order, than this sorted_summary table should be used.
+    # Otherwise, we should use the summary table (including the case of ascending percentile
+    # order, which is fast since the table is indexed by that column). See
+    # https://groups.google.com/d/topic/pytables-users/EKMUxghQiPQ/discussion
+    sorted_summary = summary.copy(newname="sorted_summary", sortby=summary.cols.avg_cell_type_percentile,
+                                  step=-1, checkCSI=True,
+                                  title="Summary table sorted in decreasing percentile order")
+    sorted_summary.cols.bin_number.create_csindex()
+
+# The normalized_counts attributes record the bin size and file keys of the bam files that the normalized
+# counts, percentiles and summaries were completed for, so bam files appended later can be normalized
+# incrementally.  Returns the set of file keys, or None if there is no complete normalization for bin_size.
+def normalized_file_keys(counts_file, bin_size):
+    for name in ["normalized_counts", "summary", "sorted_summary"]:
+        if not "/" + name in counts_file:
+            return None
+    attrs = counts_file.root.normalized_counts.attrs
+    if not "file_keys" in attrs or attrs.bin_size != bin_size:
+        return None
+    return set(attrs.file_keys.tolist())
+
+def mark_normalized(normalized_counts, bin_size, file_keys):
+    normalized_counts.attrs.bin_size = bin_size
+    normalized_counts.attrs.file_keys = numpy.array(sorted(file_keys), dtype=numpy.uint32)
+
+# leave off new_file_keys to normalize everything from scratch; otherwise, if the counts file was completely
+# normalized before the bam files with new_file_keys were appended to it, only those files are normalized
+# (see update_normalized_plot_and_summary)
+def normalize_plot_and_summarize(counts_file, output_directory, bin_size, skip_plot, new_file_keys = None):
+    all_file_keys = set(counts_file.root.files.col("key").tolist())
+    if new_file_keys is not None:
+        new_file_keys = set(new_file_keys)
+        prior_file_keys = normalized_file_keys(counts_file, bin_size)
+        if prior_file_keys is not None and prior_file_keys.isdisjoint(new_file_keys) \
+                and prior_file_keys | new_file_keys == all_file_keys:
+            update_normalized_plot_and_summary(counts_file, output_directory, bin_size, skip_plot, new_file_keys)
+            mark_normalized(counts_file.root.normalized_counts, bin_size, all_file_keys)
+            return
+
     delete_all_but_bin_counts_and_files_table(counts_file)
 
-    # recreating the entirity of the remaining tables is quick and easier than updating prior records correctly
+    # otherwise the remaining tables are recreated in their entirety
 
     counts = counts_file.root.bin_counts
     files = counts_file.root.files
@@ -388,7 +509,7 @@ def normalize_plot_and_summarize(counts_file, output_directory, bin_size, skip_p
         current_file_keys = file_keys(counts, cell_type)
         for file_key in current_file_keys:
            populate_normalized_counts(normalized_counts, counts, file_key, bin_size, files)
-           populate_percentiles(normalized_counts, cell_type, file_key)
+        populate_percentiles(normalized_counts, cell_type, None)
         populate_normalized_counts_for_cell_type(normalized_counts, cell_type, current_file_keys) 
         populate_percentiles(normalized_counts, cell_type)
 
@@ -399,32 +520,81 @@ def normalize_plot_and_summarize(counts_file, output_directory, bin_size, skip_p
     normalized_counts.cols.chromosome.create_csindex()
 
     if not skip_plot:
-        if bp is None:
-            logging.error('Skipping plotting because plots require a compatible version of bokeh -- '
-                          'see https://github.com/BradnerLab/pipeline/wiki/bamliquidator#Install . %s'
-                          % bokeh_import_error)
-        else:
-            logging.info("Plotting")
-            for chromosome in chromosomes:
-                plot(output_directory, normalized_counts, chromosome, cell_types)
-            plot_summaries(output_directory, normalized_counts, chromosomes)
+        plot_all(output_directory, normalized_counts, chromosomes, cell_types)
 
     logging.info("Summarizing")
     for chromosome in chromosomes:
         populate_summary(summary, normalized_counts, chromosome)
     summary.cols.avg_cell_type_percentile.create_csindex()
 
-    # Iterating over this index in reverse order is hundreds of times slower than iterating
-    # in ascending order in my tests, but copying into a reverse sorted table is very fast.
-    # So we create a sorted summary table sorted in decreasing percentile order.  If we need to
-    # iterate in the reverse sorted order, than this sorted_summary table should be used.
-    # Otherwise, we should use the summary table (including the case of ascending percentile
-    # order, which is fast since the table is indexed by that column). See
-    # https://groups.google.com/d/topic/pytables-users/EKMUxghQiPQ/discussion
-    sorted_summary = summary.copy(newname="sorted_summary", sortby=summary.cols.avg_cell_type_percentile,
-                                  step=-1, checkCSI=True,
-                                  title="Summary table sorted in decreasing percentile order")
-    sorted_summary.cols.bin_number.create_csindex()
+    create_sorted_summary(summary)
+    mark_normalized(normalized_counts, bin_size, all_file_keys)
+
+# Normalizes the bam files with new_file_keys, which were appended to an already normalized counts file.
+# Only the new files get normalized counts and percentiles, only the cell types of the new files get new
+# averages and percentiles, and the summary rows are updated in place.  Appending the new rows lets pytables
+# add them to the existing indexes, so only the percentile indexes (whose prior values change) are rebuilt.
+# The results match normalizing everything again, except the rows are in a different order (and sums can
+# differ in the last bit).
+def update_normalized_plot_and_summary(counts_file, output_directory, bin_size, skip_plot, new_file_keys):
+    counts = counts_file.root.bin_counts
+    files = counts_file.root.files
+    normalized_counts = counts_file.root.normalized_counts
+    summary = counts_file.root.summary
+
+    # the tables are only complete again once everything below is done
+    del normalized_counts.attrs.file_keys
+
+    logging.info("Normalizing %d appended bam files", len(new_file_keys))
+    first_new_row = normalized_counts.nrows
+    for file_key in sorted(new_file_keys):
+        populate_normalized_counts(normalized_counts, counts, file_key, bin_size, files)
+    new_rows = normalized_counts.read(start=first_new_row)
+    cell_types = numpy.unique(new_rows["cell_type"]).tolist()
+
+    logging.info("Updating cell types: %s", ", ".join(cell_types))
+    updated_cell_type_rows = []
+    for cell_type in cell_types:
+        rows = normalized_counts_for_cell_type(normalized_counts, cell_type, file_keys(counts, cell_type))
+        coordinates = normalized_counts.get_where_list("(file_key == 0) & (cell_type == '%s')" % cell_type,
+                                                       sort=True)
+        if len(coordinates) == 0:
+            normalized_counts.append(rows) # a new cell type
+        else:
+            assert len(coordinates) == len(rows)
+            updated_cell_type_rows.append((coordinates, rows))
+    normalized_counts.flush()
+
+    # with autoindex, each modification would reindex the whole percentile column, so it is reindexed once instead
+    normalized_counts.autoindex = False
+    if len(new_rows) > 0:
+        new_rows["percentile"] = grouped_percentiles(new_rows["file_key"], new_rows["count"])
+        normalized_counts.modify_column(start=first_new_row, stop=first_new_row + len(new_rows),
+                                        column=new_rows["percentile"], colname="percentile")
+    for coordinates, rows in updated_cell_type_rows:
+        modify_column_at(normalized_counts, coordinates, rows["count"], "count")
+    for cell_type in cell_types:
+        populate_percentiles(normalized_counts, cell_type)
+    normalized_counts.reindex_dirty()
+    normalized_counts.autoindex = True
+
+    chromosomes = all_chromosomes(summary)
+    chromosomes += [chromosome for chromosome in unique_in_order(new_rows["chromosome"])
+                    if not chromosome in chromosomes]
+
+    if not skip_plot:
+        plot_all(output_directory, normalized_counts, chromosomes,
+                 set(numpy.unique(normalized_counts.read_where("file_key == 0", field="cell_type")).tolist()))
+
+    logging.info("Summarizing")
+    summary.autoindex = False
+    for chromosome in chromosomes:
+        update_summary(summary, normalized_counts, chromosome, new_rows[new_rows["chromosome"] == chromosome])
+    summary.reindex_dirty()
+    summary.autoindex = True
+
+    delete_table(counts_file.root.sorted_summary)
+    create_sorted_summary(summary)
 
 def debugging_handler(signal, frame):
     import pdb
@@ -8,6 +8,7 @@ from itertools import izip
 import bamliquidator_batch as blb
 import normalize_plot_and_summarize as nps
 
+import numpy
 import os
 import shutil
 import subprocess
@@ -217,6 +218,51 @@ class SingleFullReadBamTest(TempDirTest):
                self.assertEqual('chr1(.):1-8', data_cols[1]) # todo: don't hardcode these values 
                self.assertEqual('1000000.0\n', data_cols[2])
 
+    def test_region_bin_liquidation(self):
+        regions_file_path = create_single_region_gff_file(self.dir_path, self.chromosome, 1, 41, strand='-')
+
+        liquidator = blb.RegionLiquidator(regions_file = regions_file_path,
+                                          output_directory = os.path.join(self.dir_path, 'output'),
+                                          bam_file_path = self.bam_file_path,
+                                          number_of_bins = 4)
+
+        with tables.open_file(liquidator.counts_file_path) as counts:
+            regions, bin_counts = blb.read_region_bin_counts(counts, 1)
+            self.assertEqual(1, len(regions))
+            self.assertEqual(1, len(bin_counts))
+            self.assertEqual([10, 10, 10, 10], bin_counts[0].tolist()) # 40 bp region split into 4 bins
+            self.assertEqual(40, regions[0]['count']) # count is the sum of the bins
+
+    def test_region_shorter_than_a_bin(self):
+        regions_file_path = create_single_region_gff_file(self.dir_path, self.chromosome, 1, 41, strand='-')
+
+        liquidator = blb.RegionLiquidator(regions_file = regions_file_path,
+                                          output_directory = os.path.join(self.dir_path, 'output'),
+                                          bam_file_path = self.bam_file_path,
+                                          region_bin_size = 50)
+
+        with tables.open_file(liquidator.counts_file_path) as counts:
+            regions, bin_counts = blb.read_region_bin_counts(counts, 1)
+            self.assertEqual(1, len(regions))
+            self.assertEqual([], bin_counts[0].tolist()) # no whole 50 bp bin fits in the region
+            self.assertEqual(40, regions[0]['count']) # but the region is still counted
+
+    def test_liquidate_region_bins(self):
+        gff = [[self.chromosome,       'region1', '', '1', '41', '', '-', '', 'region1'],
+               [self.chromosome + '0', 'region2', '', '1', '41', '', '-', '', 'region2'],
+               [self.chromosome,       'region3', '', '1', '41', '', '+', '', 'region3']]
+
+        # the only read is on the - strand
+        line_bins = blb.liquidate_region_bins(self.bam_file_path, gff, sense='+', region_bin_size=20)
+        self.assertEqual(3, len(line_bins))
+        self.assertEqual([20, 20], line_bins[0].tolist())
+        self.assertEqual(None, line_bins[1]) # no such chromosome
+        self.assertEqual([0, 0], line_bins[2].tolist())
+
+        line_bins = blb.liquidate_region_bins(self.bam_file_path, gff, sense='-', region_bin_size=20)
+        self.assertEqual([0, 0], line_bins[0].tolist())
+        self.assertEqual([20, 20], line_bins[2].tolist())
+
     def test_out_of_range_region(self):
         start = len(self.sequence) + 10
         stop = start + 10
@@ -488,9 +534,147 @@ class AppendingTest(TempDirTest):
         with tables.open_file(os.path.join(together_dir_path, 'counts.h5')) as together_h5:
             with tables.open_file(appending_h5_path) as appending_h5:
                 self.assertEqual(str(together_h5.root.bin_counts[:]), str(appending_h5.root.bin_counts[:]))
-                self.assertEqual(str(together_h5.root.normalized_counts[:]), str(appending_h5.root.normalized_counts[:]))
+                # the appended bam file is normalized incrementally, which appends its normalized counts after the
+                # rows of the prior files, so the rows are compared in sorted order
+                self.assertEqual(str(numpy.sort(together_h5.root.normalized_counts[:])),
+                                 str(numpy.sort(appending_h5.root.normalized_counts[:])))
                 self.assertEqual(str(together_h5.root.summary[:]), str(appending_h5.root.summary[:]))
                 self.assertEqual(str(together_h5.root.sorted_summary[:]), str(appending_h5.root.sorted_summary[:]))
+                self.assertEqual([1, 2], appending_h5.root.normalized_counts.attrs.file_keys.tolist())
+
+    def testParallelFiles(self):
+        # liquidating the bams two at a time gives the same counts.h5 as one at a time
+        bin_size = len(self.sequence1)
+        serial_dir = os.path.join(self.dir_path, 'serial')
+        blb.BinLiquidator(bin_size = bin_size, output_directory = serial_dir, bam_file_path = self.dir_path)
+        parallel_dir = os.path.join(self.dir_path, 'parallel')
+        liquidator = blb.BinLiquidator(bin_size = bin_size, output_directory = parallel_dir,
+                                       bam_file_path = self.dir_path, parallel_files = 2)
+
+        with tables.open_file(os.path.join(serial_dir, 'counts.h5')) as serial_h5:
+            with tables.open_file(os.path.join(parallel_dir, 'counts.h5')) as parallel_h5:
+                self.assertEqual(str(serial_h5.root.files[:]), str(parallel_h5.root.files[:]))
+                self.assertEqual(serial_h5.root.file_names[:], parallel_h5.root.file_names[:])
+                self.assertEqual(str(serial_h5.root.bin_counts[:]), str(parallel_h5.root.bin_counts[:]))
+                self.assertEqual(str(serial_h5.root.normalized_counts[:]), str(parallel_h5.root.normalized_counts[:]))
+                self.assertEqual(str(serial_h5.root.summary[:]), str(parallel_h5.root.summary[:]))
+        # no shards left behind, and each bam has its own timing
+        self.assertEqual([], [name for name in os.listdir(parallel_dir) if name.startswith('shards_')])
+        self.assertTrue('liquidation single1.bam' in liquidator.timings)
+        self.assertTrue('liquidation single2.bam' in liquidator.timings)
+
+        regions_file_path = create_single_region_gff_file(self.dir_path, self.chromosome, 1, len(self.sequence1))
+        serial = blb.RegionLiquidator(regions_file = regions_file_path, output_directory = os.path.join(serial_dir, 'regions'),
+                                      bam_file_path = self.dir_path, number_of_bins = 5)
+        parallel = blb.RegionLiquidator(regions_file = regions_file_path, output_directory = os.path.join(parallel_dir, 'regions'),
+                                        bam_file_path = self.dir_path, number_of_bins = 5, parallel_files = 2)
+        with tables.open_file(serial.counts_file_path) as serial_h5:
+            with tables.open_file(parallel.counts_file_path) as parallel_h5:
+                self.assertEqual(str(serial_h5.root.region_counts[:]), str(parallel_h5.root.region_counts[:]))
+                for file_key in [1, 2]:
+                    self.assertEqual(blb.read_region_bin_counts(serial_h5, file_key)[1][0].tolist(),
+                                     blb.read_region_bin_counts(parallel_h5, file_key)[1][0].tolist())
+
+# stands in for bamliquidator_regions, writing one region and its bins for the bam to the counts file it is
+# given; the first bam finishes last, so merging has to put the shards back in bam order
+fake_regions_executable = """#!%s
+import numpy
+import sys
+import tables
+import time
+
+bam_file_path, file_key, counts_file_path = sys.argv[5], int(sys.argv[6]), sys.argv[7]
+time.sleep(0.5 if file_key == 1 else 0)
+with tables.open_file(counts_file_path, mode = "r+") as counts_file:
+    row = counts_file.root.region_counts.row
+    row["file_key"] = file_key
+    row["chromosome"] = "chr1"
+    row["region_name"] = "region_%%d" %% file_key
+    row["start"] = 1
+    row["stop"] = 100
+    row["strand"] = "+"
+    row["count"] = 10 * file_key
+    row.append()
+    group = counts_file.create_group("/", "region_bin_counts")
+    bins = counts_file.create_array(group, "file_%%d" %% file_key, numpy.array([4.0, 6.0]) * file_key)
+    bins.attrs.bins = 2
+""" % sys.executable
+
+# batch_parallel and merge_shards only need pytables, so these use a fake executable and idxstats
+# instead of samtools and the bamliquidator executables
+class MergeShardsTest(TempDirTest):
+    def setUp(self):
+        super(MergeShardsTest, self).setUp()
+        self.bam_dir_path = os.path.join(self.dir_path, 'cell_type')
+        os.mkdir(self.bam_dir_path)
+        for bam_file_name in ['a.bam', 'b.bam']:
+            open(os.path.join(self.bam_dir_path, bam_file_name), 'w').close()
+        self.regions_file_path = create_single_region_gff_file(self.dir_path, 'chr1', 1, 100)
+
+        self.executable_path = os.path.join(self.dir_path, 'bamliquidator_regions')
+        with open(self.executable_path, 'w') as executable:
+            executable.write(fake_regions_executable)
+        os.chmod(self.executable_path, 0755)
+        self.original_executable_path = blb.executable_path
+        blb.executable_path = lambda executable: self.executable_path
+
+    def tearDown(self):
+        blb.executable_path = self.original_executable_path
+        super(MergeShardsTest, self).tearDown()
+
+    def idxstats(self, bam_file_path):
+        return [['chr1', '1000', '50' if os.path.basename(bam_file_path) == 'a.bam' else '150', '0']]
+
+    def check_counts_file(self, counts_file_path):
+        with tables.open_file(counts_file_path) as counts_file:
+            self.assertEqual([(1, 50), (2, 150)], [(row['key'], row['length']) for row in counts_file.root.files])
+            self.assertEqual(['*', 'a.bam', 'b.bam'], counts_file.root.file_names[:])
+            regions = counts_file.root.region_counts[:]
+            self.assertEqual([1, 2], regions['file_key'].tolist())
+            self.assertEqual(['region_1', 'region_2'], regions['region_name'].tolist())
+            self.assertEqual([10, 20], regions['count'].tolist())
+            for file_key in [1, 2]:
+                _, bin_counts = blb.read_region_bin_counts(counts_file, file_key)
+                self.assertEqual([[4.0 * file_key, 6.0 * file_key]], [bins.tolist() for bins in bin_counts])
+
+    def test_parallel_files(self):
+        liquidator = blb.RegionLiquidator(regions_file = self.regions_file_path,
+                                          output_directory = os.path.join(self.dir_path, 'output'),
+                                          bam_file_path = self.bam_dir_path, parallel_files = 2,
+                                          idxstats = self.idxstats)
+        self.check_counts_file(liquidator.counts_file_path)
+        self.assertEqual([], [name for name in os.listdir(liquidator.output_directory) if name.startswith('shards_')])
+        self.assertTrue('merging shards' in liquidator.timings)
+        with tables.open_file(liquidator.counts_file_path) as counts_file:
+            # normalized after merging: count / region size / millions of mapped reads
+            for expected, normalized_count in zip([10 / 99 / (50 / 10**6), 20 / 99 / (150 / 10**6)],
+                                                  counts_file.root.region_counts.col('normalized_count')):
+                self.assertAlmostEqual(expected, normalized_count)
+
+    def test_merge_shards(self):
+        liquidator = blb.RegionLiquidator.__new__(blb.RegionLiquidator)
+        liquidator.counts_file_path = os.path.join(self.dir_path, 'counts.h5')
+        liquidator.file_to_key = {'a.bam': 1, 'b.bam': 2}
+        with tables.open_file(liquidator.counts_file_path, mode = 'w') as counts_file:
+            liquidator.create_counts_table(counts_file)
+            files = blb.create_files_table(counts_file)
+            file_names = blb.create_file_names_array(counts_file)
+            for file_name, length in [('a.bam', 50), ('b.bam', 150)]:
+                files.row['key'] = liquidator.file_to_key[file_name]
+                files.row['length'] = length
+                files.row.append()
+                file_names.append(file_name)
+
+        shard_file_paths = []
+        for file_name in ['a.bam', 'b.bam']:
+            bam_file_path = os.path.join(self.bam_dir_path, file_name)
+            shard_file_path = liquidator.create_shard(self.dir_path, bam_file_path)
+            subprocess.check_call([self.executable_path, '0', self.regions_file_path, 'gff', '0', bam_file_path,
+                                   str(liquidator.file_to_key[file_name]), shard_file_path])
+            shard_file_paths.append(shard_file_path)
+        liquidator.merge_shards(shard_file_paths)
+
+        self.check_counts_file(liquidator.counts_file_path)
 
 class LiquidateBamInDifferentDirectories(unittest.TestCase):
     def setUp(self):
@@ -378,7 +378,7 @@ def mapMergedGFF(dataFile,nameDict,mergedGFFFile,analysisName,outputFolder,maskF
     mergedRegionMap = "%srose/%s_ROSE/%s_0KB_STITCHED_ENHANCER_REGION_MAP.txt" % (outputFolder,namesList[0],gffName)
     print("LOOKING FOR REGION MAP AT %s" % (mergedRegionMap))
 
-    if utils.checkOutput(mergedRegionMap,1,1):
+    if utils.checkOutput(mergedRegionMap,1,1,atomic=True):
         print("FOUND PREVIOUS REGION MAP")
 
         return mergedRegionMap
@@ -392,7 +392,7 @@ def mapMergedGFF(dataFile,nameDict,mergedGFFFile,analysisName,outputFolder,maskF
     print "Running enhancer mapping command:\n%s" % (bashCommand)
 
 
-    if utils.checkOutput(mergedRegionMap,5,60):
+    if utils.checkOutput(mergedRegionMap,5,60,atomic=True):
         return mergedRegionMap
     else:
         print "UNABLE TO CALL ROSE ENHANCER MAPPING ON CONSENSUS ENHANCER FILE %s.\nEXITING NOW" % (mergedGFFFile)
@@ -406,51 +406,42 @@ def makeEnhancerSignalTable(nameDict,mergedRegionMap,medianDict,analysisName,gen
     background corrected signal vs. median
     '''
 
-    #load in the region map
-    regionMap = utils.parseTable(mergedRegionMap,'\t')
     namesList = nameDict.keys()
     namesList.sort()
     signalTable = [['REGION_ID','CHROM','START','STOP','NUM_LOCI','CONSTITUENT_SIZE'] + namesList]
 
     print("len of %s for namesList" % (len(namesList)))
     print(namesList)
-    for line in regionMap[1:]:
 
-        newLine = line[0:6]
-        
-        
-        #a little tricky here to add datasets sequentially
-        i = 6 #start w/ the first column w/ data
-        for name in namesList:
-            
-            if nameDict[name]['background'] == True:
-                enhancerIndex = int(i)
-                i +=1
-                controlIndex = int(i)
-                i +=1
-                try:
-                    enhancerSignal = float(line[enhancerIndex]) - float(line[controlIndex])
-                except IndexError:
-                    print line
-                    print len(line)
-                    print enhancerIndex
-                    print controlIndex
-                    sys.exit()
-                
-            else:
-                enhancerIndex = int(i)
-                i+=1
-                enhancerSignal = float(line[enhancerIndex])
-
-            if enhancerSignal < 0:
-                enhancerSignal = 0
-            enhancerSignal = enhancerSignal/medianDict[name]
-            newLine.append(enhancerSignal)
-                
-            
+    #a little tricky here to add datasets sequentially
+    #each dataset has a signal column, followed by a control column if it has a background
+    signalColumns = []
+    i = 6 #start w/ the first column w/ data
+    for name in namesList:
+        if nameDict[name]['background'] == True:
+            signalColumns.append((i,i+1))
+            i +=2
+        else:
+            signalColumns.append((i,None))
+            i +=1
+
+    #load in the region map
+    try:
+        regionColumns = utils.loadColumns(mergedRegionMap,range(i),[str]*6 + [float]*(i-6),header=True)
+    except ValueError:
+        print "REGION MAP %s HAS MISSING OR NON NUMERIC SIGNAL IN COLUMNS 7-%s" % (mergedRegionMap,i)
+        sys.exit()
 
+    normSignals = []
+    for name,(enhancerIndex,controlIndex) in zip(namesList,signalColumns):
+        enhancerSignal = regionColumns[enhancerIndex]
+        if controlIndex is not None:
+            enhancerSignal = enhancerSignal - regionColumns[controlIndex]
+        enhancerSignal = numpy.maximum(enhancerSignal,0)/medianDict[name]
+        normSignals.append(enhancerSignal.tolist())
 
-        signalTable.append(newLine)
+    for newLine in zip(*[column.tolist() for column in regionColumns[0:6]] + normSignals):
+        signalTable.append(list(newLine))
 
     outputFile = "%s%s_%s_signalTable.txt" % (outputFolder,genome,analysisName)
     print "WRITING MEDIAN NORMALIZED SIGNAL TABLE TO %s" % (outputFile)
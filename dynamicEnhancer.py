@@ -406,6 +406,24 @@ def callRoseGeneMapper(mergedGFFFile,genome,parentFolder,name1):
     
 
 
+def getBestOverlapRank(lociList,enhancerCollection,enhancerDict):
+
+    '''
+    for each locus gets the best (lowest) rank of the enhancers overlapping it
+    loci w/o an overlapping enhancer get the size of the collection
+    '''
+
+    enhancerLoci = enhancerCollection.getLoci()
+    enhancerRanks = [enhancerDict[x.ID()]['rank'] for x in enhancerLoci]
+
+    bestRanks = [None]*len(lociList)
+    for i,j in zip(*utils.overlapJoin(lociList,enhancerLoci,sense='both')):
+        if bestRanks[i] is None or enhancerRanks[j] < bestRanks[i]:
+            bestRanks[i] = enhancerRanks[j]
+
+    return [len(enhancerCollection) if rank is None else rank for rank in bestRanks]
+
+
 def assignEnhancerRank(enhancerToGeneFile,enhancerFile1,enhancerFile2,name1,name2,rankOutput=''):
 
     '''
@@ -424,32 +442,15 @@ def assignEnhancerRank(enhancerToGeneFile,enhancerFile1,enhancerFile2,name1,name
     #we're going to update the enhancerToGeneTable
 
     enhancerToGene[0] += ['%s_rank' % name1,'%s_rank' % name2]
-    
-    for i in range(1,len(enhancerToGene)):
 
-        line = enhancerToGene[i]
-        
-        locusLine = utils.Locus(line[1],line[2],line[3],'.',line[0])
-        
-        #if the enhancer doesn't exist, its ranking is dead last on the enhancer list
+    lineLoci = [utils.Locus(line[1],line[2],line[3],'.',line[0]) for line in enhancerToGene[1:]]
 
-        enhancer1Overlap = enhancerCollection1.getOverlap(locusLine,'both')
-        if len(enhancer1Overlap) == 0:
-            enhancer1Rank = len(enhancerCollection1)
-        else:
-            
-            rankList1 = [enhancerDict1[x.ID()]['rank'] for x in enhancer1Overlap]
-            enhancer1Rank = min(rankList1)
+    #if the enhancer doesn't exist, its ranking is dead last on the enhancer list
+    enhancer1Ranks = getBestOverlapRank(lineLoci,enhancerCollection1,enhancerDict1)
+    enhancer2Ranks = getBestOverlapRank(lineLoci,enhancerCollection2,enhancerDict2)
 
-
-        enhancer2Overlap = enhancerCollection2.getOverlap(locusLine,'both')
-        if len(enhancer2Overlap) == 0:
-            enhancer2Rank = len(enhancerCollection2)
-        else:
-            
-            rankList2 = [enhancerDict2[x.ID()]['rank'] for x in enhancer2Overlap]
-            enhancer2Rank = min(rankList2)
-        enhancerToGene[i]+=[enhancer1Rank,enhancer2Rank]
+    for i in range(1,len(enhancerToGene)):
+        enhancerToGene[i]+=[enhancer1Ranks[i-1],enhancer2Ranks[i-1]]
 
 
     if len(rankOutput) == 0:
@@ -776,7 +777,7 @@ def main():
 
         gffName = '%s_%s_MERGED_REGIONS_-0_+0' % (string.upper(genome),mergeName)
         enhancerToGeneFile = "%s%s_ROSE/%s_0KB_STITCHED_ENHANCER_DELTA_ENHANCER_TO_GENE_100KB.txt" % (parentFolder,name1,gffName)
-        if utils.checkOutput(enhancerToGeneFile):
+        if utils.checkOutput(enhancerToGeneFile,atomic=True):
             rankOutput = "%s%s_ROSE/%s_0KB_STITCHED_ENHANCER_DELTA_ENHANCER_TO_GENE_100KB_RANK.txt" % (parentFolder,name1,gffName)
             assignEnhancerRank(enhancerToGeneFile,allFile1,allFile2,name1,name2,rankOutput)
         else:
@@ -785,7 +786,7 @@ def main():
 
         #make the rank plot
         print('MAKING RANK PLOTS')
-        if utils.checkOutput(rankOutput):
+        if utils.checkOutput(rankOutput,atomic=True):
             rcmd = callRankRScript(rankOutput,name1,name2,superFile1,superFile2)
             print(rcmd)
             os.system(rcmd)
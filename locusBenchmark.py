@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+BENCHMARKS MEMORY AND THROUGHPUT OF utils.Locus ON A GENOME WIDE TRANSCRIPT COLLECTION
+COMPARES THE CURRENT SLOTTED LOCUS WITH THE OLD __dict__ BACKED, start+end HASHED ONE
+'''
+
+import sys
+import time
+
+import utils
+
+
+#==================================================================
+#=====================HELPER FUNCTIONS=============================
+#==================================================================
+
+class DictLocus:
+    '''
+    the Locus layout before __slots__: an old style instance with a __dict__
+    and a hash of start + end
+    '''
+    def __init__(self, chr, start, end, sense, ID='', score=0):
+        coords = sorted([int(start), int(end)])
+        self._chr = chr
+        self._sense = sense
+        self._start = coords[0]
+        self._end = coords[1]
+        self._ID = ID
+        self._score = score
+
+    def __hash__(self): return self._start + self._end
+
+    def __eq__(self, other):
+        return (self._chr, self._start, self._end, self._sense) == (other._chr, other._start, other._end, other._sense)
+
+
+def bytesPerLocus(loci):
+    '''
+    average size of the instances themselves, their __dict__ if they have one,
+    and the int coordinates.  strings are shared or interned so aren't counted
+    '''
+    total = 0
+    for locus in loci:
+        total += sys.getsizeof(locus) + sys.getsizeof(locus._start) + sys.getsizeof(locus._end)
+        if hasattr(locus, '__dict__'):
+            total += sys.getsizeof(locus.__dict__)
+    return float(total) / len(loci)
+
+
+def benchmarkLoci(name, loci):
+    '''
+    prints bytes per locus, hash collisions and dict build/lookup time
+    '''
+    hashCount = len(set([hash(locus) for locus in loci]))
+
+    startTime = time.time()
+    lociDict = dict()
+    for locus in loci:
+        lociDict[locus] = None
+    for locus in loci:
+        lociDict[locus]
+    dictTime = time.time() - startTime
+
+    print('%s:' % (name))
+    print('\tBYTES PER LOCUS: %.1f' % (bytesPerLocus(loci)))
+    print('\tDISTINCT HASHES: %s OF %s LOCI' % (hashCount, len(loci)))
+    print('\tDICT INSERT + LOOKUP: %.3f SECONDS' % (dictTime))
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    from optparse import OptionParser
+    usage = "usage: %prog [options] -a [UCSC_REFSEQ_ANNOTATION_FILE]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-a", "--annot", dest="annot", nargs=1, default='annotation/danRer7_refseq.ucsc',
+                      help="Enter a UCSC refseq annotation file")
+
+    (options, args) = parser.parse_args()
+
+    print('LOADING TRANSCRIPT COLLECTION FROM %s' % (options.annot))
+    startTime = time.time()
+    transCollection = utils.makeTranscriptCollection(options.annot, 0, 0, 500)
+    print('LOADED %s TRANSCRIPTS IN %.3f SECONDS' % (len(transCollection), time.time() - startTime))
+
+    loci = transCollection.getLoci()
+    dictLoci = [DictLocus(locus.chr(), locus.start(), locus.end(), locus.sense(), locus.ID()) for locus in loci]
+
+    benchmarkLoci('DICT LOCUS (BEFORE)', dictLoci)
+    benchmarkLoci('SLOTTED LOCUS (AFTER)', loci)
+
+
+if __name__ == "__main__":
+    main()
@@ -175,6 +175,7 @@ from collections import defaultdict
 
 #MAPPING BAMS TO GFFS
 #def mapBams(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =False,nameList = []):
+#def mapBamsCube(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =False,rpm=True,nameList = []):
 #def mapBamsQsub(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =False,nameList = []):
 #def mapBamsBatch(dataFile,gffList,mappedFolder,overWrite =False,namesList = [],extension=200)
 
@@ -1736,9 +1737,15 @@ def makePromoterGFF(dataFile,annotFile,promoterFactor,enrichedFolder,gffFolder,w
     promoterGFF = []
     promoterLoci = enrichedCollection.getLoci()
 
-    for locus in promoterLoci:
+    #finds all promoter/TSS overlaps in one pass
+    tssLoci = tssCollection.getLoci()
+    promoterToTSS = defaultdict(list)
+    for i,j in zip(*overlapJoin(promoterLoci,tssLoci,sense='both')):
+        promoterToTSS[i].append(tssLoci[j])
 
-        overlappingTSSLoci = tssCollection.getOverlap(locus,'both')
+    for i,locus in enumerate(promoterLoci):
+
+        overlappingTSSLoci = promoterToTSS[i]
         if len(overlappingTSSLoci) == 0:
             continue
         else:
@@ -1847,8 +1854,9 @@ def mapEnrichedToGFF(dataFile,setName,gffList,cellTypeList,enrichedFolder,mapped
                 enrichedCollection = importBoundRegion(enrichedFolder + dataDict[name]['enrichedMacs'],name)
             else:
                 enrichedCollection = importBoundRegion(enrichedFolder + dataDict[name]['enriched'],name)
+            enrichedOverlaps = overlapSum(gffLoci,enrichedCollection,sense='both')
             for i in range(len(gffLoci)):
-                if len(enrichedCollection.getOverlap(gffLoci[i],'both')) > 0:
+                if enrichedOverlaps[i] > 0:
                     mappedGFF[i+1].append(1)
                 else:
                     mappedGFF[i+1].append(0)
@@ -1943,6 +1951,40 @@ def mapBams(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =Fal
 
 
 
+def mapBamsCube(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =False,rpm=True,nameList = []):
+
+    '''
+    like mapBams, but maps all of the data to each gff w/ one bamToGFF_turbo call
+    that writes a single regions x bins x datasets signal cube to mappedFolder/gffName/gffName.npz
+    makeSignalTable reads the cube when it's there. load it w/ utils.loadSignalCube
+    '''
+
+    dataDict = loadDataTable(dataFile)
+    if mappedFolder[-1] != '/':
+        mappedFolder+='/'
+    formatFolder(mappedFolder,True)
+
+    if len(nameList) == 0:
+        nameList = dataDict.keys()
+    nameList = [name for name in nameList if cellTypeList.count(name.split('_')[0]) == 1]
+
+    for gffFile in gffList:
+        gffName = gffFile.split('/')[-1].split('.')[0]
+        outdir = formatFolder(mappedFolder+gffName,True)
+        outFile = outdir+gffName+'.npz'
+        if not overWrite and os.path.isfile(outFile):
+            print('File %s Already Exists, not mapping' % (outFile))
+            continue
+
+        bamString = join([dataDict[name]['bam'] for name in nameList],',')
+        cmd1 = "python /ark/home/cl512/pipeline/bamToGFF_turbo.py -e 200 -m %s -b %s -n %s -i %s -o %s" % (nBin,bamString,join(nameList,','),gffFile,outFile)
+        if rpm:
+            cmd1 += ' -r'
+        cmd1 += ' &'
+        print cmd1
+        os.system(cmd1)
+
+
 
 def mapBamsQsub(dataFile,cellTypeList,gffList,mappedFolder,nBin = 200,overWrite =False,nameList = []):
     
@@ -2158,8 +2200,25 @@ def makeSignalTable(dataFile,gffFile,mappedFolder,namesList = [],medianNorm=Fals
 
     #now start filling in the signal dict
     gffName = gffFile.split('/')[-1].split('.')[0]
-    
-    for name in namesList:
+
+    #a signal cube from mapBamsCube has every dataset in one file
+    cubeFile = '%s%s/%s.npz' % (mappedFolder,gffName,gffName)
+    mappedNames = namesList
+    if os.path.isfile(cubeFile):
+        locusIDs,locusLines,cubeNames,signal = loadSignalCube(cubeFile)
+        if len([name for name in namesList if cubeNames.tolist().count(name) == 0]) == 0:
+            print('USING SIGNAL CUBE %s' % (cubeFile))
+            locusIDs,locusLines,cubeNames,signal = loadSignalCube(cubeFile,namesList)
+            for i,name in enumerate(namesList):
+                signals = signal[:,0,i]
+                if medianNorm == True:
+                    medianSignal = numpy.median(signals)
+                else:
+                    medianSignal = 1
+                signalDict[name].update(zip(locusIDs.tolist(),(signals/medianSignal).tolist()))
+            mappedNames = []
+
+    for name in mappedNames:
 
         print("MAKING SIGNAL DICT FOR %s" % (name))
         
@@ -2177,24 +2236,21 @@ def makeSignalTable(dataFile,gffFile,mappedFolder,namesList = [],medianNorm=Fals
             print('ERROR NO MAPPED FILE FOUND FOR %s' % (name))
             sys.exit()
             
-        mappedTable = parseTable(mappedFile,'\t')
+        locusIDs,locusLines,signals = loadColumns(mappedFile,[0,1,2],[str,str,float],header=True)
         if medianNorm == True:
-            medianSignal = numpy.median([float(line[2]) for line in mappedTable[1:]])
+            medianSignal = numpy.median(signals)
         else:
             medianSignal = 1
-        
-        for line in mappedTable[1:]:
 
-            signalDict[name][line[0]] = float(line[2])/medianSignal
+        signalDict[name].update(zip(locusIDs.tolist(),(signals/medianSignal).tolist()))
 
     #now make the signal table
     signalTable = []
     header = ['GENE_ID','locusLine'] + namesList
     signalTable.append(header)
 
-    for line in mappedTable[1:]:
-        locusID = line[0]
-        sigLine = line[0:2] + [signalDict[name][locusID] for name in namesList]
+    for locusID,locusLine in zip(locusIDs.tolist(),locusLines.tolist()):
+        sigLine = [locusID,locusLine] + [signalDict[name][locusID] for name in namesList]
         signalTable.append(sigLine)
 
     if len(output) == 0:
@@ -103,21 +103,18 @@ def makeFoldTable(annotFile,analysisName,testName,controlName,testMMR,controlMMR
 
     guideDict,geneDict = makeAnnotDict(annotFile)
 
-    testIdx = utils.parseTable(testIdxFile,'\t')
-    controlIdx = utils.parseTable(controlIdxFile,'\t')
+    testGuides,testCounts = utils.loadColumns(testIdxFile,[0,2],[str,float])
+    controlCounts = utils.loadColumns(controlIdxFile,[2],float)[0]
 
     #for each guide, divide the count by the MMR then add 1 then take the log2 ratio
+    testCounts = testCounts/testMMR + epsilon
+    controlCounts = controlCounts/controlMMR + epsilon
+    log2Ratios = numpy.log2(testCounts/controlCounts)
 
     outTable = [['GUIDE_ID','GENE','LOG2_RATIO',testName,controlName]]
-    for i in range(len(testIdx)):
+    for guideID,log2Ratio,testCount,controlCount in zip(testGuides.tolist(),log2Ratios,testCounts.tolist(),controlCounts.tolist()):
 
-        guideID = testIdx[i][0]
         gene = guideDict[guideID]
-        
-        testCount = float(testIdx[i][2])/testMMR + epsilon
-        controlCount = float(controlIdx[i][2])/controlMMR + epsilon
-
-        log2Ratio = numpy.log2(testCount/controlCount)
 
         newLine = [guideID,gene,log2Ratio,round(testCount,4),round(controlCount,4)]
 
@@ -303,18 +300,16 @@ def main():
         print("Test dataset: %s has an MMR of %s" % (testName,testMMR))
         print("Control dataset: %s has an MMR of %s" % (controlName,controlMMR))
 
-        #now get the idxstats output
+        #now write out the idxstats from the cached bam stats
         testIdxFile = '%s%s_idxstats.txt' % (outputFolder,testName)
-        testIdxCmd = '%s idxstats %s > %s' % (samtoolsString,options.test,testIdxFile)
-        print("Test idxstats command:")
-        print(testIdxCmd)
-        os.system(testIdxCmd)
+        testStats = utils.getBamStats(options.test)
+        print("Writing test idxstats to %s" % (testIdxFile))
+        utils.writeTable(testStats['chroms'] + [['*',0,0,testStats['unplaced']]],testIdxFile,'\t')
 
         controlIdxFile = '%s%s_idxstats.txt' % (outputFolder,controlName)
-        controlIdxCmd = '%s idxstats %s > %s' % (samtoolsString,options.control,controlIdxFile)
-        print("Control idxstats command:")
-        print(controlIdxCmd)
-        os.system(controlIdxCmd)
+        controlStats = utils.getBamStats(options.control)
+        print("Writing control idxstats to %s" % (controlIdxFile))
+        utils.writeTable(controlStats['chroms'] + [['*',0,0,controlStats['unplaced']]],controlIdxFile,'\t')
 
         print("Checking for output")
         if not utils.checkOutput(testIdxFile,0.1,5):
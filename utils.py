@@ -45,6 +45,16 @@ import time
 import re
 import sys
 import math
+import numpy
+import hashlib
+import tempfile
+import itertools
+import struct
+import zlib
+import json
+import sqlite3
+import atexit
+import bisect
 
 # Very pretty error reporting, where available
 try:
@@ -59,6 +69,8 @@ import subprocess
 import datetime
 
 from collections import defaultdict
+from distutils.spawn import find_executable
+from UserDict import DictMixin
 
 #==================================================================
 #======================TABLE OF CONTENTS===========================
@@ -66,15 +78,24 @@ from collections import defaultdict
 
 #1. Input/Output and file handling functions
 
-#def open(file,mode='r'):  <- replaces open with a version that can handle gzipped files
+#def open(file,mode='r'):  <- replaces open with a version that can handle gzipped (.gz or BGZF .bgz) files
 #def parseTable(fn, sep, header = False,excel = False): <- opens standard delimited files
+#def iterTable(fn,sep='\t',header=False,comment=None,chunkSize=0): <- streams the rows of a delimited file, optionally in chunks
+#def loadColumns(fn,columns,types=str,sep='\t',header=False,comment=None,fillValue=None,chunkSize=100000): <- loads selected columns of a delimited file into typed numpy arrays
 #def unParseTable(table, output, sep): <- writes standard delimited files, opposite of parseTable
+#def writeTable(table,output,sep='\t',compress=None,blockSize=10000): <- buffered, atomic and optionally gzip/BGZF compressed unParseTable
+#def writeColumns(columns,output,sep='\t',header=[],compress=None,blockSize=10000): <- writeTable for a list of (numpy) columns
+#def matrixRowsToArray(rows,nBins=None): <- bin values of matrix/clustergram rows as a float array
+#def writeSignalCube(output,regionIDs,locusLines,samples,signal): <- writes a regions x bins x samples signal cube to an .npz
+#def loadSignalCube(cubeFile,samples=None): <- loads a signal cube, optionally just some of its samples
+#def writeSignalMatrix(output,header,regionIDs,locusLines,signal,compress=None): <- writes a signal cube as one wide table
 #def formatBed(bed,output=''):
 #def bedToGFF(bed,output=''):
 #def gffToBed(gff,output= ''): <- converts standard UCSC gff format files to UCSC bed format files
 #def formatFolder(folderName,create=False): <- checks for the presence of any folder and makes it if create =True
 
 #2. Gene annotation functions
+#def getAnnotationStore(annotFile,useCache=True): <- cached columnar store of a refseq annotation file shared by the functions below
 #def makeStartDict(annotFile,geneList = []): <- takes a standard UCSC refseq table and creates a dictionary keyed by refseq ID with info about each transcript
 #def getTSSs(geneList,refseqTable,refseqDict): <- returns the TSS location of any gene
 #def importRefseq(refseqFile, returnMultiples = False): <- imports a standard UCSC refseq annotation file into a dictionary
@@ -84,8 +105,15 @@ from collections import defaultdict
 
 #3. Locus class
 #class Locus(chr,start,end,sense,ID) <- standard locus class for tracking genomic loci
+#class IntervalIndex(starts,ends) <- nested containment list for finding the intervals that overlap a query
 #class LocusCollection(lociList,windowSize=500) <- a collection of locus objects used for querying large sets of loci
 
+#3b. LocusTable class
+#class LocusTable(chromList,rows) <- columnar numpy backed set of loci with fast gff/bed/enhancer table loaders
+
+#3c. TSSIndex class
+#class TSSIndex(tssLoci) <- per chromosome sorted tss positions for k nearest and within distance lookups
+
 #4. Gene class
 #class Gene(name,chr,sense,txCoords,cdCoords,exStarts,exEnds,commonName=''): <- gene class object that contains all annotation information about a given transcript
 
@@ -95,10 +123,24 @@ from collections import defaultdict
 #def makeTSSLocus(gene,startDict,upstream,downstream): <- from a start dict makes a locus surrounding the tss
 #def makeSearchLocus(locus,upSearch,downSearch): <- takes an existing locus and makes a larger flanking locus
 #def makeSECollection(enhancerFile,name,top=0):
+#def stitchStats(locusCollection,stitchWindows): <- region/constituent size stats for a whole range of stitching windows in one pass
+#def overlapJoin(queryLoci,targetLoci,mode='overlap',sense='sense'): <- all overlapping query/target index pairs, found w/ an IntervalIndex
+#def overlapSum(queryLoci,targetLoci,values=None,mode='overlap',sense='sense'): <- per query counts or sums over overlapping targets
 
 
 #6. Bam class
-#class Bam(bamFile) <- a class for handling and manipulating bam objects.  requires samtools
+#class Bam(bamFile,backend=None) <- a class for handling and manipulating bam objects.  reads w/ pysam, the bam index or samtools
+#def openBamReader(bamFile,backend=None): <- opens a pysam, native BGZF/BAI or samtools reader for a bam
+#def getBamStats(bamFile,useCache=True): <- cached mapped/total reads and idxstats for a bam
+#def getBamIdxStats(bamFile): <- cached idxstats rows for a bam, e.g. for bamliquidator_batch's idxstats argument
+#def markPositionDuplicates(reads): <- flags reads w/ the same 5' position, strand and mate position as an earlier read
+#def getUniqueReadCount(bamFile,useCache=True): <- cached count of mapped reads after collapsing duplicates by position
+#def intervalCoverage(starts,ends,regionStart,regionEnd): <- per base coverage of a region by a set of intervals
+#def cigarBlocks(cigars,positions,lengths): <- the aligned blocks of many reads, split at their junctions
+#def findBamliquidator(executable): <- path of a bamliquidator executable, or None
+#class LiquidatorWorker(bamFile,executable=None) <- long lived bamliquidator_worker process that liquidates regions of a bam
+#class LiquidatorPool(executable=None) <- one LiquidatorWorker per bam, started as they're needed
+#def getLiquidatorPool(): <- the module's shared LiquidatorPool, closed at exit
 
 #7. Misc. functions
 #def uniquify(seq, idfun=None):  <- makes a list unique
@@ -118,7 +160,7 @@ from collections import defaultdict
 # TODO: Overriding internal functions is evil!
 bopen=open
 def open(fileName,mode='r'):
-    if fileName.split('.')[-1] == 'gz':
+    if ['gz','bgz'].count(fileName.split('.')[-1]) == 1:
         return gzip.open(fileName, mode + 'b')
     else:
         return bopen(fileName, mode)
@@ -144,21 +186,339 @@ def parseTable(fn, sep, header = False,excel = False):
 
 
 
+def isHeaderRow(firstRow,secondRow):
+    '''
+    guesses whether firstRow is a header: true if some field is numeric in
+    secondRow but not in firstRow
+    '''
+    def isNumber(field):
+        try:
+            float(field)
+            return True
+        except ValueError:
+            return False
+    for first,second in zip(firstRow,secondRow):
+        if isNumber(second) and not isNumber(first):
+            return True
+    return False
+
+
+#iterTable
+#streaming version of parseTable. rows are split the same way, but only one
+#line (or one chunk of lines) is held in memory at a time
+#example call:
+#for line in iterTable('file.txt','\t',header=True):
+def iterTable(fn,sep='\t',header=False,comment=None,chunkSize=0):
+    '''
+    yields each row of a delimited file as a list of strings. gzipped files are read transparently
+    header=True skips the first row, header='auto' skips it only if isHeaderRow thinks it's a header
+    lines starting w/ comment are skipped. w/ chunkSize > 0 yields lists of up to chunkSize rows
+    '''
+    fh = open(fn)
+    try:
+        rows = (line.rstrip().split(sep) for line in fh if comment is None or not line.startswith(comment))
+        if header == 'auto':
+            firstRows = list(itertools.islice(rows,2))
+            if len(firstRows) == 2 and isHeaderRow(firstRows[0],firstRows[1]):
+                firstRows = firstRows[1:]
+            rows = itertools.chain(firstRows,rows)
+        elif header:
+            next(rows,None)
+
+        if chunkSize > 0:
+            while True:
+                chunk = list(itertools.islice(rows,chunkSize))
+                if len(chunk) == 0:
+                    break
+                yield chunk
+        else:
+            for row in rows:
+                yield row
+    finally:
+        fh.close()
+
+
+def columnToArray(values,colType,fillValue=None):
+    '''
+    converts a list of strings to a numpy array of colType
+    values that don't convert become fillValue, or raise a ValueError if fillValue is None
+    '''
+    try:
+        return numpy.array(values,dtype=colType)
+    except ValueError:
+        if fillValue is None: raise
+    column = numpy.empty(len(values),dtype=colType)
+    for i,value in enumerate(values):
+        try:
+            column[i] = value
+        except ValueError:
+            column[i] = fillValue
+    return column
+
+
+#loadColumns
+#loads just the requested columns of a table into typed numpy arrays, a chunk
+#of lines at a time
+#example call:
+#ids,signal = loadColumns('matrix.txt',[0,2],[str,float],header=True)
+def loadColumns(fn,columns,types=str,sep='\t',header=False,comment=None,fillValue=None,chunkSize=100000):
+    '''
+    returns one numpy array per requested column. columns are column indices, or header names
+    if the file has a header. types is one type for every column or a list w/ a type per column
+    header, comment and fillValue work as in iterTable and columnToArray
+    '''
+    if not isinstance(types,(list,tuple)):
+        types = [types]*len(columns)
+
+    rows = iterTable(fn,sep,False,comment)
+    firstRows = list(itertools.islice(rows,2))
+    if header == 'auto':
+        header = len(firstRows) == 2 and isHeaderRow(firstRows[0],firstRows[1])
+    headerRow = []
+    if header and len(firstRows) > 0:
+        headerRow = firstRows.pop(0)
+    colIndices = [headerRow.index(col) if isinstance(col,str) else col for col in columns]
+    rows = itertools.chain(firstRows,rows)
+
+    colChunks = [[numpy.array([],dtype=colType)] for colType in types]
+    while True:
+        chunk = list(itertools.islice(rows,chunkSize))
+        if len(chunk) == 0:
+            break
+        for i,colType,colChunk in zip(colIndices,types,colChunks):
+            #rows are rstripped like parseTable, so empty trailing fields can be missing
+            colChunk.append(columnToArray([row[i] if i < len(row) else '' for row in chunk],colType,fillValue))
+    return [numpy.concatenate(colChunk) for colChunk in colChunks]
+
+
+
+#BgzfWriter
+#BGZF is a series of gzip members w/ at most 64kb of data each, so it reads
+#like any gzip file but can also be block indexed by tabix/samtools
+class BgzfWriter(object):
+    '''
+    writes BGZF compressed data to an open binary file handle
+    '''
+    maxBlockSize = 65280
+    eofBlock = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    def __init__(self,fh,compressLevel=6):
+        self._fh = fh
+        self._compressLevel = compressLevel
+        self._buffer = ''
+
+    def __writeBlock(self,block):
+        compressor = zlib.compressobj(self._compressLevel,zlib.DEFLATED,-15)
+        data = compressor.compress(block) + compressor.flush()
+        #the BC extra field holds the total block size - 1
+        self._fh.write(struct.pack('<BBBBIBBHBBHH',31,139,8,4,0,0,255,6,66,67,2,len(data) + 25))
+        self._fh.write(data)
+        self._fh.write(struct.pack('<II',zlib.crc32(block) & 0xffffffff,len(block)))
+
+    def write(self,data):
+        data = self._buffer + data
+        fullBlocks = len(data)/self.maxBlockSize
+        for i in range(fullBlocks):
+            self.__writeBlock(data[i*self.maxBlockSize:(i+1)*self.maxBlockSize])
+        self._buffer = data[fullBlocks*self.maxBlockSize:]
+
+    def tell(self):
+        '''
+        the virtual offset the next write starts at, as stored in bam/tabix indexes
+        '''
+        return (self._fh.tell() << 16) | len(self._buffer)
+
+    def close(self):
+        if len(self._buffer) > 0:
+            self.__writeBlock(self._buffer)
+            self._buffer = ''
+        self._fh.write(self.eofBlock)
+
+
+#AtomicWriter
+#writes to a temp file next to the output and only renames it over the output
+#once everything is written, so a file under its final name is always complete
+class AtomicWriter(object):
+    '''
+    file-like writer for output. compress can be 'none', 'gzip' or 'bgzf'
+    by default output ending in .gz is gzipped and output ending in .bgz is BGZF compressed
+    close moves the file into place, abort (or an exception in a with block) throws it away
+    '''
+    def __init__(self,output,compress=None):
+        if compress is None:
+            if output.endswith('.bgz'):
+                compress = 'bgzf'
+            elif output.endswith('.gz'):
+                compress = 'gzip'
+            else:
+                compress = 'none'
+        if ['none','gzip','bgzf'].count(compress) != 1:
+            raise ValueError("compress command invalid: '"+compress+"'.")
+
+        self._output = output
+        fd,self._tempPath = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(output)),suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(output)))
+        self._raw = os.fdopen(fd,'wb')
+        if compress == 'gzip':
+            self._fh = gzip.GzipFile(os.path.basename(output),'wb',9,self._raw)
+        elif compress == 'bgzf':
+            self._fh = BgzfWriter(self._raw)
+        else:
+            self._fh = self._raw
+
+    def write(self,data):
+        self._fh.write(data)
+
+    def close(self):
+        if self._fh is not self._raw:
+            self._fh.close()
+        self._raw.close()
+        #mkstemp files are private, give the output the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self._tempPath,0o666 & ~umask)
+        os.rename(self._tempPath,self._output)
+
+    def abort(self):
+        self._raw.close()
+        if os.path.exists(self._tempPath):
+            os.remove(self._tempPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+
+#writeTable
+#buffered, atomic version of unParseTable. rows are formatted and written a
+#block at a time and the output only appears once it's complete
+#example call writeTable(table, 'table.txt.gz', '\t') for a gzipped tab del file
+def writeTable(table,output,sep='\t',compress=None,blockSize=10000):
+    '''
+    writes an iterable of rows (or a 2d numpy array) to output, see AtomicWriter for compress
+    w/ an empty sep, each row is written as str(row). returns output
+    '''
+    if isinstance(table,numpy.ndarray):
+        blocks = (table[i:i+blockSize].tolist() for i in range(0,len(table),blockSize))
+    else:
+        rows = iter(table)
+        blocks = iter(lambda: list(itertools.islice(rows,blockSize)),[])
+
+    with AtomicWriter(output,compress) as fh:
+        for block in blocks:
+            if len(sep) == 0:
+                fh.write(''.join([str(line) + '\n' for line in block]))
+            else:
+                fh.write(''.join([sep.join(map(str,line)) + '\n' for line in block]))
+    return output
+
+
+def writeColumns(columns,output,sep='\t',header=[],compress=None,blockSize=10000):
+    '''
+    writes a table given as a list of equal length columns (lists or numpy arrays)
+    w/ an optional header row. numpy values are written like python ones. returns output
+    '''
+    def columnRows():
+        if len(header) > 0:
+            yield header
+        nRows = len(columns[0]) if len(columns) > 0 else 0
+        for i in range(0,nRows,blockSize):
+            block = [column[i:i+blockSize] for column in columns]
+            for row in zip(*[column.tolist() if isinstance(column,numpy.ndarray) else column for column in block]):
+                yield row
+    return writeTable(columnRows(),output,sep,compress,blockSize)
+
+
+#signal cubes
+#mapping several bams to one gff in matrix or clustergram mode gives a regions x bins x samples
+#array of signal. it's kept as an .npz w/ the region IDs, locus lines and sample names, or written
+#as one wide matrix w/ a block of bin columns per sample
+#example call:
+#regionIDs,locusLines,samples,signal = loadSignalCube('mapped.npz')
+
+def matrixRowsToArray(rows,nBins=None):
+    '''
+    the bin values of bamToGFF style matrix/clustergram rows [GENE_ID,locusLine,bin1,...] as a 2d float array
+    NA values and the missing bins of short rows become nan. nBins defaults to the longest row
+    '''
+    if nBins is None:
+        nBins = max([len(row) - 2 for row in rows] + [0])
+    signal = numpy.empty((len(rows),nBins))
+    signal.fill(numpy.nan)
+    for i,row in enumerate(rows):
+        values = [numpy.nan if x == 'NA' else float(x) for x in row[2:nBins+2]]
+        signal[i,:len(values)] = values
+    return signal
+
+
+def writeSignalCube(output,regionIDs,locusLines,samples,signal):
+    '''
+    writes a regions x bins x samples signal array and its region IDs, locus lines and sample names
+    to an .npz. like writeTable, the output only appears once it's complete. returns output
+    '''
+    fd,tempPath = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(output)),suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        fh = os.fdopen(fd,'wb')
+        numpy.savez_compressed(fh,regionIDs=numpy.array(regionIDs,dtype=str),locusLines=numpy.array(locusLines,dtype=str),
+                               samples=numpy.array(samples,dtype=str),signal=numpy.asarray(signal,dtype=float))
+        fh.close()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tempPath,0o666 & ~umask)
+        os.rename(tempPath,output)
+    except:
+        if os.path.exists(tempPath): os.remove(tempPath)
+        raise
+    return output
+
+
+def loadSignalCube(cubeFile,samples=None):
+    '''
+    loads a cube written by writeSignalCube as (regionIDs,locusLines,samples,signal) numpy arrays
+    w/ a list of samples, only those samples are returned, in that order
+    '''
+    cube = numpy.load(cubeFile)
+    try:
+        regionIDs,locusLines,cubeSamples,signal = [cube[name] for name in ['regionIDs','locusLines','samples','signal']]
+    finally:
+        cube.close()
+    if samples is not None:
+        sampleIndex = dict([(name,i) for i,name in enumerate(cubeSamples.tolist())])
+        missing = [name for name in samples if not sampleIndex.has_key(name)]
+        if len(missing) > 0:
+            raise ValueError('samples not in signal cube %s: %s' % (cubeFile,','.join(missing)))
+        columns = [sampleIndex[name] for name in samples]
+        cubeSamples,signal = cubeSamples[columns],signal[:,:,columns]
+    return regionIDs,locusLines,cubeSamples,signal
+
+
+def writeSignalMatrix(output,header,regionIDs,locusLines,signal,compress=None):
+    '''
+    writes a signal cube as one wide table: GENE_ID, locusLine and then each sample's bins in turn
+    nan bins are written as NA. returns output
+    '''
+    def signalRows():
+        yield header
+        for regionID,locusLine,regionSignal in itertools.izip(regionIDs,locusLines,signal):
+            values = regionSignal.T.ravel().tolist()
+            yield [regionID,locusLine] + ['NA' if value != value else value for value in values]
+    return writeTable(signalRows(),output,'\t',compress)
+
+
 #unParseTable 4/14/08
 #takes in a table generated by parseTable and writes it to an output file
 #takes as parameters (table, output, sep), where sep is how the file is delimited
 #example call unParseTable(table, 'table.txt', '\t') for a tab del file
+#now goes through writeTable, so the output is written atomically
 
 def unParseTable(table, output, sep):
-    fh_out = open(output, 'w')
-    if len(sep) == 0:
-        for i in table:
-            fh_out.write(str(i) + '\n')
-    else:
-        for line in table:
-            fh_out.write(sep.join([str(x) for x in line]) + '\n')
-
-    fh_out.close()
+    writeTable(table, output, sep)
 
 
 
@@ -254,12 +614,14 @@ def formatFolder(folderName, create=False):
     return False
 
 
-def checkOutput(fileName, waitTime = 1, timeOut = 30):
+def checkOutput(fileName, waitTime = 1, timeOut = 30, atomic = False):
 
     '''
     checks for the presence of a file every N minutes
     if it exists, returns True
     default is 1 minute with a max timeOut of 30 minutes
+    files written atomically (e.g. by unParseTable/writeTable) are complete as soon as
+    they exist, so w/ atomic=True the size isn't polled to see if it's still growing
     '''
     waitTime = int(waitTime*60)
 
@@ -270,18 +632,24 @@ def checkOutput(fileName, waitTime = 1, timeOut = 30):
 
     fileExists = False
     while not fileExists:
-        try:
-            size1 = os.stat(fileName).st_size
-            time.sleep(.5)
-            size2 = os.stat(fileName).st_size
-            if size1 == size2:
-                fileExists = True
-            else:
-                time.sleep(waitTime)
-                ticker+=1
-        except OSError:
+        if atomic:
+            if os.path.isfile(fileName):
+                return True
             time.sleep(waitTime)
             ticker+=1
+        else:
+            try:
+                size1 = os.stat(fileName).st_size
+                time.sleep(.5)
+                size2 = os.stat(fileName).st_size
+                if size1 == size2:
+                    fileExists = True
+                else:
+                    time.sleep(waitTime)
+                    ticker+=1
+            except OSError:
+                time.sleep(waitTime)
+                ticker+=1
         if ticker == maxTicker:
             break
 
@@ -310,6 +678,227 @@ def getParentFolder(inputFile):
 #===================ANNOTATION FUNCTIONS===========================
 #==================================================================
 
+#refseq annotation files are parsed once into numpy columns and cached as an npz
+#named by the md5 of the file contents, so an edited or replaced annotation never
+#hits a stale cache. caches are written to a temp file and renamed into place so
+#concurrent writers can't leave a partial cache behind.
+#bump ANNOTATION_CACHE_VERSION whenever the cached columns change
+ANNOTATION_CACHE_VERSION = 1
+ANNOTATION_CACHE_FOLDER = '%s/annotation_cache' % (tempfile.gettempdir())
+
+#stores already loaded by this process keyed by (path,size,mtime)
+_annotationStores = {}
+
+def getAnnotationStore(annotFile,useCache=True):
+    '''
+    returns the AnnotationStore for a refseq annotation file
+    reuses the one already loaded by this process if the file hasn't changed
+    '''
+    fileStat = os.stat(annotFile)
+    storeKey = (os.path.abspath(annotFile),fileStat.st_size,fileStat.st_mtime,useCache)
+    if not _annotationStores.has_key(storeKey):
+        _annotationStores[storeKey] = AnnotationStore(annotFile,useCache)
+    return _annotationStores[storeKey]
+
+
+class AnnotationStore(object):
+    '''
+    columnar copy of a UCSC refseq annotation file, cached on disk
+    startDicts, Gene objects and transcript/TSS collections are built from the columns on request
+    '''
+    columnNames = ['ID','chr','sense','name','txStart','txEnd','cdStart','cdEnd','exonOffsets','exonStarts','exonEnds']
+
+    def __init__(self,annotFile,useCache=True):
+        self._annotFile = annotFile
+        self._cacheFile = ''
+        if useCache:
+            self._cacheFile = '%s/%s.%s.v%s.npz' % (ANNOTATION_CACHE_FOLDER,os.path.basename(annotFile),
+                                                   self.hashFile(annotFile),ANNOTATION_CACHE_VERSION)
+        self._columns = None
+        self._geneIndex = None
+
+    @staticmethod
+    def hashFile(fileName):
+        md5 = hashlib.md5()
+        fh = bopen(fileName,'rb')
+        for chunk in iter(lambda: fh.read(1 << 20),''):
+            md5.update(chunk)
+        fh.close()
+        return md5.hexdigest()
+
+    def getCacheFile(self):
+        return self._cacheFile
+
+    def __parseColumns(self):
+        '''
+        parses the annotation file the same way importRefseq does, skipping the header line
+        '''
+        refseqTable = parseTable(self._annotFile,'\t')[1:]
+        exonStarts = [map(int,line[9].split(',')[:-1]) for line in refseqTable]
+        exonEnds = [map(int,line[10].split(',')[:-1]) for line in refseqTable]
+        columns = {}
+        for name,col in [('ID',1),('chr',2),('sense',3),('name',12)]:
+            columns[name] = numpy.array([line[col] for line in refseqTable],dtype=str)
+        for name,col in [('txStart',4),('txEnd',5),('cdStart',6),('cdEnd',7)]:
+            columns[name] = numpy.array([line[col] for line in refseqTable],dtype=numpy.int64)
+        columns['exonOffsets'] = numpy.cumsum([0] + [len(exons) for exons in exonStarts]).astype(numpy.int64)
+        columns['exonStarts'] = numpy.array([x for exons in exonStarts for x in exons],dtype=numpy.int64)
+        columns['exonEnds'] = numpy.array([x for exons in exonEnds for x in exons],dtype=numpy.int64)
+        return columns
+
+    def __readCache(self):
+        try:
+            cache = numpy.load(self._cacheFile)
+            columns = dict([(name,cache[name]) for name in self.columnNames])
+            cache.close()
+            return columns
+        except Exception:
+            print('WARNING: ANNOTATION CACHE %s IS UNREADABLE. REBUILDING' % (self._cacheFile))
+            return None
+
+    def __writeCache(self,columns):
+        tempPath = ''
+        try:
+            try:
+                os.makedirs(ANNOTATION_CACHE_FOLDER)
+            except OSError:
+                if not os.path.isdir(ANNOTATION_CACHE_FOLDER): raise
+            fd,tempPath = tempfile.mkstemp(suffix='.tmp',dir=ANNOTATION_CACHE_FOLDER)
+            fh = os.fdopen(fd,'wb')
+            numpy.savez(fh,**columns)
+            fh.close()
+            os.chmod(tempPath,0o644)
+            os.rename(tempPath,self._cacheFile)
+        except (IOError,OSError) as e:
+            print('WARNING: COULD NOT WRITE ANNOTATION CACHE %s: %s' % (self._cacheFile,e))
+            if len(tempPath) > 0 and os.path.exists(tempPath): os.remove(tempPath)
+
+    def getColumns(self):
+        '''
+        loads the columns from the cache, or parses the annotation file and writes the cache
+        '''
+        if self._columns is None:
+            columns = None
+            if len(self._cacheFile) > 0 and os.path.isfile(self._cacheFile):
+                columns = self.__readCache()
+            if columns is None:
+                columns = self.__parseColumns()
+                if len(self._cacheFile) > 0: self.__writeCache(columns)
+            self._columns = columns
+        return self._columns
+
+    def getGeneIndex(self):
+        '''
+        dictionary of refseq ID to the row of its first entry
+        '''
+        if self._geneIndex is None:
+            IDs = self.getColumns()['ID'].tolist()
+            self._geneIndex = {}
+            for row in range(len(IDs)-1,-1,-1): self._geneIndex[IDs[row]] = row
+        return self._geneIndex
+
+    def __getRows(self,geneList):
+        '''
+        (ID,row) for each gene in geneList (all genes if empty) that's in the annotation
+        '''
+        geneIndex = self.getGeneIndex()
+        if len(geneList) == 0: return geneIndex.items()
+        return [(gene,geneIndex[gene]) for gene in geneList if geneIndex.has_key(gene)]
+
+    def getStartDict(self,geneList=[]):
+        '''
+        same as makeStartDict
+        '''
+        columns = self.getColumns()
+        chroms,senses,names = columns['chr'].tolist(),columns['sense'].tolist(),columns['name'].tolist()
+        txStarts,txEnds = columns['txStart'].tolist(),columns['txEnd'].tolist()
+        startDict = {}
+        for gene,row in self.__getRows(geneList):
+            sense = senses[row]
+            startDict[gene] = {'sense':sense,'chr':chroms[row],'name':names[row]}
+            if sense == '+':
+                startDict[gene]['start'] = [txStarts[row]]
+                startDict[gene]['end'] = [txEnds[row]]
+            elif sense == '-':
+                startDict[gene]['start'] = [txEnds[row]]
+                startDict[gene]['end'] = [txStarts[row]]
+            else:
+                startDict[gene]['start'] = []
+                startDict[gene]['end'] = [txStarts[row]]
+        return startDict
+
+    def makeGene(self,refseqID,row):
+        '''
+        makes the Gene object for one row
+        '''
+        columns = self.getColumns()
+        exonRange = slice(columns['exonOffsets'][row],columns['exonOffsets'][row+1])
+        return Gene(refseqID,str(columns['chr'][row]),str(columns['sense'][row]),
+                    [int(columns['txStart'][row]),int(columns['txEnd'][row])],
+                    [int(columns['cdStart'][row]),int(columns['cdEnd'][row])],
+                    columns['exonStarts'][exonRange].tolist(),columns['exonEnds'][exonRange].tolist(),
+                    str(columns['name'][row]))
+
+    def getGenes(self,geneList=[],asDict=False):
+        '''
+        same as makeGenes. as a dict, each Gene is only made when it is first looked up
+        '''
+        if asDict:
+            return LazyGeneDict(self,dict(self.__getRows(geneList)))
+        return [self.makeGene(refseqID,row) for refseqID,row in self.__getRows(geneList)]
+
+    def getTranscriptCollection(self,upSearch,downSearch,window=500,geneList=[]):
+        '''
+        same as makeTranscriptCollection. genes w/ more than one entry get a locus for each
+        '''
+        columns = self.getColumns()
+        rows = numpy.arange(len(columns['ID']))
+        if len(geneList) > 0:
+            rows = rows[numpy.in1d(columns['ID'],numpy.array(list(geneList),dtype=str))]
+        minus = columns['sense'][rows] == '-'
+        starts = columns['txStart'][rows] - numpy.where(minus,downSearch,upSearch)
+        ends = columns['txEnd'][rows] + numpy.where(minus,upSearch,downSearch)
+        locusList = [Locus(chrom,start,end,sense,ID) for chrom,start,end,sense,ID in
+                     zip(columns['chr'][rows].tolist(),starts.tolist(),ends.tolist(),
+                         columns['sense'][rows].tolist(),columns['ID'][rows].tolist())]
+        return LocusCollection(locusList,window)
+
+    def getTSSCollection(self,upSearch,downSearch,window=500,geneList=[]):
+        '''
+        a LocusCollection of makeTSSLocus(gene,startDict,upSearch,downSearch) for every gene
+        '''
+        startDict = self.getStartDict(geneList)
+        return LocusCollection([makeTSSLocus(gene,startDict,upSearch,downSearch) for gene in startDict],window)
+
+
+class LazyGeneDict(DictMixin):
+    '''
+    dictionary of refseq ID to Gene object that makes each Gene from an AnnotationStore on first lookup
+    '''
+    def __init__(self,store,geneRows):
+        self._store = store
+        self._geneRows = geneRows
+        self._genes = {}
+
+    def __getitem__(self,refseqID):
+        if not self._genes.has_key(refseqID):
+            self._genes[refseqID] = self._store.makeGene(refseqID,self._geneRows[refseqID])
+        return self._genes[refseqID]
+
+    def __setitem__(self,refseqID,gene):
+        self._geneRows[refseqID] = None
+        self._genes[refseqID] = gene
+
+    def __delitem__(self,refseqID):
+        del self._geneRows[refseqID]
+        self._genes.pop(refseqID,None)
+
+    def __contains__(self,refseqID): return self._geneRows.has_key(refseqID)
+    def has_key(self,refseqID): return self._geneRows.has_key(refseqID)
+    def __iter__(self): return iter(self._geneRows)
+    def __len__(self): return len(self._geneRows)
+    def keys(self): return self._geneRows.keys()
+
 
 def makeStartDict(annotFile, geneList=[]):
     '''
@@ -322,23 +911,8 @@ def makeStartDict(annotFile, geneList=[]):
         geneList = [line[0] for line in geneList]
 
     if annotFile.upper().count('REFSEQ') == 1:
-        refseqTable,refseqDict = importRefseq(annotFile)
-        if len(geneList) == 0:
-            geneList = refseqDict.keys()
-        startDict = {}
-        for gene in geneList:
-            if refseqDict.has_key(gene) == False:
-                continue
-            startDict[gene]={}
-            startDict[gene]['sense'] = refseqTable[refseqDict[gene][0]][3]
-            startDict[gene]['chr'] = refseqTable[refseqDict[gene][0]][2]
-            startDict[gene]['start'] = getTSSs([gene],refseqTable,refseqDict)
-            if startDict[gene]['sense'] == '+':
-                startDict[gene]['end'] =[int(refseqTable[refseqDict[gene][0]][5])]
-            else:
-                startDict[gene]['end'] = [int(refseqTable[refseqDict[gene][0]][4])]
-            startDict[gene]['name'] = refseqTable[refseqDict[gene][0]][12]
-    return startDict
+        return getAnnotationStore(annotFile).getStartDict(geneList)
+    return {}
 
 
 #generic function to get the TSS of any gene
@@ -422,27 +996,7 @@ def makeGenes(annotFile,geneList=[],asDict = False):
 
 
     if annotFile.upper().count('REFSEQ') == 1:
-        refTable,refDict = importRefseq(annotFile)
-
-        if len(geneList) == 0:
-            geneList = refDict.keys()
-
-        for refseqID in geneList:
-            if refseqID not in refDict:
-                #print('no such gene ' + str(refseqID))
-                continue
-
-            geneIndex = refDict[refseqID][0]
-            geneLine = refTable[int(geneIndex)]
-            exonStarts = map(int,geneLine[9].split(',')[:-1])
-            exonEnds = map(int,geneLine[10].split(',')[:-1])
-
-            gene = Gene(refseqID,geneLine[2],geneLine[3],[int(geneLine[4]),int(geneLine[5])],[int(geneLine[6]),int(geneLine[7])],exonStarts,exonEnds,geneLine[12])
-
-            if asDict:
-                genes[refseqID] = gene
-            else:
-                genes.append(gene)
+        return getAnnotationStore(annotFile).getGenes(geneList,asDict)
 
     return genes
 
@@ -457,25 +1011,9 @@ def makeTranscriptCollection(annotFile,upSearch,downSearch,window = 500,geneList
     '''
 
     if annotFile.upper().count('REFSEQ') == 1:
-        refseqTable,refseqDict = importRefseq(annotFile)
-        locusList = []
-        ticker = 0
-        if len(geneList) == 0:
-            geneList = refseqDict.keys()
-
-        for line in refseqTable[1:]:
-            if line[1] in geneList:
-                if line[3] == '-':
-                    locus = Locus(line[2],int(line[4])-downSearch,int(line[5])+upSearch,line[3],line[1])
-                else:
-                    locus = Locus(line[2],int(line[4])-upSearch,int(line[5])+downSearch,line[3],line[1])
-                locusList.append(locus)
-                ticker = ticker + 1
-                if ticker%1000 == 0:
-                    print(ticker)
+        return getAnnotationStore(annotFile).getTranscriptCollection(upSearch,downSearch,window,geneList)
 
-    transCollection = LocusCollection(locusList, window)
-    return transCollection
+    return LocusCollection([], window)
 
 
 #140213
@@ -518,28 +1056,7 @@ def importBoundRegion(boundRegionFile,name):
     imports bound regions in either bed format or in error model format                                                                
     '''
 
-    bound = parseTable(boundRegionFile,'\t')
-    lociList = []
-    ticker = 1
-    #                                                                                                                                  
-    if boundRegionFile.split('.')[-1] == 'bed':
-        bed = True
-    else:
-        bed = False
-    if bed:
-        for line in bound:
-            if ticker%1000 == 0:
-                print(ticker)
-            lociList.append(Locus(line[0],int(line[1]),int(line[2]),'.',ID = name + '_' + str(ticker)))
-            ticker = ticker + 1
-    else:
-        for line in bound:
-            if ticker%1000 == 0:
-                print(ticker)
-
-            lociList.append(Locus('chr'+line[0],int(line[1]),int(line[2]),'.',ID = name + '_' + str(ticker)))
-            ticker = ticker + 1
-    return LocusCollection(lociList,500)
+    return LocusTable.fromBoundRegion(boundRegionFile,name).toCollection(500)
 
 
 
@@ -550,7 +1067,10 @@ def importBoundRegion(boundRegionFile,name):
 #Locus and LocusCollection instances courtesy of Graham Ruby
 
 
-class Locus:
+class Locus(object):
+    # slots keep each instance down to its six attributes instead of carrying
+    # a per instance __dict__.  there are a lot of these.
+    __slots__ = ('_chr','_sense','_start','_end','_ID','_score')
     # this may save some space by reducing the number of chromosome strings
     # that are associated with Locus instances (see __init__).
     __chrDict = dict()
@@ -560,16 +1080,22 @@ class Locus:
     # start,end = ints of the start and end coords of the locus;
     #      end coord is the coord of the last nucleotide.
     def __init__(self,chr,start,end,sense,ID='',score=0):
-        coords = sorted([int(start), int(end)])
+        start = int(start)
+        end = int(end)
+        if start > end: start,end = end,start
         # this method for assigning chromosome should help avoid storage of
         # redundant strings.
         if not(self.__chrDict.has_key(chr)): self.__chrDict[chr] = chr
         self._chr = self.__chrDict[chr]
         self._sense = self.__senseDict[sense]
-        self._start = int(coords[0])
-        self._end = int(coords[1])
+        self._start = start
+        self._end = end
         self._ID = ID
         self._score = score
+    def __getstate__(self): return (self._chr,self._sense,self._start,self._end,self._ID,self._score)
+    def __setstate__(self,state):
+        (chr,self._sense,self._start,self._end,self._ID,self._score) = state
+        self._chr = self.__chrDict.setdefault(chr,chr)
     def ID(self): return self._ID
     def chr(self): return self._chr
     def start(self): return self._start  ## returns the smallest coordinate
@@ -608,7 +1134,9 @@ class Locus:
     # same as contains, but considers the opposite strand
     def containsAntisense(self,otherLocus):
         return self.getAntisenseLocus().contains(otherLocus)
-    def __hash__(self): return self._start + self._end
+    # hashing on every field __eq__ compares keeps loci with the same span on
+    # different chromosomes or strands (or just the same start+end) apart
+    def __hash__(self): return hash((self._chr,self._start,self._end,self._sense))
     def __eq__(self,other):
         if self.__class__ != other.__class__: return False
         if self.chr()!=other.chr(): return False
@@ -671,29 +1199,185 @@ class Locus:
         return phastSum/self.len()
 
 
+class IntervalIndex(object):
+    # a nested containment list: intervals sorted by start (longest first on
+    # ties) are split into sublists, where each interval is filed under the
+    # nearest interval before it that contains it.  no interval in a sublist
+    # contains another, so both starts and ends increase along a sublist and
+    # the intervals of a sublist overlapping [start,end] are one contiguous run
+    # found w/ two bisects.  a query only descends into the sublists of the
+    # intervals it overlaps, so it costs O(log n) per overlapping interval that
+    # has nested intervals plus O(1) per overlap, however long the intervals are.
+    # the sublists are laid out back to back in one array, keyed by
+    # sublist*2**32 plus the coordinate, so a single searchsorted bisects
+    # every (query,sublist) pair of a level at once.
+
+    __offset = 2**31
+
+    def __init__(self,starts,ends):
+        '''
+        starts and ends are sequences of inclusive interval coords, like a locus' start and end
+        '''
+        starts = numpy.asarray(starts,dtype=numpy.int64)
+        ends = numpy.asarray(ends,dtype=numpy.int64)
+        order = numpy.lexsort((-ends,starts))
+        sortedEnds = ends[order]
+
+        #0 for the top level, otherwise 1 + the sorted position of the containing interval
+        parents = numpy.zeros(len(order),dtype=numpy.int64)
+        if len(order) > 1 and not numpy.all(sortedEnds[1:] > sortedEnds[:-1]):
+            stack = []
+            stackEnds = []
+            for i,end in enumerate(sortedEnds.tolist()):
+                while stackEnds and stackEnds[-1] < end:
+                    stack.pop()
+                    stackEnds.pop()
+                if stack: parents[i] = stack[-1] + 1
+                stack.append(i)
+                stackEnds.append(end)
+
+        #a stable sort keeps each sublist in start order
+        layout = numpy.argsort(parents,kind='mergesort')
+        sublists = parents[layout]
+        self._positions = order[layout]
+        self._startKeys = self.__keys(sublists,starts[self._positions])
+        self._endKeys = self.__keys(sublists,ends[self._positions])
+        self._children = layout + 1
+        self._hasChildren = (numpy.searchsorted(sublists,self._children,'right') >
+                             numpy.searchsorted(sublists,self._children,'left'))
+        self.__lists = None
+
+    def __keys(self,sublists,coords):
+        coords = numpy.clip(coords,-self.__offset,self.__offset - 1) + self.__offset
+        return (sublists << 32) + coords
+
+    def __len__(self): return len(self._positions)
+
+    def query(self,starts,ends):
+        '''
+        finds every (query,interval) pair where the interval overlaps the query [start,end]
+        returns numpy arrays of query positions and interval positions, in the order of the
+        starts/ends passed here and to the constructor
+        '''
+        starts = numpy.asarray(starts,dtype=numpy.int64)
+        ends = numpy.asarray(ends,dtype=numpy.int64)
+        queries = numpy.arange(len(starts))
+        sublists = numpy.zeros(len(starts),dtype=numpy.int64)
+        queryHits = [numpy.zeros(0,dtype=numpy.int64)]
+        slotHits = [numpy.zeros(0,dtype=numpy.int64)]
+        while len(queries) > 0:
+            lo = numpy.searchsorted(self._endKeys,self.__keys(sublists,starts[queries]),'left')
+            hi = numpy.searchsorted(self._startKeys,self.__keys(sublists,ends[queries]),'right')
+            counts = numpy.maximum(hi - lo,0)
+            queries = numpy.repeat(queries,counts)
+            slots = numpy.arange(len(queries)) + numpy.repeat(lo - (numpy.cumsum(counts) - counts),counts)
+            queryHits.append(queries)
+            slotHits.append(slots)
+
+            #only the intervals that overlap the query can have nested ones that do
+            nested = self._hasChildren[slots]
+            queries = queries[nested]
+            sublists = self._children[slots[nested]]
+        return numpy.concatenate(queryHits),self._positions[numpy.concatenate(slotHits)]
+
+    def find(self,start,end):
+        '''
+        list of the positions of the intervals overlapping [start,end], for one query
+        '''
+        #a single query only touches a few sublists, so it walks python lists
+        #instead of paying numpy's per call overhead at every level
+        if self.__lists is None:
+            self.__lists = (self._startKeys.tolist(),self._endKeys.tolist(),self._positions.tolist(),
+                            numpy.where(self._hasChildren,self._children,0).tolist())
+        startKeys,endKeys,positions,children = self.__lists
+        start = int(self.__keys(0,start))
+        end = int(self.__keys(0,end))
+        hits = []
+        sublists = [0]
+        while sublists:
+            shift = sublists.pop() << 32
+            lo = bisect.bisect_left(endKeys,shift + start)
+            hi = bisect.bisect_right(startKeys,shift + end,lo)
+            if lo < hi:
+                hits += positions[lo:hi]
+                sublists += [child for child in children[lo:hi] if child]
+        return hits
+
+
 class LocusCollection:
+    # loci are kept per chromosome/strand key ('chr1+', 'chr1-'; '.' loci go
+    # under both).  each key gets a lazily built index made of a few blocks of
+    # loci, each w/ an IntervalIndex over their coords, so a query costs
+    # O(log n) per block and per overlapping locus w/ loci nested in it, plus
+    # O(1) per overlap, whatever the locus or window sizes.  appended loci go
+    # into a new block that is merged with the smaller blocks before it, so
+    # appends between queries stay cheap.
+    # windowSize is kept for backwards compatibility of the constructor.
     def __init__(self,loci,windowSize=50):
         ### top-level keys are chr, then strand, no space
-        self.__chrToCoordToLoci = dict()
+        self.__chrToLoci = dict()
+        self.__chrToBlocks = dict()
+        self.__chrToPending = dict()
+        self.__chrToStale = dict()
         self.__loci = dict()
         self.__winSize = windowSize
         for lcs in loci: self.__addLocus(lcs)
 
+    def __getChrKeys(self,lcs):
+        if lcs.sense()=='.': return [lcs.chr()+'+', lcs.chr()+'-']
+        else: return [lcs.chr()+lcs.sense()]
+
     def __addLocus(self,lcs):
         if not(self.__loci.has_key(lcs)):
             self.__loci[lcs] = None
-            if lcs.sense()=='.': chrKeyList = [lcs.chr()+'+', lcs.chr()+'-']
-            else: chrKeyList = [lcs.chr()+lcs.sense()]
-            for chrKey in chrKeyList:
-                if not(self.__chrToCoordToLoci.has_key(chrKey)): self.__chrToCoordToLoci[chrKey] = dict()
-                for n in self.__getKeyRange(lcs):
-                    if not(self.__chrToCoordToLoci[chrKey].has_key(n)): self.__chrToCoordToLoci[chrKey][n] = []
-                    self.__chrToCoordToLoci[chrKey][n].append(lcs)
-
-    def __getKeyRange(self,locus):
-        start = locus.start() / self.__winSize
-        end = locus.end() / self.__winSize + 1 ## add 1 because of the range
-        return range(start,end)
+            for chrKey in self.__getChrKeys(lcs):
+                if not(self.__chrToLoci.has_key(chrKey)):
+                    self.__chrToLoci[chrKey] = dict()
+                    self.__chrToBlocks[chrKey] = []
+                    self.__chrToPending[chrKey] = []
+                    self.__chrToStale[chrKey] = 0
+                self.__chrToLoci[chrKey][lcs] = lcs
+                self.__chrToPending[chrKey].append(lcs)
+
+    def __makeBlock(self,lociList):
+        starts = numpy.array([lcs.start() for lcs in lociList],dtype=numpy.int64)
+        ends = numpy.array([lcs.end() for lcs in lociList],dtype=numpy.int64)
+        return (starts,ends,IntervalIndex(starts,ends),lociList)
+
+    def __mergeBlocks(self,first,second):
+        starts = numpy.concatenate((first[0],second[0]))
+        ends = numpy.concatenate((first[1],second[1]))
+        return (starts,ends,IntervalIndex(starts,ends),first[3] + second[3])
+
+    def __getBlocks(self,chrKey):
+        chrLoci = self.__chrToLoci[chrKey]
+        pending = self.__chrToPending[chrKey]
+        blocks = self.__chrToBlocks[chrKey]
+        # removals leave stale loci in the blocks; rebuild once they dominate
+        if self.__chrToStale[chrKey] > len(chrLoci) + 64:
+            blocks[:] = [self.__makeBlock(chrLoci.values())]
+            self.__chrToStale[chrKey] = 0
+            del pending[:]
+        elif len(pending) > 0:
+            blocks.append(self.__makeBlock([lcs for lcs in pending if chrLoci.get(lcs) is lcs]))
+            del pending[:]
+            while len(blocks) > 1 and len(blocks[-2][3]) <= 2*len(blocks[-1][3]):
+                last = blocks.pop()
+                blocks[-1] = self.__mergeBlocks(blocks[-1],last)
+        return blocks
+
+    def __getRange(self,chrKey,start,end):
+        '''
+        returns every locus under chrKey whose coords overlap [start,end]
+        '''
+        if not(self.__chrToLoci.has_key(chrKey)): return []
+        hits = []
+        for starts,ends,index,lociList in self.__getBlocks(chrKey):
+            hits += [lociList[i] for i in index.find(start,end)]
+        if self.__chrToStale[chrKey] > 0:
+            chrLoci = self.__chrToLoci[chrKey]
+            hits = [lcs for lcs in hits if chrLoci.get(lcs) is lcs]
+        return hits
 
     def __len__(self): return len(self.__loci)
 
@@ -705,11 +1389,11 @@ class LocusCollection:
     def remove(self,old):
         if not(self.__loci.has_key(old)): raise ValueError("requested locus isn't in collection")
         del self.__loci[old]
-        if old.sense()=='.': senseList = ['+','-']
-        else: senseList = [old.sense()]
-        for k in self.__getKeyRange(old):
-            for sense in senseList:
-                self.__chrToCoordToLoci[old.chr()+sense][k].remove(old)
+        # the blocks keep the removed locus until the next rebuild,
+        # __getRange filters it out against the per key dict
+        for chrKey in self.__getChrKeys(old):
+            del self.__chrToLoci[chrKey][old]
+            self.__chrToStale[chrKey] += 1
 
     def getWindowSize(self): return self.__winSize
     def getLoci(self): return self.__loci.keys()
@@ -725,7 +1409,7 @@ class LocusCollection:
         # i need to remove the strand info from the chromosome keys and make
         # them non-redundant.
         tempKeys = dict()
-        for k in self.__chrToCoordToLoci.keys(): tempKeys[k[:-1]] = None
+        for k in self.__chrToLoci.keys(): tempKeys[k[:-1]] = None
         return tempKeys.keys()
 
     def __subsetHelper(self,locus,sense):
@@ -740,11 +1424,8 @@ class LocusCollection:
         else: raise ValueError("sense value was inappropriate: '"+sense+"'.")
         for s in filter(lamb, senses):
             chrKey = locus.chr()+s
-            if self.__chrToCoordToLoci.has_key(chrKey):
-                for n in self.__getKeyRange(locus):
-                    if self.__chrToCoordToLoci[chrKey].has_key(n):
-                        for lcs in self.__chrToCoordToLoci[chrKey][n]:
-                            matches[lcs] = None
+            for lcs in self.__getRange(chrKey,locus.start(),locus.end()):
+                matches[lcs] = None
         return matches.keys()
 
     # sense can be 'sense' (default), 'antisense', or 'both'
@@ -799,7 +1480,46 @@ class LocusCollection:
         #initializing stitchWindow to 1 
         #this helps collect directly adjacent loci
 
+        if sense != 'both':
+            #strand aware stitching depends on the order loci are visited in,
+            #so it keeps the iterative implementation
+            return self.__iterativeStitch(stitchWindow,sense)
+
+        #with sense='both' a stitched region is a run of loci on a chromosome
+        #sorted by start where each start is within stitchWindow of the
+        #furthest end before it. one sort and one sweep per chromosome.
+        locusList = self.getLoci()
+        chrToOrder = defaultdict(list)
+        for i,locus in enumerate(locusList):
+            chrToOrder[locus.chr()].append(i)
+
+        stitchedLoci = []
+        for chrom,order in chrToOrder.items():
+            starts = numpy.array([locusList[i].start() for i in order],dtype=numpy.int64)
+            ends = numpy.array([locusList[i].end() for i in order],dtype=numpy.int64)
+            sortOrder = numpy.argsort(starts,kind='mergesort')
+            starts = starts[sortOrder]
+            maxEnds = numpy.maximum.accumulate(ends[sortOrder])
+            breaks = numpy.flatnonzero(starts[1:] > maxEnds[:-1] + stitchWindow) + 1
+            bounds = [0] + breaks.tolist() + [len(order)]
+            for a,b in zip(bounds[:-1],bounds[1:]):
+                #the region is named after whichever of its loci comes first in
+                #getLoci, same as the locus that would seed it when iterating
+                seed = locusList[order[sortOrder[a:b].min()]]
+                stitchedID = '%s_%s_lociStitched' % (b-a,seed.ID())
+                if b - a == 1:
+                    stitchedLoci.append(Locus(chrom,seed.start(),seed.end(),seed.sense(),stitchedID))
+                else:
+                    stitchedLoci.append(Locus(chrom,int(starts[a]),int(maxEnds[b-1]),'.',stitchedID))
 
+        return LocusCollection(stitchedLoci,500)
+
+    def __iterativeStitch(self,stitchWindow,sense):
+
+        '''
+        stitches by removing each locus in turn and repeatedly growing it
+        with whatever still overlaps it
+        '''
 
         locusList = self.getLoci()
         oldCollection = LocusCollection(locusList,500)
@@ -837,6 +1557,302 @@ class LocusCollection:
 
 
 
+#==================================================================
+#=========================LOCUS TABLE==============================
+#==================================================================
+
+#a columnar alternative to a list of Locus objects for when only the
+#coordinates are needed. rows live in a numpy structured array and
+#chromosomes are stored once in chromList and referenced by integer code.
+
+class LocusTable(object):
+    dtype = numpy.dtype([('chr',numpy.int32),('start',numpy.int64),('end',numpy.int64),
+                         ('sense','S1'),('score',numpy.float64),('ID',object)])
+
+    def __init__(self,chromList=[],rows=None):
+        self._chromList = list(chromList)
+        if rows is None: rows = numpy.zeros(0,dtype=self.dtype)
+        self._rows = rows
+
+    @classmethod
+    def fromColumns(cls,chroms,starts,ends,senses='.',scores=0,IDs=''):
+        '''
+        makes a table from per locus columns. senses, scores and IDs can be a single value for every row
+        start and end are swapped where needed so start is always the smaller coordinate
+        '''
+        starts = numpy.array(starts,dtype=numpy.int64)
+        ends = numpy.array(ends,dtype=numpy.int64)
+        chromList,chromCodes = numpy.unique(numpy.asarray(chroms,dtype=str),return_inverse=True)
+        rows = numpy.zeros(len(starts),dtype=cls.dtype)
+        rows['chr'] = chromCodes
+        rows['start'] = numpy.minimum(starts,ends)
+        rows['end'] = numpy.maximum(starts,ends)
+        rows['sense'] = senses
+        rows['score'] = scores
+        if isinstance(IDs,str):
+            rows['ID'] = IDs
+        else:
+            rows['ID'] = list(IDs)
+        return cls(chromList.tolist(),rows)
+
+    @classmethod
+    def fromLoci(cls,loci):
+        '''
+        makes a table from a list of loci or a LocusCollection
+        '''
+        if isinstance(loci,LocusCollection): loci = loci.getLoci()
+        return cls.fromColumns([locus.chr() for locus in loci],[locus.start() for locus in loci],
+                               [locus.end() for locus in loci],[locus.sense() for locus in loci],
+                               [locus.score() for locus in loci],[locus.ID() for locus in loci])
+
+    @classmethod
+    def fromGFF(cls,gff):
+        '''
+        loads a gff file or parsed gff table. IDs follow gffToLocusCollection:
+        column 2, else column 9, else chr:sense:start-end
+        '''
+        if type(gff) == str:
+            gff = parseTable(gff,'\t')
+        if len(gff) == 0: return cls()
+
+        columns = [[line[i] for line in gff] for i in range(7)]
+        IDs = []
+        for line in gff:
+            if len(line[1]) > 0:
+                IDs.append(line[1])
+            elif len(line[8]) > 0:
+                IDs.append(line[8])
+            else:
+                IDs.append('%s:%s:%s-%s' % (line[0],line[6],line[3],line[4]))
+        return cls.fromColumns(columns[0],columns[3],columns[4],columns[6],cls.__parseScores(columns[5]),IDs)
+
+    @classmethod
+    def fromBed(cls,bed,name=''):
+        '''
+        loads a bed file or parsed bed table, including MACS peak beds
+        IDs come from the name column, or are name_N numbered by line if a name is given
+        '''
+        if type(bed) == str:
+            bed = parseTable(bed,'\t')
+        if len(bed) == 0: return cls()
+
+        nColumns = min([len(line) for line in bed])
+        columns = [[line[i] for line in bed] for i in range(min(nColumns,6))]
+        if len(name) > 0:
+            IDs = ['%s_%s' % (name,i) for i in range(1,len(bed)+1)]
+        elif nColumns > 3:
+            IDs = columns[3]
+        else:
+            IDs = ''
+        scores = cls.__parseScores(columns[4]) if nColumns > 4 else 0
+        senses = columns[5] if nColumns > 5 else '.'
+        return cls.fromColumns(columns[0],columns[1],columns[2],senses,scores,IDs)
+
+    @classmethod
+    def fromBoundRegion(cls,boundRegionFile,name):
+        '''
+        loads a bed or error model bound region file the same way as importBoundRegion
+        '''
+        bound = parseTable(boundRegionFile,'\t')
+        if len(bound) == 0: return cls()
+
+        columns = [[line[i] for line in bound] for i in range(3)]
+        if boundRegionFile.split('.')[-1] == 'bed':
+            chroms = columns[0]
+        else:
+            chroms = ['chr' + chrom for chrom in columns[0]]
+        IDs = ['%s_%s' % (name,i) for i in range(1,len(bound)+1)]
+        return cls.fromColumns(chroms,columns[1],columns[2],'.',0,IDs)
+
+    @classmethod
+    def fromEnhancerTable(cls,enhancerFile,name,top=0):
+        '''
+        loads a ROSE enhancer table the same way as makeSECollection
+        top gives the number of rows
+        '''
+        enhancerTable = [line for line in parseTable(enhancerFile,'\t') if line[0][0] != '#' and line[0][0] != 'R']
+        if top > 0: enhancerTable = enhancerTable[0:top]
+        if len(enhancerTable) == 0: return cls()
+
+        columns = [[line[i] for line in enhancerTable] for i in range(4)]
+        IDs = [name + '_' + regionID for regionID in columns[0]]
+        return cls.fromColumns(columns[1],columns[2],columns[3],'.',0,IDs)
+
+    @staticmethod
+    def __parseScores(column):
+        #gff/bed scores are often '' or '.'
+        try:
+            return numpy.array([score if score != '' and score != '.' else 0 for score in column],dtype=numpy.float64)
+        except ValueError:
+            scores = numpy.zeros(len(column))
+            for i,score in enumerate(column):
+                try:
+                    scores[i] = float(score)
+                except ValueError:
+                    pass
+            return scores
+
+    def __len__(self): return len(self._rows)
+    def getChrList(self): return list(self._chromList)
+    def chroms(self): return numpy.array(self._chromList + [''])[self._rows['chr']]
+    def starts(self): return self._rows['start']
+    def ends(self): return self._rows['end']
+    def lengths(self): return self._rows['end'] - self._rows['start'] + 1
+    def senses(self): return self._rows['sense']
+    def scores(self): return self._rows['score']
+    def IDs(self): return self._rows['ID']
+    def getRows(self): return self._rows
+
+    def subset(self,mask):
+        '''
+        returns a new table of the rows picked by a boolean mask or index array
+        '''
+        return LocusTable(self._chromList,self._rows[mask])
+
+    def filterChrom(self,chromList,exclude=False):
+        codes = [i for i,chrom in enumerate(self._chromList) if chrom in chromList]
+        mask = numpy.in1d(self._rows['chr'],codes)
+        if exclude: mask = ~mask
+        return self.subset(mask)
+
+    def filterLength(self,minLength=0,maxLength=None):
+        lengths = self.lengths()
+        mask = lengths >= minLength
+        if maxLength is not None: mask &= lengths <= maxLength
+        return self.subset(mask)
+
+    def filterScore(self,minScore=None,maxScore=None):
+        mask = numpy.ones(len(self._rows),dtype=bool)
+        if minScore is not None: mask &= self._rows['score'] >= minScore
+        if maxScore is not None: mask &= self._rows['score'] <= maxScore
+        return self.subset(mask)
+
+    def toLoci(self):
+        chroms = self._chromList
+        return [Locus(chroms[row[0]],row[1],row[2],row[3],row[5],row[4]) for row in self._rows.tolist()]
+
+    def toCollection(self,windowSize=500):
+        return LocusCollection(self.toLoci(),windowSize)
+
+    def toGFF(self):
+        chroms = self._chromList
+        return [[chroms[row[0]],row[5],'',row[1],row[2],'',row[3],'',row[5]] for row in self._rows.tolist()]
+
+
+
+#==================================================================
+#===========================TSS INDEX==============================
+#==================================================================
+
+#per chromosome sorted arrays of tss positions. nearest gene and within
+#distance lookups bisect into these for a whole list of query loci at once
+#instead of building a search locus and collection query per locus
+
+class TSSIndex(object):
+
+    def __init__(self,tssLoci):
+        '''
+        tssLoci is a list of loci or a LocusCollection (e.g. made w/ makeTSSLocus)
+        each locus is indexed at its tss: the start for + and . loci and the end for - loci
+        '''
+        if isinstance(tssLoci,LocusCollection): tssLoci = tssLoci.getLoci()
+        self._IDs = [locus.ID() for locus in tssLoci]
+        self._tss = numpy.array([locus.end() if locus.sense() == '-' else locus.start() for locus in tssLoci],dtype=numpy.int64)
+        chrToIndices = defaultdict(list)
+        for i,locus in enumerate(tssLoci): chrToIndices[locus.chr()].append(i)
+
+        #chrom -> (sorted tss positions, index of each into the input loci)
+        self._chrToTSS = dict()
+        for chrom in chrToIndices:
+            indices = numpy.array(chrToIndices[chrom],dtype=numpy.int64)
+            indices = indices[numpy.argsort(self._tss[indices],kind='mergesort')]
+            self._chrToTSS[chrom] = (self._tss[indices],indices)
+
+    @classmethod
+    def fromStartDict(cls,startDict,geneList=[]):
+        '''
+        indexes the tss of every gene in geneList, or of every gene in the startDict
+        '''
+        if len(geneList) == 0: geneList = startDict.keys()
+        return cls([makeTSSLocus(gene,startDict,0,0) for gene in geneList])
+
+    def __len__(self):
+        return len(self._IDs)
+
+    def getID(self,index):
+        return self._IDs[index]
+
+    def getTSS(self,index):
+        return int(self._tss[index])
+
+    def __queryArrays(self,lociList):
+        '''
+        groups query loci by indexed chromosome into (query indices, starts, ends) arrays
+        '''
+        if isinstance(lociList,LocusCollection): lociList = lociList.getLoci()
+        chrToQueries = defaultdict(list)
+        for i,locus in enumerate(lociList):
+            if self._chrToTSS.has_key(locus.chr()): chrToQueries[locus.chr()].append(i)
+        for chrom in chrToQueries:
+            qIndex = numpy.array(chrToQueries[chrom],dtype=numpy.int64)
+            qStarts = numpy.array([lociList[i].start() for i in qIndex],dtype=numpy.int64)
+            qEnds = numpy.array([lociList[i].end() for i in qIndex],dtype=numpy.int64)
+            yield chrom,qIndex,qStarts,qEnds
+
+    def within(self,lociList,window=0):
+        '''
+        finds every tss within window of the boundaries of each query locus
+        returns numpy arrays of query indices and tss indices, sorted by query then tss position
+        '''
+        queryIndices = [numpy.zeros(0,dtype=numpy.int64)]
+        tssIndices = [numpy.zeros(0,dtype=numpy.int64)]
+        for chrom,qIndex,qStarts,qEnds in self.__queryArrays(lociList):
+            tss,indices = self._chrToTSS[chrom]
+            lo = numpy.searchsorted(tss,qStarts - window,'left')
+            hi = numpy.searchsorted(tss,qEnds + window,'right')
+            counts = hi - lo
+            tPos = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts,counts) + numpy.repeat(lo,counts)
+            queryIndices.append(numpy.repeat(qIndex,counts))
+            tssIndices.append(indices[tPos])
+
+        queryIndices = numpy.concatenate(queryIndices)
+        tssIndices = numpy.concatenate(tssIndices)
+        pairOrder = numpy.argsort(queryIndices,kind='mergesort')
+        return queryIndices[pairOrder],tssIndices[pairOrder]
+
+    def nearest(self,lociList,k=1,window=None):
+        '''
+        finds the k tss closest to the center of each query locus. if window is given
+        only tss within window of the query boundaries are considered
+        returns (n,k) numpy arrays of tss indices and distances, closest first
+        and padded w/ -1 where a query has fewer than k tss
+        '''
+        if isinstance(lociList,LocusCollection): lociList = lociList.getLoci()
+        nearestIndices = numpy.zeros((len(lociList),k),dtype=numpy.int64) - 1
+        nearestDists = numpy.zeros((len(lociList),k),dtype=numpy.int64) - 1
+        for chrom,qIndex,qStarts,qEnds in self.__queryArrays(lociList):
+            tss,indices = self._chrToTSS[chrom]
+            centers = (qStarts + qEnds)//2
+
+            #the k nearest are always among the k tss on either side of the center
+            pos = numpy.searchsorted(tss,centers,'left')[:,None] + numpy.arange(-k,k)
+            valid = (pos >= 0) & (pos < len(tss))
+            pos = numpy.clip(pos,0,len(tss) - 1)
+            dists = numpy.abs(tss[pos] - centers[:,None])
+            if window is not None:
+                valid &= (tss[pos] >= (qStarts - window)[:,None]) & (tss[pos] <= (qEnds + window)[:,None])
+            dists[~valid] = numpy.iinfo(numpy.int64).max
+
+            rows = numpy.arange(len(qIndex))[:,None]
+            closest = numpy.argsort(dists,axis=1,kind='mergesort')[:,:k]
+            found = valid[rows,closest]
+            nearestIndices[qIndex] = numpy.where(found,indices[pos[rows,closest]],-1)
+            nearestDists[qIndex] = numpy.where(found,dists[rows,closest],-1)
+
+        return nearestIndices,nearestDists
+
+
+
 #==================================================================
 #========================GENE INSTANCE============================
 #==================================================================
@@ -1006,21 +2022,7 @@ def gffToLocusCollection(gff,window =500):
     opens up a gff file and turns it into a LocusCollection instance
     '''
 
-    lociList = []
-    if type(gff) == str:
-        gff = parseTable(gff,'\t')
-
-    for line in gff:
-        #USE line[1] as the locus ID.  If that is empty use line[8]
-        if len(line[1]) > 0:
-            name = line[1]
-        elif len(line[8]) >0:
-            name = line[8]
-        else:
-            name = '%s:%s:%s-%s' % (line[0],line[6],line[3],line[4])
-
-        lociList.append(Locus(line[0],line[3],line[4],line[6],name))
-    return LocusCollection(lociList,window)
+    return LocusTable.fromGFF(gff).toCollection(window)
 
 
 
@@ -1051,21 +2053,141 @@ def makeSECollection(enhancerFile,name,top=0):
     returns a locus collection from a super table
     top gives the number of rows
     '''
-    enhancerTable = parseTable(enhancerFile,'\t')
-    superLoci = []
+    return LocusTable.fromEnhancerTable(enhancerFile,name,top).toCollection(50)
 
-    ticker = 0
-    for line in enhancerTable:
-        if line[0][0] == '#' or line[0][0] == 'R':
-            continue
-        else:
-            ticker+=1
 
-            superLoci.append(Locus(line[1],line[2],line[3],'.',name+'_'+line[0]))
+def stitchStats(locusCollection,stitchWindows):
+    '''
+    gets the stats ROSE uses to pick a stitching parameter for every stitchWindow at once
+    overlapping loci are consolidated first, then each window is a cut of the same
+    sorted gaps between neighboring loci
+    returns one row per window: [STEP,NUM_REGIONS,TOTAL_CONSTIT,TOTAL_REGION,
+    MEAN_CONSTIT,MEDIAN_CONSTIT,MEAN_REGION,MEDIAN_REGION,MEAN_STITCH_FRACTION,MEDIAN_STITCH_FRACTION]
+    '''
+    consolidatedCollection = locusCollection.stitchCollection(stitchWindow=0)
+    chrToCoords = defaultdict(list)
+    for locus in consolidatedCollection.getLoci():
+        chrToCoords[locus.chr()].append([locus.start(),locus.end()])
+
+    coords = []
+    chromStarts = []
+    for chrom in chrToCoords:
+        chromStarts.append(len(coords))
+        coords += sorted(chrToCoords[chrom])
+    coords = numpy.array(coords,dtype=numpy.int64).reshape(-1,2)
+    starts = coords[:,0]
+    ends = coords[:,1]
+    nLoci = len(starts)
+
+    #consolidated loci don't overlap, so a stitched region's constituent size
+    #is just the summed length of the loci it covers
+    cumLengths = numpy.concatenate(([0],numpy.cumsum(ends - starts + 1)))
+    totalConstit = int(cumLengths[-1])
+    gaps = starts[1:] - ends[:-1]
+    isChromStart = numpy.zeros(nLoci,dtype=bool)
+    isChromStart[chromStarts] = True
+
+    statsTable = []
+    for step in stitchWindows:
+        #a gap closes once the step reaches it
+        isFirst = isChromStart.copy()
+        isFirst[1:] |= gaps > step
+        isLast = numpy.append(isFirst[1:],True)[:nLoci]
+        firsts = numpy.flatnonzero(isFirst)
+        lasts = numpy.flatnonzero(isLast)
+
+        regionLengths = ends[lasts] - starts[firsts] + 1
+        constitLengths = cumLengths[lasts+1] - cumLengths[firsts]
+        stitchFractions = constitLengths.astype(float)/regionLengths
+
+        statsTable.append([step,len(firsts),totalConstit,int(regionLengths.sum()),
+                           round(numpy.mean(constitLengths),2),round(numpy.median(constitLengths),2),
+                           round(numpy.mean(regionLengths),2),round(numpy.median(regionLengths),2),
+                           round(numpy.mean(stitchFractions),2),round(numpy.median(stitchFractions),2)])
+    return statsTable
+
+
+def overlapJoin(queryLoci,targetLoci,mode='overlap',sense='sense'):
+    '''
+    finds every query/target pair where the target overlaps the query (mode='overlap'),
+    is contained by it (mode='contained') or contains it (mode='containers')
+    matches the same loci as LocusCollection.getOverlap/getContained/getContainers
+    query and target can be lists of loci or LocusCollections (indexed in getLoci order)
+    returns numpy arrays of query indices and target indices, sorted by query
+    '''
+    if ['overlap','contained','containers'].count(mode)!=1:
+        raise ValueError("mode command invalid: '"+mode+"'.")
+    sense = sense.lower()
+    if ['sense','antisense','both'].count(sense)!=1:
+        raise ValueError("sense command invalid: '"+sense+"'.")
+
+    if isinstance(queryLoci,LocusCollection): queryLoci = queryLoci.getLoci()
+    if isinstance(targetLoci,LocusCollection): targetLoci = targetLoci.getLoci()
+
+    strandCodes = {'+':1,'-':-1,'.':0}
+    chrToTargets = defaultdict(list)
+    for i,locus in enumerate(targetLoci): chrToTargets[locus.chr()].append(i)
+    chrToQueries = defaultdict(list)
+    for i,locus in enumerate(queryLoci): chrToQueries[locus.chr()].append(i)
+
+    queryIndices = [numpy.zeros(0,dtype=numpy.int64)]
+    targetIndices = [numpy.zeros(0,dtype=numpy.int64)]
+    for chrom in chrToQueries:
+        if not chrToTargets.has_key(chrom): continue
+
+        tIndex = numpy.array(chrToTargets[chrom],dtype=numpy.int64)
+        tStarts = numpy.array([targetLoci[i].start() for i in tIndex],dtype=numpy.int64)
+        tEnds = numpy.array([targetLoci[i].end() for i in tIndex],dtype=numpy.int64)
+        tStrands = numpy.array([strandCodes[targetLoci[i].sense()] for i in tIndex])
+
+        qIndex = numpy.array(chrToQueries[chrom],dtype=numpy.int64)
+        qStarts = numpy.array([queryLoci[i].start() for i in qIndex],dtype=numpy.int64)
+        qEnds = numpy.array([queryLoci[i].end() for i in qIndex],dtype=numpy.int64)
+        qStrands = numpy.array([strandCodes[queryLoci[i].sense()] for i in qIndex])
+
+        #only overlapping pairs are ever built, so memory follows the number of overlaps
+        qPos,tPos = IntervalIndex(tStarts,tEnds).query(qStarts,qEnds)
+
+        keep = numpy.ones(len(qPos),dtype=bool)
+        if mode == 'contained':
+            keep &= (tStarts[tPos] >= qStarts[qPos]) & (tEnds[tPos] <= qEnds[qPos])
+        elif mode == 'containers':
+            keep &= (tStarts[tPos] <= qStarts[qPos]) & (tEnds[tPos] >= qEnds[qPos])
+        if sense != 'both':
+            strandMatch = (tStrands[tPos] == 0) | (qStrands[qPos] == 0)
+            if sense == 'sense':
+                keep &= strandMatch | (tStrands[tPos] == qStrands[qPos])
+            else:
+                keep &= strandMatch | (tStrands[tPos] != qStrands[qPos])
 
-            if ticker == top:
-                break
-    return LocusCollection(superLoci,50)
+        queryIndices.append(qIndex[qPos[keep]])
+        targetIndices.append(tIndex[tPos[keep]])
+
+    queryIndices = numpy.concatenate(queryIndices)
+    targetIndices = numpy.concatenate(targetIndices)
+    pairOrder = numpy.lexsort((targetIndices,queryIndices))
+    return queryIndices[pairOrder],targetIndices[pairOrder]
+
+
+def overlapSum(queryLoci,targetLoci,values=None,mode='overlap',sense='sense'):
+    '''
+    for each query locus sums a value over the target loci matched by overlapJoin
+    values can be None to count targets, 'len' or 'score' to sum those locus
+    attributes, or a list with one value per target
+    returns a numpy array with one entry per query
+    '''
+    if isinstance(queryLoci,LocusCollection): queryLoci = queryLoci.getLoci()
+    if isinstance(targetLoci,LocusCollection): targetLoci = targetLoci.getLoci()
+
+    queryIndices,targetIndices = overlapJoin(queryLoci,targetLoci,mode,sense)
+    if values is None:
+        return numpy.bincount(queryIndices,minlength=len(queryLoci))
+    if isinstance(values,str) and values == 'len':
+        values = [locus.len() for locus in targetLoci]
+    elif isinstance(values,str) and values == 'score':
+        values = [locus.score() for locus in targetLoci]
+    values = numpy.asarray(values,dtype=float)
+    return numpy.bincount(queryIndices,weights=values[targetIndices],minlength=len(queryLoci))
 
 
 #==================================================================
@@ -1081,23 +2203,756 @@ def convertBitwiseFlag(flag):
     else:
         return "+";
 
+
+#which backend Bam uses to pull reads: 'pysam', 'native' (the BGZF/BAI reader
+#below), 'samtools' (a samtools view subprocess per locus) or None to take the
+#first of those that works for the bam
+BAM_BACKEND = None
+
+#reads come back from every backend as a record array w/ one row per alignment
+#pos is the 1-based leftmost position and end the 1-based last reference base covered
+#seq is the read sequence as a string and nJunctions the number of N ops in the cigar
+#mpos is the 1-based position of the mate, 0 if there isn't one
+bamReadDtype = numpy.dtype([('pos',numpy.int64),('end',numpy.int64),('flag',numpy.int32),('strand','S1'),
+                            ('mapq',numpy.int32),('length',numpy.int32),('nJunctions',numpy.int32),
+                            ('name',object),('cigar',object),('seq',object),('mpos',numpy.int64)])
+
+def makeReadArray(rows):
+    '''
+    makes a read record array from a list of (pos,end,flag,strand,mapq,length,nJunctions,name,cigar,seq,mpos) tuples
+    '''
+    if len(rows) == 0:
+        return numpy.zeros(0,dtype=bamReadDtype)
+    return numpy.array(rows,dtype=bamReadDtype)
+
+
+def findBamIndex(bamFile):
+    '''
+    returns the path of the .bai for a bam (foo.bam.bai or foo.bai) or '' if there isn't one
+    '''
+    indexFiles = [bamFile + '.bai']
+    if bamFile.endswith('.bam'):
+        indexFiles.append(bamFile[:-4] + '.bai')
+    for indexFile in indexFiles:
+        if os.path.isfile(indexFile):
+            return indexFile
+    return ''
+
+
+#BgzfReader
+#random access into a BGZF file using the virtual offsets that bam indexes store:
+#the compressed offset of a block << 16 | the offset into the decompressed block
+class BgzfReader(object):
+    '''
+    reads BGZF compressed data from a file, seek and tell take virtual offsets
+    recently decompressed blocks are cached so nearby seeks don't decompress them again
+    '''
+    maxCachedBlocks = 64
+
+    def __init__(self,fileName):
+        self._fh = bopen(fileName,'rb')
+        self._blockCache = {}
+        #how many blocks have been decompressed, counting each time a block is re-read
+        self.blocksRead = 0
+        self._coffset = 0
+        self._block = ''
+        self._nextCoffset = 0
+        self._within = 0
+        self.seek(0)
+
+    def getBlock(self,coffset):
+        '''
+        the decompressed block starting at a compressed offset and the offset of the next block
+        '''
+        if coffset in self._blockCache:
+            return self._blockCache[coffset]
+        self._fh.seek(coffset)
+        header = self._fh.read(18)
+        if len(header) < 18:
+            block = ('',coffset)
+        else:
+            if header[0:4] != '\x1f\x8b\x08\x04':
+                raise IOError('not a BGZF block at offset %s' % (coffset))
+            blockSize = struct.unpack('<H',header[16:18])[0] + 1
+            data = self._fh.read(blockSize - 18)
+            block = (zlib.decompress(data[:-8],-15),coffset + blockSize)
+            self.blocksRead += 1
+        if len(self._blockCache) >= self.maxCachedBlocks:
+            self._blockCache.clear()
+        self._blockCache[coffset] = block
+        return block
+
+    def seek(self,virtualOffset):
+        self._coffset = virtualOffset >> 16
+        self._within = virtualOffset & 0xffff
+        self._block,self._nextCoffset = self.getBlock(self._coffset)
+
+    def tell(self):
+        #the end of one block and the start of the next are the same place
+        if self._within >= len(self._block) and len(self._block) > 0:
+            return self._nextCoffset << 16
+        return (self._coffset << 16) | self._within
+
+    def read(self,n):
+        pieces = []
+        while n > 0:
+            if self._within >= len(self._block):
+                if len(self._block) == 0:
+                    break
+                self.seek(self._nextCoffset << 16)
+                continue
+            piece = self._block[self._within:self._within + n]
+            self._within += len(piece)
+            n -= len(piece)
+            pieces.append(piece)
+        return ''.join(pieces)
+
+    def close(self):
+        self._fh.close()
+
+
+def reg2bins(beg,end):
+    '''
+    the bam index bins that can hold reads overlapping the 0-based half open region [beg,end)
+    '''
+    end -= 1
+    bins = [0]
+    for shift,offset in [(26,1),(23,9),(20,73),(17,585),(14,4681)]:
+        bins.extend(range(offset + (beg >> shift),offset + (end >> shift) + 1))
+    return bins
+
+
+#NativeBamReader
+#reads a sorted, indexed bam directly: the header and .bai are parsed once and
+#each region is a few seeks into the file instead of a samtools process
+class NativeBamReader(object):
+    '''
+    pulls reads from a bam using its .bai index w/o samtools or pysam
+    '''
+    cigarOps = 'MIDNSHP=X'
+    #the fixed length part of a bam record after its block size
+    coreDtype = numpy.dtype([('refID','<i4'),('pos','<i4'),('lName','u1'),('mapq','u1'),('bin','<u2'),('nCigar','<u2'),
+                             ('flag','<u2'),('lSeq','<i4'),('nextRefID','<i4'),('nextPos','<i4'),('tlen','<i4')])
+    seqCodes = numpy.array(list('=ACMGRSVTWYHKDBN'))
+
+    def __init__(self,bamFile,indexFile=''):
+        self._bam = bamFile
+        self._bgzf = BgzfReader(bamFile)
+        self.__readHeader()
+        self.__readIndex(indexFile if indexFile else findBamIndex(bamFile))
+
+    def __readHeader(self):
+        if self._bgzf.read(4) != 'BAM\x01':
+            raise IOError('%s is not a bam file' % (self._bam))
+        textLength = struct.unpack('<i',self._bgzf.read(4))[0]
+        self._headerText = self._bgzf.read(textLength).rstrip('\x00')
+        nRef = struct.unpack('<i',self._bgzf.read(4))[0]
+        self._chroms = []
+        self._chromLengths = []
+        for i in range(nRef):
+            nameLength = struct.unpack('<i',self._bgzf.read(4))[0]
+            self._chroms.append(self._bgzf.read(nameLength).rstrip('\x00'))
+            self._chromLengths.append(struct.unpack('<i',self._bgzf.read(4))[0])
+        self._refIDs = dict([(chrom,i) for i,chrom in enumerate(self._chroms)])
+
+    def __readIndex(self,indexFile):
+        if not indexFile:
+            raise IOError('no index found for %s' % (self._bam))
+        data = bopen(indexFile).read()
+        if data[0:4] != 'BAI\x01':
+            raise IOError('%s is not a bam index' % (indexFile))
+        nRef = struct.unpack_from('<i',data,4)[0]
+        offset = 8
+        #per reference a dict of bin -> (n,2) chunk array and the 16kb linear index
+        self._bins = []
+        self._linearIndex = []
+        #samtools index writes mapped/unmapped read counts for each reference into a pseudo bin
+        self._readCounts = []
+        for i in range(nRef):
+            nBin = struct.unpack_from('<i',data,offset)[0]
+            offset += 4
+            bins = {}
+            for j in range(nBin):
+                binID,nChunk = struct.unpack_from('<Ii',data,offset)
+                offset += 8
+                bins[binID] = numpy.frombuffer(data,dtype='<u8',count=2*nChunk,offset=offset).reshape(nChunk,2)
+                offset += 16*nChunk
+            nIntv = struct.unpack_from('<i',data,offset)[0]
+            offset += 4
+            if 37450 in bins:
+                self._readCounts.append([int(x) for x in bins.pop(37450)[1]])
+            else:
+                self._readCounts.append(None if nBin > 0 else [0,0])
+            self._bins.append(bins)
+            self._linearIndex.append(numpy.frombuffer(data,dtype='<u8',count=nIntv,offset=offset))
+            offset += 8*nIntv
+        #reads w/o a position are counted at the end of the index
+        self._unplacedReads = struct.unpack_from('<Q',data,offset)[0] if offset + 8 <= len(data) else 0
+
+    def getChromList(self):
+        return list(self._chroms)
+
+    def getChromLengths(self):
+        return dict(zip(self._chroms,self._chromLengths))
+
+    def getIndexStats(self):
+        '''
+        samtools idxstats from the index: ([[chrom,length,mapped,unmapped],...],unplaced reads)
+        or None if the index doesn't have read counts
+        '''
+        if self._readCounts.count(None) > 0:
+            return None
+        return [[chrom,length] + counts for chrom,length,counts in zip(self._chroms,self._chromLengths,self._readCounts)],self._unplacedReads
+
+    def getChunks(self,chrom,start,end):
+        '''
+        the merged, sorted (begin,end) virtual offset chunks that can hold reads
+        overlapping the 1-based inclusive region chrom:start-end
+        '''
+        if chrom not in self._refIDs:
+            return []
+        refID = self._refIDs[chrom]
+        beg = max(start - 1,0)
+        bins = self._bins[refID]
+        chunks = [bins[binID] for binID in reg2bins(beg,max(end,beg + 1)) if binID in bins]
+        if len(chunks) == 0:
+            return []
+        chunks = numpy.concatenate(chunks)
+        #nothing overlapping the region starts before the linear index offset of its first 16kb window
+        linearIndex = self._linearIndex[refID]
+        if (beg >> 14) < len(linearIndex):
+            minOffset = linearIndex[beg >> 14]
+            chunks = chunks[chunks[:,1] > minOffset]
+            chunks[:,0] = numpy.maximum(chunks[:,0],minOffset)
+        chunks = chunks[numpy.argsort(chunks[:,0],kind='mergesort')]
+        merged = []
+        for chunkStart,chunkEnd in chunks.tolist():
+            #like samtools, chunks that start in the block the last one ends in are read together
+            if len(merged) > 0 and chunkStart >> 16 <= merged[-1][1] >> 16:
+                merged[-1][1] = max(merged[-1][1],chunkEnd)
+            else:
+                merged.append([chunkStart,chunkEnd])
+        return merged
+
+    def readChunks(self,chunks,refID,beg,end):
+        '''
+        the reads in the virtual offset chunks overlapping the 0-based half open region [beg,end)
+        of refID as (pos,end,flag,mapq,lSeq,nJunctions,name,cigar,packedSeq,mpos) tuples
+        '''
+        rows = []
+        pastRegion = False
+        for chunkStart,chunkEnd in chunks:
+            #chunks are in file order, so once a record is past the region so is everything after it
+            if pastRegion:
+                break
+            #walk the chunk a block at a time, parsing the records that are complete in the buffer
+            coffset = chunkStart >> 16
+            buffer = ''
+            done = False
+            while not done:
+                block,nextCoffset = self._bgzf.getBlock(coffset)
+                if coffset == chunkEnd >> 16 or len(block) == 0:
+                    block = block[:chunkEnd & 0xffff]
+                    done = True
+                if coffset == chunkStart >> 16:
+                    block = block[chunkStart & 0xffff:]
+                buffer += block
+                coffset = nextCoffset
+
+                offsets = []
+                offset = 0
+                while offset + 4 <= len(buffer):
+                    recordEnd = offset + 4 + struct.unpack_from('<i',buffer,offset)[0]
+                    if recordEnd > len(buffer):
+                        break
+                    offsets.append(offset)
+                    offset = recordEnd
+                if len(offsets) > 0 and self.parseRecords(buffer,offsets,refID,beg,end,rows):
+                    pastRegion = done = True
+                buffer = buffer[offset:]
+        return rows
+
+    def parseRecords(self,buffer,offsets,refID,beg,end,rows):
+        '''
+        appends the records starting at offsets in buffer that overlap [beg,end) of refID to rows
+        returns True if any record is past the region
+        '''
+        data = numpy.frombuffer(buffer,dtype=numpy.uint8)
+        offsets = numpy.array(offsets,dtype=numpy.int64)
+        core = data[offsets[:,None] + numpy.arange(4,36)].view(self.coreDtype).ravel()
+        nCigar = core['nCigar'].astype(numpy.int64)
+        cigarStarts = offsets + 36 + core['lName']
+
+        #every cigar op of every record, w/ the record it belongs to
+        readIndex = numpy.repeat(numpy.arange(len(offsets)),nCigar)
+        opIndex = numpy.arange(len(readIndex)) - numpy.repeat(numpy.cumsum(nCigar) - nCigar,nCigar)
+        ops = data[(cigarStarts[readIndex] + 4*opIndex)[:,None] + numpy.arange(4)].view('<u4').ravel()
+        opLengths = ops >> 4
+        opTypes = ops & 15
+        refLengths = numpy.bincount(readIndex,weights=opLengths*((0x18d >> opTypes) & 1),minlength=len(offsets)).astype(numpy.int64)
+        nJunctions = numpy.bincount(readIndex,weights=opTypes == 3,minlength=len(offsets)).astype(numpy.int64)
+
+        pos = core['pos'].astype(numpy.int64)
+        readEnds = pos + numpy.maximum(refLengths,1)
+        pastRegion = (core['refID'] != refID) | (pos >= end)
+        cigarOps = self.cigarOps
+        opStarts = numpy.cumsum(nCigar) - nCigar
+        opLengths = opLengths.tolist()
+        opTypes = opTypes.tolist()
+        for i in numpy.nonzero(~pastRegion & (readEnds > beg))[0].tolist():
+            n = int(nCigar[i])
+            opStart = int(opStarts[i])
+            cigarString = ''.join(['%s%s' % (opLengths[j],cigarOps[opTypes[j]]) for j in range(opStart,opStart + n)]) if n > 0 else '*'
+            seqStart = int(cigarStarts[i]) + 4*n
+            lSeq = int(core['lSeq'][i])
+            rows.append((int(pos[i]) + 1,int(readEnds[i]),int(core['flag'][i]),int(core['mapq'][i]),lSeq,int(nJunctions[i]),
+                         buffer[int(offsets[i]) + 36:int(cigarStarts[i]) - 1],cigarString,buffer[seqStart:seqStart + (lSeq + 1)/2],
+                         int(core['nextPos'][i]) + 1))
+        return pastRegion.any()
+
+    def decodeSeqs(self,rows):
+        '''
+        decodes the 4 bit packed sequences of rows from readChunks in one go
+        '''
+        packed = ''.join([row[8] for row in rows])
+        codes = numpy.frombuffer(packed,dtype=numpy.uint8)
+        bases = numpy.empty(2*len(codes),dtype=numpy.uint8)
+        bases[0::2] = codes >> 4
+        bases[1::2] = codes & 15
+        seqString = self.seqCodes[bases].tostring() if len(bases) > 0 else ''
+        seqs = []
+        offset = 0
+        for row in rows:
+            seqs.append(seqString[offset:offset + row[4]] if row[4] > 0 else '*')
+            offset += 2*len(row[8])
+        return seqs
+
+    def fetch(self,chrom,start,end):
+        '''
+        the reads overlapping the 1-based inclusive region chrom:start-end as a read array
+        '''
+        chunks = self.getChunks(chrom,start,end)
+        if len(chunks) == 0:
+            return makeReadArray([])
+        rows = self.readChunks(chunks,self._refIDs[chrom],max(start - 1,0),end)
+        seqs = self.decodeSeqs(rows)
+        return makeReadArray([(row[0],row[1],row[2],'-' if row[2] & 16 else '+',row[3],row[4],row[5],row[6],row[7],seq,row[9])
+                              for row,seq in zip(rows,seqs)])
+
+    def close(self):
+        self._bgzf.close()
+
+
+#PysamBamReader
+#the same interface as NativeBamReader on top of pysam when it's installed
+class PysamBamReader(object):
+    '''
+    pulls reads from an indexed bam w/ pysam
+    '''
+    def __init__(self,bamFile):
+        import pysam
+        self._bam = bamFile
+        self._alignmentFile = pysam.AlignmentFile(bamFile,'rb')
+
+    def getChromList(self):
+        return list(self._alignmentFile.references)
+
+    def getChromLengths(self):
+        return dict(zip(self._alignmentFile.references,self._alignmentFile.lengths))
+
+    def getIndexStats(self):
+        try:
+            counts = dict([(stat.contig,[stat.mapped,stat.unmapped]) for stat in self._alignmentFile.get_index_statistics()])
+        except (ValueError,OSError):
+            return None
+        chroms = [[chrom,length] + counts.get(chrom,[0,0]) for chrom,length in zip(self._alignmentFile.references,self._alignmentFile.lengths)]
+        return chroms,self._alignmentFile.nocoordinate
+
+    def fetch(self,chrom,start,end):
+        if chrom not in self._alignmentFile.references:
+            return makeReadArray([])
+        rows = []
+        for read in self._alignmentFile.fetch(chrom,max(start - 1,0),end):
+            cigar = read.cigartuples or []
+            seq = read.query_sequence or '*'
+            readEnd = read.reference_end if read.reference_end is not None else read.reference_start + 1
+            rows.append((read.reference_start + 1,readEnd,read.flag,'-' if read.flag & 16 else '+',read.mapping_quality,
+                         len(seq) if seq != '*' else 0,len([op for op,length in cigar if op == 3]),
+                         read.query_name,read.cigarstring or '*',seq,read.next_reference_start + 1))
+        return makeReadArray(rows)
+
+    def close(self):
+        self._alignmentFile.close()
+
+
+#SamtoolsBamReader
+#the original samtools view per locus, for bams w/o an index this can read
+class SamtoolsBamReader(object):
+    '''
+    pulls reads from a bam by running samtools view for each region
+    '''
+    def __init__(self,bamFile):
+        self._bam = bamFile
+
+    def getChromList(self):
+        command = '%s view -H %s' % (samtoolsString,self._bam)
+        header = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
+        headerLines = header.communicate()[0].split('\n')
+        return [line.split('\t')[1][3:] for line in headerLines if line.startswith('@SQ')]
+
+    def getChromLengths(self):
+        command = '%s view -H %s' % (samtoolsString,self._bam)
+        header = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
+        fields = [dict([field.split(':',1) for field in line.split('\t')[1:] if field.count(':') > 0])
+                  for line in header.communicate()[0].split('\n') if line.startswith('@SQ')]
+        return dict([(field['SN'],int(field['LN'])) for field in fields])
+
+    def getIndexStats(self):
+        command = '%s idxstats %s' % (samtoolsString,self._bam)
+        idxStats = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
+        idxLines = [line.split('\t') for line in idxStats.communicate()[0].split('\n')[:-1]]
+        if len(idxLines) == 0 or idxLines[-1][0] != '*':
+            return None
+        return [[line[0],int(line[1]),int(line[2]),int(line[3])] for line in idxLines[:-1]],int(idxLines[-1][3])
+
+    def viewLines(self,chrom,start,end,printCommand=False):
+        '''
+        the samtools view lines for a region, split on tabs
+        '''
+        locusLine = chrom+':'+str(start)+'-'+str(end)
+        command = '%s view %s %s' % (samtoolsString,self._bam,locusLine)
+        if printCommand:
+            print(command)
+        getReads = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
+        reads = getReads.communicate()
+        reads = reads[0].split('\n')[:-1]
+        return [read.split('\t') for read in reads]
+
+    def fetch(self,chrom,start,end):
+        return self.linesToReadArray(self.viewLines(chrom,start,end))
+
+    def linesToReadArray(self,lines):
+        '''
+        a read array from split samtools view lines
+        '''
+        rows = []
+        for read in lines:
+            pos = int(read[3])
+            cigar = re.findall('(\d+)([MIDNSHP=X])',read[5])
+            refLength = sum([int(length) for length,op in cigar if op in 'MDN=X'])
+            flag = int(read[1])
+            rows.append((pos,pos + max(refLength,1) - 1,flag,convertBitwiseFlag(flag),int(read[4]),
+                         len(read[9]) if read[9] != '*' else 0,read[5].count('N'),read[0],read[5],read[9],int(read[7])))
+        return makeReadArray(rows)
+
+    def close(self):
+        pass
+
+
+def openBamReader(bamFile,backend=None):
+    '''
+    opens a reader for a bam w/ the given backend ('pysam','native','samtools')
+    w/ no backend (and BAM_BACKEND unset) uses pysam if it's installed, then the
+    native reader if the bam is indexed, then samtools
+    '''
+    backend = backend or BAM_BACKEND
+    if backend == 'pysam':
+        return PysamBamReader(bamFile)
+    if backend == 'native':
+        return NativeBamReader(bamFile)
+    if backend == 'samtools':
+        return SamtoolsBamReader(bamFile)
+    if backend is not None:
+        raise ValueError("bam backend invalid: '"+backend+"'.")
+    try:
+        return PysamBamReader(bamFile)
+    except ImportError:
+        pass
+    if findBamIndex(bamFile):
+        return NativeBamReader(bamFile)
+    return SamtoolsBamReader(bamFile)
+
+
+#BAM_STATS_CACHE
+#read counts for each bam are kept in one sqlite file, keyed on the bam's path, size
+#and mtime, so idxstats numbers are only worked out once per version of a bam
+BAM_STATS_CACHE = '%s/bam_stats_cache.sqlite' % tempfile.gettempdir()
+
+def countChromReads(reader,windowSize=1000000):
+    '''
+    idxstats rows [chrom,length,mapped,unmapped] counted by reading through the bam a window at a time,
+    for indexes w/o read counts. each read is counted in the window its position is in
+    '''
+    chromLengths = reader.getChromLengths()
+    chroms = []
+    for chrom in reader.getChromList():
+        length = chromLengths[chrom]
+        mapped,unmapped = 0,0
+        for start in range(1,length + 1,windowSize):
+            end = start + windowSize - 1
+            reads = reader.fetch(chrom,start,end)
+            inWindow = reads['pos'] >= start
+            #reads hanging off the end of the chromosome go in its last window
+            if end < length:
+                inWindow &= reads['pos'] <= end
+            unmappedReads = int(((reads['flag'][inWindow] & 4) != 0).sum())
+            mapped += int(inWindow.sum()) - unmappedReads
+            unmapped += unmappedReads
+        chroms.append([chrom,length,mapped,unmapped])
+    return chroms
+
+
+def computeBamStats(bamFile):
+    '''
+    mapped and total reads for a bam plus its idxstats: chroms is a list of [chrom,length,mapped,unmapped]
+    and unplaced the reads w/o a position. uses the index when it has read counts, otherwise samtools idxstats,
+    otherwise counts the reads of each chromosome (w/o the unplaced reads)
+    '''
+    reader = openBamReader(bamFile)
+    indexStats = reader.getIndexStats()
+    if indexStats is None and not isinstance(reader,SamtoolsBamReader):
+        indexStats = SamtoolsBamReader(bamFile).getIndexStats()
+    if indexStats is None:
+        indexStats = countChromReads(reader),0
+    reader.close()
+    chroms,unplaced = indexStats
+    mapped = sum([line[2] for line in chroms])
+    return {'mapped':mapped,'total':mapped + sum([line[3] for line in chroms]) + unplaced,'chroms':chroms,'unplaced':unplaced}
+
+
+def cachedBamValue(bamFile,table,compute):
+    '''
+    compute(bamFile), looked up in table of BAM_STATS_CACHE first and stored there (as json) when it's worked out
+    '''
+    fileStat = os.stat(bamFile)
+    key = (os.path.abspath(bamFile),fileStat.st_size,fileStat.st_mtime)
+    try:
+        connection = sqlite3.connect(BAM_STATS_CACHE,timeout=60)
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, stats TEXT)' % (table))
+        row = connection.execute('SELECT stats FROM %s WHERE path = ? AND size = ? AND mtime = ?' % (table),key).fetchone()
+    except sqlite3.Error as e:
+        print('WARNING: could not read bam stats cache %s: %s' % (BAM_STATS_CACHE,e))
+        return compute(bamFile)
+    if row is not None:
+        connection.close()
+        return json.loads(row[0])
+
+    value = compute(bamFile)
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO %s VALUES (?,?,?,?)' % (table),key + (json.dumps(value),))
+    except sqlite3.Error as e:
+        print('WARNING: could not write bam stats cache %s: %s' % (BAM_STATS_CACHE,e))
+    connection.close()
+    return value
+
+
+def getBamStats(bamFile,useCache=True):
+    '''
+    computeBamStats for a bam, looked up in BAM_STATS_CACHE first and stored there when it's worked out
+    '''
+    if not useCache:
+        return computeBamStats(bamFile)
+    stats = cachedBamValue(bamFile,'bam_stats',computeBamStats)
+    stats['chroms'] = [[str(line[0])] + line[1:] for line in stats['chroms']]
+    return stats
+
+
+def countUniqueReads(bamFile,backend=None,windowSize=1000000):
+    '''
+    mapped reads in a bam once duplicates are collapsed by position (see markPositionDuplicates)
+    reads the bam once, a window at a time. each read is counted in the window its 5' end is in,
+    so duplicates always land in the same window
+    '''
+    reader = openBamReader(bamFile,backend)
+    chromLengths = reader.getChromLengths()
+    count = 0
+    for chrom in reader.getChromList():
+        length = chromLengths[chrom]
+        for start in range(1,length + 1,windowSize):
+            end = start + windowSize - 1
+            reads = reader.fetch(chrom,start,end)
+            reads = reads[(reads['flag'] & 4) == 0]
+            fivePrime = numpy.where(reads['strand'] == '-',reads['end'],reads['pos'])
+            #reads hanging off the end of the chromosome go in its last window
+            inWindow = fivePrime >= start
+            if end < length:
+                inWindow &= fivePrime <= end
+            reads = reads[inWindow]
+            count += len(reads) - int(markPositionDuplicates(reads).sum())
+    reader.close()
+    return count
+
+
+def getUniqueReadCount(bamFile,useCache=True):
+    '''
+    countUniqueReads for a bam, cached in BAM_STATS_CACHE like getBamStats
+    '''
+    if not useCache:
+        return countUniqueReads(bamFile)
+    return cachedBamValue(bamFile,'unique_reads',countUniqueReads)
+
+
+def getBamIdxStats(bamFile):
+    '''
+    a bam's cached idxstats rows, [chrom,length,mapped,unmapped]
+    '''
+    return getBamStats(bamFile)['chroms']
+
+
+def getBamChromList(bamFile):
+    '''
+    the chromosomes in a bam's idxstats, in order
+    '''
+    return [line[0] for line in getBamIdxStats(bamFile)]
+
+
+def intervalCoverage(starts,ends,regionStart,regionEnd):
+    '''
+    per base coverage of regionStart to regionEnd (inclusive) by intervals covering starts to ends (inclusive)
+    intervals add 1 where they start and take it away after they end, so one cumsum gives the coverage
+    '''
+    length = regionEnd - regionStart + 1
+    starts = numpy.clip(numpy.asarray(starts) - regionStart,0,length)
+    ends = numpy.clip(numpy.asarray(ends) - regionStart + 1,0,length)
+    changes = numpy.bincount(starts,minlength=length + 1) - numpy.bincount(ends,minlength=length + 1)
+    return numpy.cumsum(changes[:length])
+
+
+def markPositionDuplicates(reads):
+    '''
+    bool array that's True for every read after the first w/ the same 5' position, strand and
+    mate position (for paired reads), like samtools rmdup/picard. reads are from one chromosome
+    '''
+    minus = reads['strand'] == '-'
+    fivePrime = numpy.where(minus,reads['end'],reads['pos'])
+    matePos = numpy.where(reads['flag'] & 1,reads['mpos'],0)
+    #lexsort is stable, so the first read of each run of equal keys is the first in the array
+    order = numpy.lexsort((matePos,minus,fivePrime))
+    same = ((fivePrime[order][1:] == fivePrime[order][:-1]) & (minus[order][1:] == minus[order][:-1]) &
+            (matePos[order][1:] == matePos[order][:-1]))
+    duplicates = numpy.zeros(len(reads),dtype=bool)
+    duplicates[order[1:][same]] = True
+    return duplicates
+
+
+#cigar op characters in the order of their bam codes, w/ masks of the codes that consume reference and read bases
+cigarOpTypes = numpy.zeros(256,dtype=numpy.int64) - 1
+cigarOpTypes[numpy.frombuffer('MIDNSHP=X',dtype=numpy.uint8)] = numpy.arange(9)
+CIGAR_REF_OPS = 0x18d
+CIGAR_QUERY_OPS = 0x193
+
+def cigarBlocks(cigars,positions,lengths):
+    '''
+    the aligned blocks of reads, splitting each read at its N (junction) ops, for all of the reads at once
+    returns (readIndex,starts,ends,queryStarts) w/ a row per block in read order: the read it's from,
+    its first reference base, that plus the reference bases it covers (the end readsToLoci has always used)
+    and where it starts in the read sequence (0 for the first block, so leading clips stay w/ it)
+    reads w/o a cigar ('*') are one block of lengths bases
+    '''
+    cigars = list(cigars)
+    positions = numpy.asarray(positions,dtype=numpy.int64)
+    nReads = len(cigars)
+    text = numpy.frombuffer(''.join(cigars),dtype=numpy.uint8)
+    cigarEnds = numpy.cumsum([len(cigar) for cigar in cigars],dtype=numpy.int64)
+
+    #every op w/ the read it's in, its length read off the digits before it
+    isDigit = (text >= 48) & (text <= 57)
+    opAt = numpy.nonzero(~isDigit & (text != ord('*')))[0]
+    opTypes = cigarOpTypes[text[opAt]]
+    if (opTypes < 0).any():
+        raise ValueError('bad cigar op in %s' % (cigars[numpy.searchsorted(cigarEnds,opAt[opTypes < 0][0],'right')]))
+    opRead = numpy.searchsorted(cigarEnds,opAt,'right')
+    digitAt = numpy.nonzero(isDigit)[0]
+    digitOp = numpy.searchsorted(opAt,digitAt)
+    digitValues = (text[digitAt] - 48).astype(numpy.int64)*10**(opAt[digitOp] - digitAt - 1)
+    opLengths = numpy.bincount(digitOp,weights=digitValues,minlength=len(opAt)).astype(numpy.int64)
+
+    #reference and read bases used by the ops before each op of a read
+    refLengths = opLengths*((CIGAR_REF_OPS >> opTypes) & 1)
+    queryLengths = opLengths*((CIGAR_QUERY_OPS >> opTypes) & 1)
+    opsPerRead = numpy.bincount(opRead,minlength=nReads)
+    firstOp = numpy.repeat(numpy.cumsum(opsPerRead) - opsPerRead,opsPerRead)
+    refBefore = numpy.cumsum(refLengths) - refLengths
+    refBefore -= refBefore[firstOp]
+    queryBefore = numpy.cumsum(queryLengths) - queryLengths
+    queryBefore -= queryBefore[firstOp]
+
+    #each N op ends a block, reads w/o ops are a block of their own
+    isJunction = opTypes == 3
+    junctions = numpy.cumsum(isJunction)
+    junctionsBefore = junctions - junctions[firstOp] + isJunction[firstOp]
+    blocksPerRead = numpy.bincount(opRead,weights=isJunction,minlength=nReads).astype(numpy.int64) + 1
+    blockOffsets = numpy.cumsum(blocksPerRead) - blocksPerRead
+    nBlocks = int(blocksPerRead.sum())
+    readIndex = numpy.repeat(numpy.arange(nReads),blocksPerRead)
+    starts = positions[readIndex].copy()
+    blockLengths = numpy.zeros(nBlocks,dtype=numpy.int64)
+    queryStarts = numpy.zeros(nBlocks,dtype=numpy.int64)
+
+    inBlock = ~isJunction
+    opBlock = (blockOffsets[opRead] + junctionsBefore)[inBlock]
+    blockLengths += numpy.bincount(opBlock,weights=refLengths[inBlock],minlength=nBlocks).astype(numpy.int64)
+    #ops are in order, so a block starts where its first op does
+    first = numpy.nonzero(numpy.r_[True,opBlock[1:] != opBlock[:-1]])[0] if len(opBlock) > 0 else numpy.zeros(0,dtype=numpy.int64)
+    starts[opBlock[first]] += refBefore[inBlock][first]
+    queryStarts[opBlock[first]] = queryBefore[inBlock][first]
+    queryStarts[blockOffsets] = 0
+
+    noCigar = opsPerRead == 0
+    blockLengths[blockOffsets[noCigar]] = numpy.asarray(lengths,dtype=numpy.int64)[noCigar]
+    keep = (blockLengths > 0) | noCigar[readIndex]
+    return readIndex[keep],starts[keep],starts[keep] + blockLengths[keep],queryStarts[keep]
+
+
+def filterReadArray(reads,locus,sense='both',unique=False,includeJxnReads=False):
+    '''
+    the strand, uniqueness and junction filters of Bam.getRawReads applied to a read array
+    unique is True (or 'sequence') to keep the first read of each sequence, or 'position'
+    to drop reads at the same position as an earlier one (see markPositionDuplicates)
+    '''
+    if includeJxnReads == False:
+        reads = reads[reads['nJunctions'] < 1]
+    keep = numpy.ones(len(reads),dtype=bool)
+    if sense != 'both' and sense != '.':
+        if sense == '-':
+            strand = ['+','-']
+            strand.remove(locus.sense())
+            strand = strand[0]
+        else:
+            strand = locus.sense()
+        keep &= reads['strand'] == strand
+    if unique == 'position':
+        keep &= ~markPositionDuplicates(reads)
+    elif unique:
+        #a read is kept if it's the first one w/ its sequence, counting reads on either strand
+        firstIndex = {}
+        keep &= numpy.array([firstIndex.setdefault(seq,i) == i for i,seq in enumerate(reads['seq'].tolist())],dtype=bool)
+    return reads[keep]
+
+
 class Bam:
     '''A class for a sorted and indexed bam file that allows easy analysis of reads'''
-    def __init__(self,bamFile):
+    def __init__(self,bamFile,backend=None):
         self._bam = bamFile
+        self._backend = backend
+        self._reader = None
+
+    def getReader(self):
+        '''
+        the reader reads are pulled w/ (see openBamReader), opened once and kept open
+        '''
+        if self._reader is None:
+            self._reader = openBamReader(self._bam,self._backend)
+        return self._reader
 
     def getTotalReads(self,readType = 'mapped'):
-        command = '%s flagstat %s' % (samtoolsString,self._bam)
-        stats = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-        statLines = stats.stdout.readlines()
-        stats.stdout.close()
-        if readType == 'mapped':
-            for line in statLines:
-                if line.count('mapped (') == 1:
-
-                    return int(line.split(' ')[0])
-        if readType == 'total':
-            return int(statLines[0].split(' ')[0])
+        '''
+        mapped or total reads in the bam, from the bam stats cache (see getBamStats)
+        '''
+        if readType == 'mapped' or readType == 'total':
+            return getBamStats(self._bam)[readType]
 
     def convertBitwiseFlag(self,flag):
         if flag & 16:
@@ -1105,20 +2960,70 @@ class Bam:
         else:
             return "+";
 
-    def getRawReads(self,locus,sense,unique = False,includeJxnReads = False,printCommand = False):
+    def getReadArray(self,locus,sense = 'both',unique = False,includeJxnReads = False):
         '''
-        gets raw reads from the bam using samtools view.
-        can enforce uniqueness and strandedness
+        gets the reads for a locus as a record array (see bamReadDtype)
+        can enforce uniqueness and strandedness like getRawReads
         '''
-        locusLine = locus.chr()+':'+str(locus.start())+'-'+str(locus.end())
+        reads = self.getReader().fetch(locus.chr(),locus.start(),locus.end())
+        return filterReadArray(reads,locus,sense,unique,includeJxnReads)
 
-        command = '%s view %s %s' % (samtoolsString,self._bam,locusLine)
-        if printCommand:
-            print(command)
-        getReads = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-        reads = getReads.communicate()
-        reads = reads[0].split('\n')[:-1]
-        reads = [read.split('\t') for read in reads]
+    def iterFetchMany(self,loci,sense = 'both',unique = False,includeJxnReads = False,maxSpan = 1000000):
+        '''
+        gets the reads for many loci, reading each stretch of the bam once
+        loci on the same chromosome w/in 16kb of each other (and w/in maxSpan overall) are fetched together
+        and every read goes to each locus it overlaps. yields (index in loci, read array) in genome order
+        filtered like getReadArray
+        '''
+        reader = self.getReader()
+        order = sorted(range(len(loci)),key=lambda i: (loci[i].chr(),loci[i].start()))
+        groups = []
+        for i in order:
+            locus = loci[i]
+            if len(groups) > 0 and groups[-1][0] == locus.chr() and locus.start() <= groups[-1][2] + 16384 and locus.end() - groups[-1][1] <= maxSpan:
+                groups[-1][2] = max(groups[-1][2],locus.end())
+                groups[-1][3].append(i)
+            else:
+                groups.append([locus.chr(),locus.start(),locus.end(),[i]])
+
+        for chrom,start,end,indices in groups:
+            reads = reader.fetch(chrom,start,end)
+            starts = numpy.ascontiguousarray(reads['pos'])
+            ends = numpy.ascontiguousarray(reads['end'])
+            maxLength = (ends - starts).max() + 1 if len(reads) > 0 else 0
+            #reads starting more than the longest read before a locus can't reach it
+            locusStarts = numpy.array([loci[i].start() for i in indices])
+            lows = numpy.searchsorted(starts,locusStarts - maxLength).tolist()
+            highs = numpy.searchsorted(starts,[loci[i].end() for i in indices],'right').tolist()
+            for i,low,high,locusStart in zip(indices,lows,highs,locusStarts.tolist()):
+                window = reads[low:high]
+                window = window[ends[low:high] >= locusStart]
+                yield i,filterReadArray(window,loci[i],sense,unique,includeJxnReads)
+
+    def fetchMany(self,loci,sense = 'both',unique = False,includeJxnReads = False):
+        '''
+        gets the read arrays for many loci (see iterFetchMany) as a list in the order of loci
+        '''
+        readArrays = [None]*len(loci)
+        for i,reads in self.iterFetchMany(loci,sense,unique,includeJxnReads):
+            readArrays[i] = reads
+        return readArrays
+
+    def getRawReads(self,locus,sense,unique = False,includeJxnReads = False,printCommand = False):
+        '''
+        gets raw reads from the bam as split sam lines.
+        can enforce uniqueness (by sequence, or w/ unique='position' by position) and strandedness
+        w/ a backend other than samtools the lines only carry the fields Bam uses
+        '''
+        reader = self.getReader()
+        if not isinstance(reader,SamtoolsBamReader):
+            reads = self.getReadArray(locus,sense,unique,includeJxnReads)
+            return [[name,str(flag),locus.chr(),str(pos),str(mapq),cigar,'=' if mpos else '*',str(mpos),'0',seq,'*']
+                    for name,flag,pos,mapq,cigar,seq,mpos in zip(reads['name'].tolist(),reads['flag'].tolist(),reads['pos'].tolist(),
+                                                                  reads['mapq'].tolist(),reads['cigar'].tolist(),reads['seq'].tolist(),
+                                                                  reads['mpos'].tolist())]
+
+        reads = reader.viewLines(locus.chr(),locus.start(),locus.end(),printCommand)
         if includeJxnReads == False:
             reads = filter(lambda x: x[5].count('N') < 1,reads)
 
@@ -1137,7 +3042,9 @@ class Bam:
             strand = strand[0]
         else:
             strand = locus.sense()
-        for read in reads:
+        if unique == 'position':
+            duplicates = markPositionDuplicates(reader.linesToReadArray(reads)).tolist()
+        for i,read in enumerate(reads):
             #readStrand = read[1].translate(convert)[0]
             #print read[1], read[0]
             #readStrand = convertDict[read[1]]
@@ -1145,7 +3052,10 @@ class Bam:
 
             if sense == 'both' or sense == '.' or readStrand == strand:
 
-                if unique and seqDict[read[9]] == 0:
+                if unique == 'position':
+                    if not duplicates[i]:
+                        keptReads.append(read)
+                elif unique and seqDict[read[9]] == 0:
                     keptReads.append(read)
                 elif not unique:
                     keptReads.append(read)
@@ -1169,67 +3079,141 @@ class Bam:
         #BJA added 256 and 272, which correspond to 0 and 16 for multi-mapped reads respectively:
         #http://onetipperday.blogspot.com/2012/04/understand-flag-code-of-sam-format.html
         #convert = string.maketrans('160','--+')
-        numPattern = re.compile('\d*')
-        for read in reads:
-            chrom = read[2]
+        #spliced reads make a locus for each block between junctions, see cigarBlocks
+        readIndex,starts,ends,queryStarts = cigarBlocks([read[5] for read in reads],[int(read[3]) for read in reads],
+                                                        [len(read[9]) for read in reads])
+        queryEnds = numpy.r_[queryStarts[1:],0]
+        queryEnds[numpy.r_[readIndex[1:] != readIndex[:-1],True]] = -1
+        for i,start,end,queryStart,queryEnd in zip(readIndex.tolist(),starts.tolist(),ends.tolist(),queryStarts.tolist(),queryEnds.tolist()):
+            read = reads[i]
             #strand = read[1].translate(convert)[0]
             #strand = convertDict[read[1]]
             strand = convertBitwiseFlag(read[1])
             if IDtag == 'sequence':
-                ID = read[9]
+                ID = read[9][queryStart:] if queryEnd < 0 else read[9][queryStart:queryEnd]
             elif IDtag == 'seqID':
                 ID = read[0]
             else:
                 ID = ''
+            loci.append(Locus(read[2],start,end,strand,ID))
+        return loci
 
-            length = len(read[9])
-            start = int(read[3])
-            if read[5].count('N') == 1:
-                #this awful oneliner first finds all of the numbers in the read string
-                #then it filters out the '' and converts them to integers
-                #only works for reads that span one junction
-
-                [first,gap,second] = [int(x) for x in filter(lambda x: len(x) > 0, re.findall(numPattern,read[5]))][0:3]
-                if IDtag == 'sequence':
-                    loci.append(Locus(chrom,start,start+first,strand,ID[0:first]))
-                    loci.append(Locus(chrom,start+first+gap,start+first+gap+second,strand,ID[first:]))
-                else:
-                    loci.append(Locus(chrom,start,start+first,strand,ID))
-                    loci.append(Locus(chrom,start+first+gap,start+first+gap+second,strand,ID))
-            elif read[5].count('N') > 1:
-                continue
-            else:
-                loci.append(Locus(chrom,start,start+length,strand,ID))
+    def readArrayToLoci(self,reads,chrom,IDtag = 'sequence,seqID,none'):
+        '''
+        takes a read array from getReadArray and converts it into loci the same way readsToLoci does
+        '''
+        if IDtag == 'sequence,seqID,none':
+            print('please specify one of the three options: sequence, seqID, none')
+            return
+        if IDtag == 'sequence':
+            IDs = reads['seq'].tolist()
+        elif IDtag == 'seqID':
+            IDs = reads['name'].tolist()
+        else:
+            IDs = [''] * len(reads)
+
+        loci = []
+        readIndex,starts,ends,queryStarts = cigarBlocks(reads['cigar'].tolist(),reads['pos'],reads['length'])
+        queryEnds = numpy.r_[queryStarts[1:],0]
+        queryEnds[numpy.r_[readIndex[1:] != readIndex[:-1],True]] = -1
+        strands = reads['strand'].tolist()
+        for i,start,end,queryStart,queryEnd in zip(readIndex.tolist(),starts.tolist(),ends.tolist(),queryStarts.tolist(),queryEnds.tolist()):
+            ID = IDs[i]
+            if IDtag == 'sequence':
+                ID = ID[queryStart:] if queryEnd < 0 else ID[queryStart:queryEnd]
+            loci.append(Locus(chrom,start,end,strands[i],ID))
         return loci
 
+    def readArrayToIntervals(self,reads,extension = 0):
+        '''
+        the loci readArrayToLoci would make from a read array as (starts,ends,strands) numpy arrays
+        + strand reads are extended by extension past their end and - strand reads before their start
+        '''
+        #spliced reads make an interval for each block between junctions
+        readIndex,starts,ends,queryStarts = cigarBlocks(reads['cigar'].tolist(),reads['pos'],reads['length'])
+        strands = reads['strand'][readIndex]
+        isMinus = strands == '-'
+        return starts - extension*isMinus,ends + extension*(~isMinus),strands
+
+    def strandCoverage(self,locus,extension = 200,unique = False,includeJxnReads = False,reads = None):
+        '''
+        per base coverage of locus.start() to locus.end() by + and - strand reads extended by extension
+        returns (plusCoverage,minusCoverage) numpy arrays in genome order
+        reads can be passed in if they've already been fetched from the locus padded by extension
+        '''
+        if reads is None:
+            reads = self.getReadArray(makeSearchLocus(locus,extension,extension),'both',unique,includeJxnReads)
+        starts,ends,strands = self.readArrayToIntervals(reads,extension)
+        isMinus = strands == '-'
+        return (intervalCoverage(starts[~isMinus],ends[~isMinus],locus.start(),locus.end()),
+                intervalCoverage(starts[isMinus],ends[isMinus],locus.start(),locus.end()))
+
+    def coverage(self,locus,extension = 200,sense = 'both',nBins = None,binSize = None,unique = False,includeJxnReads = False,reads = None):
+        '''
+        per base read coverage of a locus running 5' to 3' along it (reversed for - loci)
+        sense 'both' counts every read, '+' reads on the locus strand and '-' reads on the other one
+        ('.' loci count as +). w/ nBins or binSize returns the summed coverage of each bin instead:
+        nBins splits the locus into near equal bins, binSize leaves out a partial last bin
+        '''
+        plusCoverage,minusCoverage = self.strandCoverage(locus,extension,unique,includeJxnReads,reads)
+        if locus.sense() == '-':
+            plusCoverage,minusCoverage = minusCoverage[::-1],plusCoverage[::-1]
+        if sense == 'both' or sense == '.':
+            coverage = plusCoverage + minusCoverage
+        elif sense == '-':
+            coverage = minusCoverage
+        else:
+            coverage = plusCoverage
+
+        if nBins:
+            binStarts = numpy.arange(nBins)*len(coverage)/nBins
+            binEnds = numpy.append(binStarts[1:],len(coverage))
+            binSums = numpy.add.reduceat(coverage,numpy.minimum(binStarts,len(coverage) - 1))
+            #reduceat gives a single value for empty bins, which only happen when there are more bins than bases
+            binSums[binStarts == binEnds] = 0
+            return binSums
+        if binSize:
+            nFull = len(coverage)/binSize
+            if nFull == 0:
+                return numpy.zeros(0,dtype=coverage.dtype)
+            return numpy.add.reduceat(coverage[:nFull*binSize],numpy.arange(nFull)*binSize)
+        return coverage
+
     def getReadsLocus(self,locus,sense = 'both',unique = True,IDtag = 'sequence,seqID,none',includeJxnReads = False):
         '''
         gets all of the reads for a given locus
         '''
-        reads = self.getRawReads(locus,sense,unique,includeJxnReads)
+        reads = self.getReadArray(locus,sense,unique,includeJxnReads)
 
-        loci = self.readsToLoci(reads,IDtag)
+        loci = self.readArrayToLoci(reads,locus.chr(),IDtag)
 
         return loci
 
     def getReadSequences(self,locus,sense = 'both',unique = True,includeJxnReads = False):
 
-        reads = self.getRawReads(locus,sense,unique,includeJxnReads)
+        reads = self.getReadArray(locus,sense,unique,includeJxnReads)
 
-        return [read[9] for read in reads]
+        return reads['seq'].tolist()
 
     def getReadStarts(self,locus,sense = 'both',unique = False,includeJxnReads = False):
-        reads = self.getRawReads(locus,sense,unique,includeJxnReads)
+        reads = self.getReadArray(locus,sense,unique,includeJxnReads)
 
-        return [int(read[3]) for read in reads]
+        return reads['pos'].tolist()
 
 
     def getReadCount(self,locus,sense = 'both',unique = True,includeJxnReads = False):
-        reads = self.getRawReads(locus,sense,unique,includeJxnReads)
+        reads = self.getReadArray(locus,sense,unique,includeJxnReads)
 
         return len(reads)
 
     def liquidateLocus(self,locus,sense='.'):
+           '''
+           total bp of 200bp extended reads in the locus, in bamliquidator's output format
+           uses the shared LiquidatorPool when bamliquidator_worker is installed
+           '''
+           if bamliquidatorWorkerPath is not None:
+               counts = getLiquidatorPool().liquidate(self._bam,locus.chr(),locus.start(),locus.end(),sense,1,200)
+               return ''.join(['%d\n' % count for count in counts])
 
            bamliquidatorCmd = 'bamliquidator %s %s %s %s %s 1 200' % (self._bam, locus.chr(),
                                                                      str(locus.start()), str(locus.end()),
@@ -1240,6 +3224,158 @@ class Bam:
 
            return score
 
+
+#bamliquidator_worker keeps a bam and its index open and liquidates regions sent to it over a pipe,
+#so liquidating a region costs a request/response instead of a bamliquidator process and index load.
+#requests are little endian: uint16 chrom length (0 shuts the worker down), the chrom, then
+#uint32 start, uint32 end, char strand, uint32 nBins, uint32 extension. responses are an int32 n
+#and n float64 bin counts, or a negative n and an error message of -n characters
+
+def findBamliquidator(executable):
+    '''
+    path of a bamliquidator executable, either built in bamliquidator_internal or on the path, or None
+    '''
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)),'bamliquidator_internal',executable)
+    if os.path.isfile(path):
+        return path
+    return find_executable(executable)
+
+#resolved once, since Bam.liquidateLocus checks it for every locus
+bamliquidatorWorkerPath = findBamliquidator('bamliquidator_worker')
+
+
+class LiquidatorWorker(object):
+    '''
+    liquidates regions of one bam w/ a long lived bamliquidator_worker process.
+    counts are the total bp of extended reads in each bin, same as the bamliquidator executable
+    '''
+    requestFormat = '<IIcII'
+
+    def __init__(self,bamFile,executable=None):
+        if executable is None:
+            executable = findBamliquidator('bamliquidator_worker')
+        if executable is None:
+            raise ValueError('bamliquidator_worker not found in path')
+        self._bam = bamFile
+        self._process = subprocess.Popen([executable,bamFile],stdin = subprocess.PIPE,stdout = subprocess.PIPE)
+        #requests sent whose responses haven't been read yet
+        self._unread = 0
+
+    def _send(self,chrom,start,end,sense='.',nBins=1,extension=0):
+        if sense not in ['+','-']:
+            sense = '.'
+        self._process.stdin.write(struct.pack('<H',len(chrom)) + chrom +
+                                  struct.pack(self.requestFormat,int(start),int(end),sense,int(nBins),int(extension)))
+        self._unread += 1
+
+    def _receive(self):
+        header = self._process.stdout.read(4)
+        if len(header) < 4:
+            raise IOError('bamliquidator_worker for %s exited with %s' % (self._bam,self._process.poll()))
+        self._unread -= 1
+        n = struct.unpack('<i',header)[0]
+        if n < 0:
+            raise ValueError('bamliquidator_worker for %s: %s' % (self._bam,self._process.stdout.read(-n)))
+        return numpy.frombuffer(self._process.stdout.read(8*n),dtype='<f8')
+
+    def _drain(self):
+        #skips responses left by an abandoned liquidateMany
+        self._process.stdin.flush()
+        while self._unread > 0:
+            try:
+                self._receive()
+            except ValueError:
+                pass
+
+    def liquidate(self,chrom,start,end,sense='.',nBins=1,extension=0):
+        '''
+        numpy array of the nBins counts of start to end, w/ reads extended by extension
+        '''
+        self._drain()
+        self._send(chrom,start,end,sense,nBins,extension)
+        self._process.stdin.flush()
+        return self._receive()
+
+    def liquidateMany(self,requests,window=64):
+        '''
+        yields the counts of each (chrom,start,end,sense,nBins,extension) request in order,
+        keeping up to window requests in the pipe ahead of the response being read
+        '''
+        self._drain()
+        for request in requests:
+            self._send(*request)
+            if self._unread >= window:
+                self._process.stdin.flush()
+                yield self._receive()
+        self._process.stdin.flush()
+        while self._unread > 0:
+            yield self._receive()
+
+    def close(self):
+        '''
+        tells the worker to shut down and waits for it
+        '''
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write(struct.pack('<H',0))
+                self._process.stdin.close()
+            except IOError:
+                pass
+        self._process.stdout.close()
+        return self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+class LiquidatorPool(object):
+    '''
+    one LiquidatorWorker per bam, started the first time the bam is liquidated and kept until close
+    '''
+
+    def __init__(self,executable=None):
+        self._executable = executable
+        self._workers = {}
+
+    def getWorker(self,bamFile):
+        key = os.path.abspath(bamFile)
+        if key not in self._workers:
+            self._workers[key] = LiquidatorWorker(bamFile,self._executable)
+        return self._workers[key]
+
+    def liquidate(self,bamFile,chrom,start,end,sense='.',nBins=1,extension=0):
+        return self.getWorker(bamFile).liquidate(chrom,start,end,sense,nBins,extension)
+
+    def liquidateMany(self,bamFile,requests,window=64):
+        return self.getWorker(bamFile).liquidateMany(requests,window)
+
+    def close(self):
+        for worker in self._workers.values():
+            worker.close()
+        self._workers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+_liquidatorPool = None
+
+def getLiquidatorPool():
+    '''
+    the LiquidatorPool shared by this process, closed when it exits
+    '''
+    global _liquidatorPool
+    if _liquidatorPool is None:
+        _liquidatorPool = LiquidatorPool()
+        atexit.register(_liquidatorPool.close)
+    return _liquidatorPool
+
 #==================================================================
 #========================MISC FUNCTIONS============================
 #==================================================================
@@ -0,0 +1,841 @@
+#!/usr/bin/env python
+
+import gzip
+import numpy
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import utils
+
+def random_loci(count, chromosomes=('chr1', 'chr2'), span=100000, max_length=5000, seed=0):
+    rng = random.Random(seed)
+    loci = {}
+    while len(loci) < count:
+        start = rng.randint(1, span)
+        end = start + rng.choice([0, rng.randint(1, 200), rng.randint(1, max_length)])
+        locus = utils.Locus(rng.choice(chromosomes), start, end, rng.choice('+-.'), 'locus_%d' % len(loci))
+        # the collection treats equal coordinates as the same locus
+        loci.setdefault(locus, locus)
+    return sorted(loci, key=lambda locus: locus.ID())
+
+def locus_key(locus):
+    return (locus.chr(), locus.start(), locus.end(), locus.sense(), locus.ID())
+
+class IntervalIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.starts = [rng.randint(1, 10000) for i in range(1500)]
+        self.ends = [start + rng.choice([0, rng.randint(1, 100), rng.randint(1, 5000)]) for start in self.starts]
+        # nested chains, duplicates and one interval spanning everything
+        self.starts += [100, 100, 100, 200, 300, 1]
+        self.ends += [5000, 5000, 4000, 3000, 301, 20000]
+        self.index = utils.IntervalIndex(self.starts, self.ends)
+        self.queries = [(start, start + rng.randint(0, 3000)) for start in [rng.randint(-100, 21000) for i in range(300)]]
+
+    def expected(self, start, end):
+        return [i for i in range(len(self.starts)) if self.starts[i] <= end and self.ends[i] >= start]
+
+    def test_find_matches_brute_force(self):
+        self.assertEqual(len(self.index), len(self.starts))
+        for start, end in self.queries:
+            self.assertEqual(sorted(self.index.find(start, end)), self.expected(start, end))
+
+    def test_query_matches_brute_force(self):
+        query_positions, positions = self.index.query([q[0] for q in self.queries], [q[1] for q in self.queries])
+        expected = [(q, i) for q, (start, end) in enumerate(self.queries) for i in self.expected(start, end)]
+        self.assertEqual(sorted(zip(query_positions.tolist(), positions.tolist())), expected)
+
+    def test_empty(self):
+        index = utils.IntervalIndex([], [])
+        self.assertEqual(index.find(1, 10), [])
+        query_positions, positions = index.query([1], [10])
+        self.assertEqual(len(query_positions), 0)
+        self.assertEqual(len(positions), 0)
+
+class LocusCollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.loci = random_loci(2000)
+        self.queries = random_loci(100, seed=1, max_length=50000)
+        self.collection = utils.LocusCollection(self.loci, 50)
+
+    def assertSameLoci(self, first, second):
+        self.assertEqual(sorted(map(locus_key, first)), sorted(map(locus_key, second)))
+
+    def test_queries_match_brute_force(self):
+        for query in self.queries:
+            for sense in ['sense', 'antisense', 'both']:
+                expected_overlap = [l for l in self.loci
+                                    if (sense != 'antisense' and l.overlaps(query))
+                                    or (sense != 'sense' and l.overlapsAntisense(query))]
+                expected_contained = [l for l in self.loci
+                                      if (sense != 'antisense' and query.contains(l))
+                                      or (sense != 'sense' and query.containsAntisense(l))]
+                expected_containers = [l for l in self.loci
+                                       if (sense != 'antisense' and l.contains(query))
+                                       or (sense != 'sense' and l.containsAntisense(query))]
+                self.assertSameLoci(self.collection.getOverlap(query, sense), expected_overlap)
+                self.assertSameLoci(self.collection.getContained(query, sense), expected_contained)
+                self.assertSameLoci(self.collection.getContainers(query, sense), expected_containers)
+
+    def test_remove_and_append(self):
+        removed = self.loci[::3]
+        for locus in removed:
+            self.collection.remove(locus)
+            self.assertFalse(self.collection.hasLocus(locus))
+        kept = [l for i, l in enumerate(self.loci) if i % 3 != 0]
+        self.assertEqual(len(self.collection), len(kept))
+        for query in self.queries[:50]:
+            self.assertSameLoci(self.collection.getOverlap(query, 'both'),
+                                [l for l in kept if l.overlaps(query) or l.overlapsAntisense(query)])
+
+        self.collection.extend(removed)
+        self.assertEqual(len(self.collection), len(self.loci))
+        for query in self.queries[:50]:
+            self.assertSameLoci(self.collection.getOverlap(query, 'both'),
+                                [l for l in self.loci if l.overlaps(query) or l.overlapsAntisense(query)])
+
+    def test_interleaved_append_and_query(self):
+        collection = utils.LocusCollection([], 50)
+        added = []
+        for i, locus in enumerate(self.loci[:600]):
+            collection.append(locus)
+            added.append(locus)
+            if i % 7 == 0:
+                query = self.queries[i % len(self.queries)]
+                self.assertSameLoci(collection.getOverlap(query, 'both'),
+                                    [l for l in added if l.overlaps(query) or l.overlapsAntisense(query)])
+
+    def test_long_locus(self):
+        long_locus = utils.Locus('chr1', 1, 30000000, '+', 'long')
+        self.collection.append(long_locus)
+        loci = self.loci + [long_locus]
+        for query in self.queries:
+            self.assertSameLoci(self.collection.getOverlap(query, 'both'),
+                                [l for l in loci if l.overlaps(query) or l.overlapsAntisense(query)])
+            self.assertSameLoci(self.collection.getContainers(query, 'both'),
+                                [l for l in loci if l.contains(query) or l.containsAntisense(query)])
+
+    def test_remove_missing_locus(self):
+        self.assertRaises(ValueError, self.collection.remove, utils.Locus('chrX', 1, 2, '+'))
+
+class StitchCollectionTest(unittest.TestCase):
+    def check_against_iterative(self, loci, stitch_window):
+        collection = utils.LocusCollection(loci, 50)
+        # the iterative version renames unstitched loci in place, so run it last
+        stitched = collection.stitchCollection(stitch_window)
+        expected = collection._LocusCollection__iterativeStitch(stitch_window, 'both')
+        self.assertEqual(sorted(map(locus_key, stitched.getLoci())),
+                         sorted(map(locus_key, expected.getLoci())))
+
+    def test_matches_iterative_stitching(self):
+        for seed in range(5):
+            for stitch_window in [0, 1, 500, 12500]:
+                self.check_against_iterative(random_loci(400, seed=seed, max_length=2000), stitch_window)
+
+    def test_adjacent_loci(self):
+        loci = [utils.Locus('chr1', 1, 10, '+', 'a'), utils.Locus('chr1', 11, 20, '-', 'b')]
+        self.assertEqual(len(utils.LocusCollection(loci, 50).stitchCollection(0)), 2)
+        stitched = utils.LocusCollection(loci, 50).stitchCollection(1).getLoci()
+        self.assertEqual(len(stitched), 1)
+        self.assertEqual((stitched[0].start(), stitched[0].end(), stitched[0].sense()), (1, 20, '.'))
+        self.assertTrue(stitched[0].ID() in ['2_a_lociStitched', '2_b_lociStitched'])
+
+    def test_does_not_rename_input(self):
+        locus = utils.Locus('chr1', 1, 10, '+', 'a')
+        stitched = utils.LocusCollection([locus], 50).stitchCollection()
+        self.assertEqual(stitched.getLoci()[0].ID(), '1_a_lociStitched')
+        self.assertEqual(locus.ID(), 'a')
+
+class StitchStatsTest(unittest.TestCase):
+    def old_stitch_stats(self, collection, step):
+        # the per step loop ROSE2 optimizeStitching used to run
+        consolidated = collection.stitchCollection(stitchWindow=0)
+        total_constit = sum([locus.len() for locus in consolidated.getLoci()])
+        stitch_loci = consolidated.stitchCollection(stitchWindow=step).getLoci()
+        region_lengths = [locus.len() for locus in stitch_loci]
+        constit_lengths = [sum([l.len() for l in consolidated.getOverlap(locus)]) for locus in stitch_loci]
+        fractions = [float(c) / r for c, r in zip(constit_lengths, region_lengths)]
+        return [step, len(stitch_loci), total_constit, sum(region_lengths),
+                round(numpy.mean(constit_lengths), 2), round(numpy.median(constit_lengths), 2),
+                round(numpy.mean(region_lengths), 2), round(numpy.median(region_lengths), 2),
+                round(numpy.mean(fractions), 2), round(numpy.median(fractions), 2)]
+
+    def test_matches_per_step_stitching(self):
+        collection = utils.LocusCollection(random_loci(500, chromosomes=('chr1', 'chr2', 'chr3'), span=500000), 50)
+        steps = range(0, 15001, 2500)
+        stats = utils.stitchStats(collection, steps)
+        self.assertEqual(len(stats), len(steps))
+        for row, step in zip(stats, steps):
+            self.assertEqual(row, self.old_stitch_stats(collection, step))
+
+class OverlapJoinTest(unittest.TestCase):
+    def test_matches_collection_queries(self):
+        targets = random_loci(1500)
+        queries = random_loci(150, seed=1, max_length=20000)
+        collection = utils.LocusCollection(targets, 50)
+        for mode, query_method in [('overlap', collection.getOverlap),
+                                   ('contained', collection.getContained),
+                                   ('containers', collection.getContainers)]:
+            for sense in ['sense', 'antisense', 'both']:
+                query_indices, target_indices = utils.overlapJoin(queries, targets, mode, sense)
+                joined = [(q, locus_key(targets[t])) for q, t in zip(query_indices, target_indices)]
+                expected = [(q, locus_key(locus)) for q, query in enumerate(queries)
+                            for locus in query_method(query, sense)]
+                self.assertEqual(sorted(joined), sorted(expected))
+
+    def test_long_target(self):
+        # every query starts past the long target's start, so a scan from the first target
+        # that can still reach a query would look at ~all targets for each query
+        rng = random.Random(0)
+        starts = numpy.array([rng.randint(1, 30000000) for i in range(50000)])
+        targets = [utils.Locus('chr1', start, start + rng.randint(0, 2000), '.') for start in starts]
+        targets.append(utils.Locus('chr1', 1, 30000000, '.', 'long'))
+        queries = [utils.Locus('chr1', start, start + rng.randint(0, 5000), '.')
+                   for start in [rng.randint(1, 30000000) for i in range(20000)]]
+
+        query_indices, target_indices = utils.overlapJoin(queries, targets, sense='both')
+        self.assertEqual(numpy.bincount(query_indices, minlength=len(queries))[:5].tolist(),
+                         [sum(1 for t in targets if t.overlaps(q)) for q in queries[:5]])
+        # targets starting by the query end, less those ending before its start
+        target_starts = numpy.sort([t.start() for t in targets])
+        target_ends = numpy.sort([t.end() for t in targets])
+        query_starts = numpy.array([q.start() for q in queries])
+        query_ends = numpy.array([q.end() for q in queries])
+        expected = (numpy.searchsorted(target_starts, query_ends, 'right') -
+                    numpy.searchsorted(target_ends, query_starts, 'left'))
+        self.assertEqual(numpy.bincount(query_indices, minlength=len(queries)).tolist(), expected.tolist())
+        self.assertEqual(sum(1 for t in target_indices if t == len(targets) - 1), len(queries))
+
+    def test_sums(self):
+        targets = [utils.Locus('chr1', 1, 10, '+', 'a', score=2),
+                   utils.Locus('chr1', 5, 20, '-', 'b', score=3),
+                   utils.Locus('chr2', 1, 100, '.', 'c', score=5)]
+        queries = [utils.Locus('chr1', 8, 9, '+'), utils.Locus('chr2', 200, 300, '.'), utils.Locus('chr3', 1, 2, '.')]
+        self.assertEqual(list(utils.overlapSum(queries, targets)), [1, 0, 0])
+        self.assertEqual(list(utils.overlapSum(queries, targets, sense='both')), [2, 0, 0])
+        self.assertEqual(list(utils.overlapSum(queries, targets, 'len', sense='both')), [26, 0, 0])
+        self.assertEqual(list(utils.overlapSum(queries, targets, 'score', sense='both')), [5, 0, 0])
+        self.assertEqual(list(utils.overlapSum(queries, targets, [1.5, 2.5, 0], sense='antisense')), [2.5, 0, 0])
+
+class TSSIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tss_loci = [utils.Locus(l.chr(), l.start(), l.start(), '+', l.ID()) for l in random_loci(1500)]
+        self.queries = random_loci(200, chromosomes=('chr1', 'chr2', 'chr3'), seed=1, max_length=20000)
+        self.index = utils.TSSIndex(self.tss_loci)
+
+    def test_within_matches_brute_force(self):
+        query_indices, tss_indices = self.index.within(self.queries, 5000)
+        expected = [(q, t) for q, query in enumerate(self.queries) for t, locus in enumerate(self.tss_loci)
+                    if locus.chr() == query.chr() and query.start() - 5000 <= locus.start() <= query.end() + 5000]
+        self.assertEqual(sorted(zip(query_indices, tss_indices)), sorted(expected))
+
+    def test_nearest_matches_brute_force(self):
+        for window in [None, 2000]:
+            indices, dists = self.index.nearest(self.queries, 3, window)
+            for q, query in enumerate(self.queries):
+                center = (query.start() + query.end()) / 2
+                expected = sorted([abs(locus.start() - center) for locus in self.tss_loci
+                                   if locus.chr() == query.chr() and (window is None or
+                                   query.start() - window <= locus.start() <= query.end() + window)])[:3]
+                found = [d for d in dists[q] if d != -1]
+                self.assertEqual(found, expected)
+                self.assertEqual([abs(self.index.getTSS(i) - center) for i in indices[q] if i != -1], expected)
+
+    def test_minus_strand_tss_is_end(self):
+        index = utils.TSSIndex([utils.Locus('chr1', 100, 200, '-', 'a'), utils.Locus('chr1', 300, 400, '+', 'b')])
+        indices, dists = index.nearest([utils.Locus('chr1', 240, 240, '.')], 2)
+        self.assertEqual([index.getID(i) for i in indices[0]], ['a', 'b'])
+        self.assertEqual(list(dists[0]), [40, 60])
+
+class LocusTableTest(unittest.TestCase):
+    def setUp(self):
+        self.gff = [['chr1', 'a', '', '100', '50', '2.5', '+', '', 'a'],
+                    ['chr2', '', '', '10', '20', '', '-', '', 'b'],
+                    ['chr1', '', '', '300', '400', '.', '.', '', '']]
+
+    def test_gff_matches_locus_collection(self):
+        table = utils.LocusTable.fromGFF(self.gff)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table.starts()), [50, 10, 300])
+        self.assertEqual(list(table.scores()), [2.5, 0, 0])
+        self.assertEqual(sorted(map(locus_key, table.toLoci())),
+                         [('chr1', 50, 100, '+', 'a'), ('chr1', 300, 400, '.', 'chr1:.:300-400'), ('chr2', 10, 20, '-', 'b')])
+        self.assertEqual(sorted(map(locus_key, utils.gffToLocusCollection(self.gff).getLoci())),
+                         sorted(map(locus_key, table.toLoci())))
+
+    def test_round_trip_and_filters(self):
+        loci = random_loci(500, chromosomes=('chr1', 'chr2', 'chr3'))
+        table = utils.LocusTable.fromLoci(utils.LocusCollection(loci, 50))
+        self.assertEqual(sorted(map(locus_key, table.toLoci())), sorted(map(locus_key, loci)))
+
+        chr2 = table.filterChrom(['chr2'])
+        self.assertEqual(sorted(map(locus_key, chr2.toLoci())),
+                         sorted([locus_key(l) for l in loci if l.chr() == 'chr2']))
+        self.assertEqual(len(table.filterChrom(['chr2'], exclude=True)) + len(chr2), len(table))
+
+        short = table.filterLength(maxLength=100)
+        self.assertEqual(sorted(map(locus_key, short.toLoci())),
+                         sorted([locus_key(l) for l in loci if l.len() <= 100]))
+        self.assertEqual(len(table.filterScore(minScore=1)), 0)
+
+    def test_bed(self):
+        bed = [['chr1', '10', '20', 'peak1', '7'], ['chr1', '30', '40', 'peak2', '9']]
+        table = utils.LocusTable.fromBed(bed)
+        self.assertEqual(list(table.IDs()), ['peak1', 'peak2'])
+        self.assertEqual(list(table.filterScore(minScore=8).IDs()), ['peak2'])
+        self.assertEqual(list(utils.LocusTable.fromBed(bed, 'macs').IDs()), ['macs_1', 'macs_2'])
+
+REFSEQ_LINES = [
+    ['#bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score', 'name2'],
+    ['0', 'NM_1', 'chr1', '+', '100', '900', '150', '850', '2', '100,500,', '300,900,', '0', 'geneA'],
+    ['0', 'NM_2', 'chr1', '-', '2000', '5000', '2000', '2000', '1', '2000,', '5000,', '0', 'geneB'],
+    ['0', 'NM_2', 'chr2', '-', '7000', '8000', '7100', '7900', '1', '7000,', '8000,', '0', 'geneB'],
+    ['0', 'NR_3', 'chr2', '+', '10', '60', '60', '60', '1', '10,', '60,', '0', 'geneC'],
+]
+
+class AnnotationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_folder = utils.ANNOTATION_CACHE_FOLDER
+        utils.ANNOTATION_CACHE_FOLDER = os.path.join(self.folder, 'cache')
+        self.annot_file = os.path.join(self.folder, 'test_refseq.ucsc')
+        utils.unParseTable(REFSEQ_LINES, self.annot_file, '\t')
+
+    def tearDown(self):
+        utils.ANNOTATION_CACHE_FOLDER = self.cache_folder
+        shutil.rmtree(self.folder)
+
+    def test_matches_refseq_table(self):
+        store = utils.AnnotationStore(self.annot_file)
+        refseq_table, refseq_dict = utils.importRefseq(self.annot_file)
+        start_dict = store.getStartDict()
+        self.assertEqual(sorted(start_dict), ['NM_1', 'NM_2', 'NR_3'])
+        self.assertEqual(start_dict['NM_2'], {'sense': '-', 'chr': 'chr1', 'start': [5000], 'end': [2000], 'name': 'geneB'})
+        for gene in start_dict:
+            self.assertEqual(start_dict[gene]['start'], utils.getTSSs([gene], refseq_table, refseq_dict))
+        self.assertEqual(store.getStartDict(['NR_3', 'NM_9']).keys(), ['NR_3'])
+
+        transcripts = store.getTranscriptCollection(10, 20, 500, ['NM_2'])
+        self.assertEqual(sorted(map(locus_key, transcripts.getLoci())),
+                         [('chr1', 1980, 5010, '-', 'NM_2'), ('chr2', 6980, 8010, '-', 'NM_2')])
+        tss = store.getTSSCollection(0, 0)
+        self.assertEqual(sorted(map(locus_key, tss.getLoci())),
+                         [('chr1', 100, 100, '+', 'NM_1'), ('chr1', 5000, 5000, '-', 'NM_2'), ('chr2', 10, 10, '+', 'NR_3')])
+
+        genes = store.getGenes(['NM_1', 'NM_9'], True)
+        self.assertEqual(genes.keys(), ['NM_1'])
+        self.assertFalse(genes.has_key('NM_9'))
+        gene = genes['NM_1']
+        self.assertEqual((gene.commonName(), gene.chr(), gene.cdLocus().start(), len(gene.txExons())), ('geneA', 'chr1', 150, 2))
+        self.assertEqual(sorted([g.name() for g in store.getGenes()]), ['NM_1', 'NM_2', 'NR_3'])
+
+    def test_cache_is_written_and_reused(self):
+        store = utils.AnnotationStore(self.annot_file)
+        start_dict = store.getStartDict()
+        self.assertTrue(os.path.isfile(store.getCacheFile()))
+        self.assertEqual([f for f in os.listdir(utils.ANNOTATION_CACHE_FOLDER) if f.endswith('.tmp')], [])
+
+        # a second store must read the columns back from the cache
+        cached = utils.AnnotationStore(self.annot_file)
+        self.assertEqual(cached.getCacheFile(), store.getCacheFile())
+        cached._AnnotationStore__parseColumns = None
+        self.assertEqual(cached.getStartDict(), start_dict)
+
+    def test_corrupt_cache_is_rebuilt(self):
+        store = utils.AnnotationStore(self.annot_file)
+        os.makedirs(utils.ANNOTATION_CACHE_FOLDER)
+        with open(store.getCacheFile(), 'w') as fh:
+            fh.write('not an npz')
+        self.assertEqual(sorted(store.getStartDict()), ['NM_1', 'NM_2', 'NR_3'])
+        self.assertEqual(sorted(utils.AnnotationStore(self.annot_file).getStartDict()), ['NM_1', 'NM_2', 'NR_3'])
+
+    def test_edited_annotation_gets_a_new_cache(self):
+        first = utils.getAnnotationStore(self.annot_file)
+        first.getStartDict()
+        utils.unParseTable(REFSEQ_LINES[:2], self.annot_file, '\t')
+        second = utils.getAnnotationStore(self.annot_file)
+        self.assertNotEqual(first.getCacheFile(), second.getCacheFile())
+        self.assertEqual(utils.makeStartDict(self.annot_file).keys(), ['NM_1'])
+
+class TableReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.rows = [['GENE_ID', 'locusLine', 'bin_1']] + [['r%d' % i, 'chr1(.):%d-%d' % (i, i + 10), '%s' % (i * 0.5)] for i in range(250)]
+        self.table_file = os.path.join(self.folder, 'matrix.txt')
+        utils.unParseTable(self.rows, self.table_file, '\t')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_iter_table_matches_parse_table(self):
+        self.assertEqual(list(utils.iterTable(self.table_file)), utils.parseTable(self.table_file, '\t'))
+        self.assertEqual(list(utils.iterTable(self.table_file, header=True)), self.rows[1:])
+        self.assertEqual(list(utils.iterTable(self.table_file, header='auto')), self.rows[1:])
+        chunks = list(utils.iterTable(self.table_file, header=True, chunkSize=100))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        self.assertEqual([row for chunk in chunks for row in chunk], self.rows[1:])
+
+    def test_gzip_and_comments(self):
+        gz_file = os.path.join(self.folder, 'matrix.txt.gz')
+        fh = gzip.open(gz_file, 'wb')
+        fh.write('# a comment\n' + open(self.table_file).read())
+        fh.close()
+        self.assertEqual(list(utils.iterTable(gz_file, comment='#', header='auto')), self.rows[1:])
+
+    def test_load_columns(self):
+        ids, signal = utils.loadColumns(self.table_file, [0, 'bin_1'], [str, float], header=True, chunkSize=64)
+        self.assertEqual(ids.tolist(), [row[0] for row in self.rows[1:]])
+        self.assertEqual(signal.tolist(), [float(row[2]) for row in self.rows[1:]])
+        self.assertEqual(utils.loadColumns(self.table_file, [2], float, header='auto')[0].tolist(), signal.tolist())
+
+    def test_fill_value(self):
+        utils.unParseTable([['a', '1'], ['b', ''], ['c', '3']], self.table_file, '\t')
+        self.assertRaises(ValueError, utils.loadColumns, self.table_file, [1], float)
+        values = utils.loadColumns(self.table_file, [1], float, fillValue=-1)[0]
+        self.assertEqual(values.tolist(), [1, -1, 3])
+
+class TableWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.table = [['ID', 'signal']] + [['region_%d' % i, i * 0.25] for i in range(30000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_plain_output_matches_old_format(self):
+        output = os.path.join(self.folder, 'table.txt')
+        utils.unParseTable(self.table, output, '\t')
+        self.assertEqual(open(output).read(), ''.join(['\t'.join([str(x) for x in line]) + '\n' for line in self.table]))
+        utils.writeTable(['a', 1], output, '')
+        self.assertEqual(open(output).read(), 'a\n1\n')
+        self.assertEqual(os.listdir(self.folder), ['table.txt'])
+
+    def test_gzip_and_bgzf(self):
+        expected = utils.parseTable(utils.writeTable(self.table, os.path.join(self.folder, 'table.txt'), '\t'), '\t')
+        for name, compress in [('table.txt.gz', None), ('table.txt.bgz', None), ('table.bgzf.gz', 'bgzf')]:
+            output = utils.writeTable(self.table, os.path.join(self.folder, name), '\t', compress)
+            self.assertEqual(list(utils.iterTable(output)), expected)
+
+        # every BGZF block carries its own size and the file ends w/ the empty EOF block
+        data = open(os.path.join(self.folder, 'table.bgzf.gz'), 'rb').read()
+        offset, blocks = 0, 0
+        while offset < len(data):
+            self.assertEqual(data[offset:offset + 4], '\x1f\x8b\x08\x04')
+            self.assertEqual(data[offset + 12:offset + 14], 'BC')
+            offset += struct.unpack('<H', data[offset + 16:offset + 18])[0] + 1
+            blocks += 1
+        self.assertEqual(offset, len(data))
+        self.assertTrue(blocks > 2)
+        self.assertEqual(data[-28:], utils.BgzfWriter.eofBlock)
+
+    def test_columns(self):
+        output = os.path.join(self.folder, 'columns.txt')
+        ids = numpy.array(['a', 'b', 'c'])
+        utils.writeColumns([ids, numpy.array([1.5, 2, 3]), [1, 2, 3]], output, '\t', ['ID', 'X', 'Y'], blockSize=2)
+        self.assertEqual(open(output).read(), 'ID\tX\tY\na\t1.5\t1\nb\t2.0\t2\nc\t3.0\t3\n')
+
+    def test_failed_write_leaves_nothing_behind(self):
+        output = os.path.join(self.folder, 'table.txt')
+        utils.unParseTable([['old']], output, '\t')
+
+        def rows():
+            yield ['new']
+            raise RuntimeError('failed')
+        self.assertRaises(RuntimeError, utils.writeTable, rows(), output, '\t', blockSize=1)
+        self.assertEqual(open(output).read(), 'old\n')
+        self.assertEqual(os.listdir(self.folder), ['table.txt'])
+
+
+def reg2bin(beg, end):
+    end -= 1
+    for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+def ref_length(cigar):
+    return sum([int(length) for length, op in utils.re.findall('(\d+)([MIDNSHP=X])', cigar) if op in 'MDN=X'])
+
+def cigar_blocks(pos, cigar, seq):
+    # walks a cigar an op at a time: (start, start + reference length, sequence) of each block between N ops
+    blocks = [[pos, pos, 0]]
+    query = 0
+    for length, op in utils.re.findall('(\d+)([MIDNSHP=X])', cigar):
+        length = int(length)
+        if op == 'N':
+            blocks.append([blocks[-1][1] + length, blocks[-1][1] + length, query])
+        else:
+            blocks[-1][1] += length if op in 'MD=X' else 0
+            query += length if op in 'MIS=X' else 0
+    starts = [block[2] for block in blocks[1:]] + [len(seq)]
+    return [(start, end, seq[query_start:query_end]) for (start, end, query_start), query_end in zip(blocks, starts) if end > start]
+
+def write_bam(path, chrom_lengths, reads, block_size=300, with_pseudo_bins=True):
+    '''
+    writes sorted (chrom, pos, flag, cigar, seq, name[, mate pos]) reads as a bam w/ a .bai next to it
+    small BGZF blocks so records and index chunks cross block boundaries
+    w/o with_pseudo_bins the index has no read counts, like an index from an old samtools or another indexer
+    '''
+    chroms = [chrom for chrom, length in chrom_lengths]
+    fh = open(path, 'wb')
+    writer = utils.BgzfWriter(fh)
+    writer.maxBlockSize = block_size
+    text = '@HD\tVN:1.0\tSO:coordinate\n' + ''.join(['@SQ\tSN:%s\tLN:%s\n' % pair for pair in chrom_lengths])
+    header = 'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(chroms))
+    for chrom, length in chrom_lengths:
+        header += struct.pack('<i', len(chrom) + 1) + chrom + '\x00' + struct.pack('<i', length)
+    writer.write(header)
+
+    bins = [{} for chrom in chroms]
+    linear = [{} for chrom in chroms]
+    # samtools index keeps each reference's offsets and mapped/unmapped counts in pseudo bin 37450
+    pseudo_bins = [None for chrom in chroms]
+    for read in reads:
+        chrom, pos, flag, cigar, seq, name = read[:6]
+        mate_pos = read[6] if len(read) > 6 else 0
+        ref_id, beg = chroms.index(chrom), pos - 1
+        end = beg + max(ref_length(cigar), 1)
+        ops = [int(length) << 4 | 'MIDNSHP=X'.index(op) for length, op in utils.re.findall('(\d+)([MIDNSHP=X])', cigar)]
+        codes = ['=ACMGRSVTWYHKDBN'.index(base) for base in seq] + [0]
+        packed = ''.join([chr(codes[i] << 4 | codes[i + 1]) for i in range(0, len(seq), 2)])
+        body = (struct.pack('<iiBBHHHiiii', ref_id, beg, len(name) + 1, 60, reg2bin(beg, end), len(ops), flag, len(seq),
+                             ref_id if mate_pos else -1, mate_pos - 1, 0)
+                + name + '\x00' + struct.pack('<%sI' % len(ops), *ops) + packed + '\xff' * len(seq))
+        start_offset = writer.tell()
+        writer.write(struct.pack('<i', len(body)) + body)
+        chunks = bins[ref_id].setdefault(reg2bin(beg, end), [])
+        if len(chunks) > 0 and chunks[-1][1] == start_offset:
+            chunks[-1][1] = writer.tell()
+        else:
+            chunks.append([start_offset, writer.tell()])
+        for window in range(beg >> 14, ((end - 1) >> 14) + 1):
+            linear[ref_id].setdefault(window, start_offset)
+        if pseudo_bins[ref_id] is None:
+            pseudo_bins[ref_id] = [start_offset, 0, 0, 0]
+        pseudo_bins[ref_id][1] = writer.tell()
+        pseudo_bins[ref_id][3 if flag & 4 else 2] += 1
+    writer.close()
+    fh.close()
+
+    if not with_pseudo_bins:
+        pseudo_bins = [None for chrom in chroms]
+    index = 'BAI\x01' + struct.pack('<i', len(chroms))
+    for ref_id in range(len(chroms)):
+        index += struct.pack('<i', len(bins[ref_id]) + (pseudo_bins[ref_id] is not None))
+        for bin_id, chunks in sorted(bins[ref_id].items()):
+            index += struct.pack('<Ii', bin_id, len(chunks)) + ''.join([struct.pack('<QQ', *chunk) for chunk in chunks])
+        if pseudo_bins[ref_id] is not None:
+            index += struct.pack('<IiQQQQ', 37450, 2, *pseudo_bins[ref_id])
+        n_intv = max(linear[ref_id].keys()) + 1 if len(linear[ref_id]) > 0 else 0
+        index += struct.pack('<i', n_intv) + ''.join([struct.pack('<Q', linear[ref_id].get(i, 0)) for i in range(n_intv)])
+    index += struct.pack('<Q', 0)
+    open(path + '.bai', 'wb').write(index)
+    return path
+
+def random_reads(count, chrom_lengths, seed=0):
+    rng = random.Random(seed)
+    reads = []
+    seqs = []
+    for i in range(count):
+        chrom, length = rng.choice(chrom_lengths)
+        read_length = rng.randint(20, 50)
+        # some reads share a sequence so uniqueness has something to do
+        if len(seqs) > 0 and rng.random() < 0.2:
+            seq = rng.choice(seqs)[:read_length]
+            read_length = len(seq)
+        else:
+            seq = ''.join([rng.choice('ACGTN') for j in range(read_length)])
+            seqs.append(seq)
+        kind = rng.random()
+        if kind < 0.1:
+            cigar = '%dM%dN%dM' % (10, rng.randint(100, 20000), read_length - 10)
+        elif kind < 0.15:
+            cigar = '%dM%dN%dM%dN%dM' % (5, rng.randint(100, 5000), 5, rng.randint(100, 5000), read_length - 10)
+        elif kind < 0.2:
+            cigar = '3S%dM2I%dM' % (read_length - 15, 10)
+        else:
+            cigar = '%dM' % read_length
+        flag = rng.choice([0, 16, 256, 272, 99, 147])
+        reads.append((chrom, rng.randint(1, length - 60), flag, cigar, seq, 'read_%d' % i))
+    chrom_order = [chrom for chrom, length in chrom_lengths]
+    return sorted(reads, key=lambda read: (chrom_order.index(read[0]), read[1]))
+
+def sam_lines(reads, locus):
+    # what samtools view prints for the locus, as split lines
+    lines = []
+    for read in reads:
+        chrom, pos, flag, cigar, seq, name = read[:6]
+        mate_pos = read[6] if len(read) > 6 else 0
+        if chrom == locus.chr() and pos <= locus.end() and pos - 1 + max(ref_length(cigar), 1) >= locus.start():
+            lines.append([name, str(flag), chrom, str(pos), '60', cigar, '=' if mate_pos else '*', str(mate_pos), '0', seq, '*'])
+    return lines
+
+class FakeSamtoolsReader(utils.SamtoolsBamReader):
+    # stands in for samtools view w/ the lines it would print
+    def __init__(self, reads):
+        self._reads = reads
+        self._lines = {}
+
+    def viewLines(self, chrom, start, end, printCommand=False):
+        if (chrom, start, end) not in self._lines:
+            self._lines[(chrom, start, end)] = sam_lines(self._reads, utils.Locus(chrom, start, end, '.'))
+        return [list(line) for line in self._lines[(chrom, start, end)]]
+
+class BamReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.chrom_lengths = [('chr1', 200000), ('chr2', 100000), ('chrM', 16000)]
+        self.reads = random_reads(3000, self.chrom_lengths[:2])
+        self.bam_file = write_bam(os.path.join(self.folder, 'test.bam'), self.chrom_lengths, self.reads)
+        rng = random.Random(1)
+        self.loci = [utils.Locus('chr1', 1, 200000, '+')] + [utils.Locus('chrM', 1, 16000, '+')]
+        for i in range(40):
+            chrom, length = rng.choice(self.chrom_lengths[:2])
+            start = rng.randint(1, length)
+            self.loci.append(utils.Locus(chrom, start, start + rng.choice([0, 50, 1000, 40000]), rng.choice('+-')))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_fetch_matches_overlaps(self):
+        reader = utils.NativeBamReader(self.bam_file)
+        self.assertEqual(reader.getChromList(), ['chr1', 'chr2', 'chrM'])
+        for locus in self.loci + [utils.Locus('chrX', 1, 100, '+')]:
+            reads = reader.fetch(locus.chr(), locus.start(), locus.end())
+            expected = sam_lines(self.reads, locus)
+            self.assertEqual(reads['name'].tolist(), [line[0] for line in expected])
+            self.assertEqual(reads['pos'].tolist(), [int(line[3]) for line in expected])
+            self.assertEqual(reads['cigar'].tolist(), [line[5] for line in expected])
+            self.assertEqual(reads['seq'].tolist(), [line[9] for line in expected])
+            self.assertEqual(reads['strand'].tolist(), [utils.convertBitwiseFlag(line[1]) for line in expected])
+
+    def test_matches_samtools_path(self):
+        native = utils.Bam(self.bam_file, 'native')
+        samtools = utils.Bam(self.bam_file, 'samtools')
+        samtools._reader = FakeSamtoolsReader(self.reads)
+        for locus in self.loci[2:]:
+            for sense in ['both', '+', '-']:
+                for unique, jxn in [(True, False), (False, True)]:
+                    self.assertEqual(native.getReadCount(locus, sense, unique, jxn),
+                                     samtools.getReadCount(locus, sense, unique, jxn))
+                    self.assertEqual(native.getReadStarts(locus, sense, unique, jxn),
+                                     samtools.getReadStarts(locus, sense, unique, jxn))
+                    for IDtag in ['sequence', 'seqID', 'none']:
+                        self.assertEqual([locus_key(read) for read in native.getReadsLocus(locus, sense, unique, IDtag, jxn)],
+                                         [locus_key(read) for read in samtools.getReadsLocus(locus, sense, unique, IDtag, jxn)])
+                self.assertEqual(native.getRawReads(locus, sense, True), samtools.getRawReads(locus, sense, True))
+
+    def test_fetch_many(self):
+        bam = utils.Bam(self.bam_file, 'native')
+        # densely tiled windows and scattered ones, in no particular order
+        loci = [utils.Locus('chr1', start, start + 199, '+') for start in range(50000, 90000, 100)] + self.loci
+        random.Random(2).shuffle(loci)
+        for sense, unique, jxn in [('both', False, True), ('-', True, False)]:
+            for locus, reads in zip(loci, bam.fetchMany(loci, sense, unique, jxn)):
+                self.assertEqual(reads['name'].tolist(), bam.getReadArray(locus, sense, unique, jxn)['name'].tolist())
+
+        # fetched together each block is only decompressed once
+        data = open(self.bam_file, 'rb').read()
+        offset, blocks = 0, 0
+        while offset < len(data):
+            offset += struct.unpack('<H', data[offset + 16:offset + 18])[0] + 1
+            blocks += 1
+        single = utils.Bam(self.bam_file, 'native')
+        for locus in loci:
+            single.getReadArray(locus)
+        batch = utils.Bam(self.bam_file, 'native')
+        batch.fetchMany(loci)
+        self.assertTrue(batch.getReader()._bgzf.blocksRead <= blocks)
+        self.assertTrue(batch.getReader()._bgzf.blocksRead < single.getReader()._bgzf.blocksRead)
+
+    def test_bam_stats_cache(self):
+        cache = utils.BAM_STATS_CACHE
+        utils.BAM_STATS_CACHE = os.path.join(self.folder, 'bam_stats.sqlite')
+        try:
+            stats = utils.getBamStats(self.bam_file)
+            counts = dict([(chrom, len([read for read in self.reads if read[0] == chrom])) for chrom, length in self.chrom_lengths])
+            self.assertEqual(stats['chroms'], [[chrom, length, counts[chrom], 0] for chrom, length in self.chrom_lengths])
+            self.assertEqual((stats['mapped'], stats['total'], stats['unplaced']), (len(self.reads), len(self.reads), 0))
+            self.assertEqual(utils.getBamChromList(self.bam_file), ['chr1', 'chr2', 'chrM'])
+
+            # the second lookup comes from the cache
+            compute = utils.computeBamStats
+            utils.computeBamStats = None
+            try:
+                self.assertEqual(utils.Bam(self.bam_file).getTotalReads('total'), len(self.reads))
+                self.assertEqual(utils.getBamStats(self.bam_file), stats)
+            finally:
+                utils.computeBamStats = compute
+
+            # a rewritten bam is counted again
+            write_bam(self.bam_file, self.chrom_lengths, self.reads[:100])
+            os.utime(self.bam_file, (0, 0))
+            self.assertEqual(utils.Bam(self.bam_file).getTotalReads(), 100)
+        finally:
+            utils.BAM_STATS_CACHE = cache
+
+    def test_bam_stats_without_index_read_counts(self):
+        # w/o the pseudo bins (or samtools to read through the bam) the reads of each chromosome are counted
+        reads = self.reads + [('chr2', 99990, 4, '*', 'ACGT', 'unmapped_placed')]
+        bam_file = write_bam(os.path.join(self.folder, 'no_pseudo_bins.bam'), self.chrom_lengths, reads,
+                             with_pseudo_bins=False)
+        self.assertEqual(utils.NativeBamReader(bam_file).getIndexStats(), None)
+        samtools_stats = utils.SamtoolsBamReader.getIndexStats
+        utils.SamtoolsBamReader.getIndexStats = lambda reader: None
+        try:
+            stats = utils.getBamStats(bam_file, useCache=False)
+        finally:
+            utils.SamtoolsBamReader.getIndexStats = samtools_stats
+        counts = dict([(chrom, len([read for read in self.reads if read[0] == chrom])) for chrom, length in self.chrom_lengths])
+        self.assertEqual(stats['chroms'], [['chr1', 200000, counts['chr1'], 0], ['chr2', 100000, counts['chr2'], 1],
+                                           ['chrM', 16000, 0, 0]])
+        self.assertEqual((stats['mapped'], stats['total'], stats['unplaced']), (len(self.reads), len(self.reads) + 1, 0))
+
+        # samtools idxstats is used when it can read through the bam
+        utils.SamtoolsBamReader.getIndexStats = lambda reader: ([['chr1', 200000, 5, 1]], 2)
+        try:
+            stats = utils.getBamStats(bam_file, useCache=False)
+        finally:
+            utils.SamtoolsBamReader.getIndexStats = samtools_stats
+        self.assertEqual(stats, {'mapped': 5, 'total': 8, 'chroms': [['chr1', 200000, 5, 1]], 'unplaced': 2})
+
+    def test_position_duplicates(self):
+        # reads piled up on a few 5' ends w/ different cigars, strands and mates
+        rng = random.Random(3)
+        reads = []
+        for i in range(2000):
+            five_prime, flag = rng.randint(100, 20000), rng.choice([0, 16, 99, 147, 83, 163])
+            length = rng.choice([30, 36, 50])
+            cigar = rng.choice(['%dM' % length, '10M200N%dM' % (length - 10), '5S%dM' % (length - 5)])
+            pos = five_prime - ref_length(cigar) + 1 if flag & 16 else five_prime
+            mate = rng.choice([0, 500, 900]) if flag & 1 else 0
+            reads.append(('chr1', pos, flag, cigar, 'A' * length, 'dup_%d' % i, mate))
+        reads.sort(key=lambda read: read[1])
+        bam_file = write_bam(os.path.join(self.folder, 'dups.bam'), self.chrom_lengths, reads)
+
+        def expected(reads):
+            seen = set()
+            kept = []
+            for chrom, pos, flag, cigar, seq, name, mate in reads:
+                key = (chrom, pos + ref_length(cigar) - 1 if flag & 16 else pos, flag & 16, mate if flag & 1 else 0)
+                if key not in seen:
+                    kept.append(name)
+                seen.add(key)
+            return kept
+
+        native = utils.Bam(bam_file, 'native')
+        samtools = utils.Bam(bam_file, 'samtools')
+        samtools._reader = FakeSamtoolsReader(reads)
+        for locus in [utils.Locus('chr1', 1, 30000, '+'), utils.Locus('chr1', 5000, 9000, '-')]:
+            overlapping = set([line[0] for line in sam_lines(reads, locus)])
+            names = native.getReadArray(locus, 'both', 'position', True)['name'].tolist()
+            self.assertEqual(names, expected([read for read in reads if read[5] in overlapping]))
+            self.assertEqual([line[0] for line in samtools.getRawReads(locus, 'both', 'position', True)], names)
+            self.assertEqual(native.getRawReads(locus, '-', 'position'), samtools.getRawReads(locus, '-', 'position'))
+
+        # counted a window at a time, duplicates straddling windows are still caught
+        for window_size in [1000, 4096, 1000000]:
+            self.assertEqual(utils.countUniqueReads(bam_file, 'native', window_size), len(expected(reads)))
+        cache = utils.BAM_STATS_CACHE
+        utils.BAM_STATS_CACHE = os.path.join(self.folder, 'bam_stats.sqlite')
+        try:
+            self.assertEqual(utils.getUniqueReadCount(bam_file), len(expected(reads)))
+            self.assertEqual(utils.getUniqueReadCount(bam_file), len(expected(reads)))
+        finally:
+            utils.BAM_STATS_CACHE = cache
+
+    def test_spliced_read_blocks(self):
+        bam = utils.Bam(self.bam_file, 'native')
+        samtools = utils.Bam(self.bam_file, 'samtools')
+        samtools._reader = FakeSamtoolsReader(self.reads)
+        locus = utils.Locus('chr1', 1, 200000, '+')
+        reads = [read for read in self.reads if read[0] == 'chr1']
+        expected = [(read[5], start, end, seq) for read in reads for start, end, seq in cigar_blocks(read[1], read[3], read[4])]
+        # reads w/ two junctions, clips and insertions are all there
+        self.assertTrue(len([read for read in reads if read[3].count('N') == 2]) > 0)
+        for backend in [bam, samtools]:
+            loci = backend.getReadsLocus(locus, 'both', False, 'sequence', True)
+            self.assertEqual([(start, end, seq) for name, start, end, seq in expected],
+                             [(l.start(), l.end(), l.ID()) for l in loci])
+            loci = backend.getReadsLocus(locus, 'both', False, 'seqID', True)
+            self.assertEqual([name for name, start, end, seq in expected], [l.ID() for l in loci])
+
+        plus, minus = bam.strandCoverage(locus, 0, False, True)
+        expected_plus = numpy.zeros(200000, dtype=int)
+        for read in reads:
+            if not read[2] & 16:
+                for start, end, seq in cigar_blocks(read[1], read[3], read[4]):
+                    expected_plus[start - 1:end] += 1
+        self.assertEqual(plus.tolist(), expected_plus.tolist())
+
+    def test_backend_choice(self):
+        self.assertTrue(isinstance(utils.Bam(self.bam_file).getReader(), (utils.NativeBamReader, utils.PysamBamReader)))
+        os.remove(self.bam_file + '.bai')
+        self.assertTrue(isinstance(utils.openBamReader(self.bam_file), (utils.SamtoolsBamReader, utils.PysamBamReader)))
+        self.assertRaises(IOError, utils.openBamReader, self.bam_file, 'native')
+        self.assertRaises(ValueError, utils.openBamReader, self.bam_file, 'bamtools')
+
+# speaks the bamliquidator_worker protocol, with bin i of a region counting i + start, negated on the - strand
+FAKE_WORKER = r"""
+import struct, sys
+while True:
+    header = sys.stdin.read(2)
+    if len(header) < 2 or struct.unpack('<H', header)[0] == 0:
+        break
+    chrom = sys.stdin.read(struct.unpack('<H', header)[0])
+    start, stop, strand, bins, extension = struct.unpack('<IIcII', sys.stdin.read(17))
+    if stop <= start:
+        sys.stdout.write(struct.pack('<i', -len('wrong stop')) + 'wrong stop')
+    else:
+        counts = [(i + start) * (-1 if strand == '-' else 1) for i in range(bins)]
+        sys.stdout.write(struct.pack('<i%dd' % bins, bins, *counts))
+    sys.stdout.flush()
+"""
+
+class LiquidatorWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.executable = os.path.join(self.folder, 'fake_worker')
+        with open(self.executable, 'w') as f:
+            f.write('#!%s\n%s' % (sys.executable, FAKE_WORKER))
+        os.chmod(self.executable, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_liquidate(self):
+        with utils.LiquidatorWorker('x.bam', self.executable) as worker:
+            self.assertEqual(worker.liquidate('chr1', 10, 20, '+', 3).tolist(), [10, 11, 12])
+            self.assertEqual(worker.liquidate('chr1', 10, 20, '-', 1).tolist(), [-10])
+            self.assertRaises(ValueError, worker.liquidate, 'chr1', 20, 20)
+            # the worker keeps going after a bad request
+            self.assertEqual(worker.liquidate('chr2', 5, 20, 'both', 2).tolist(), [5, 6])
+
+    def test_liquidate_many_keeps_order(self):
+        requests = [('chr1', start, start + 100, '+', start % 5 + 1, 200) for start in range(500)]
+        with utils.LiquidatorWorker('x.bam', self.executable) as worker:
+            results = list(worker.liquidateMany(requests, window=16))
+            self.assertEqual([r.tolist() for r in results],
+                             [range(start, start + start % 5 + 1) for start in range(500)])
+            # responses of an abandoned liquidateMany don't leak into later requests
+            partial = worker.liquidateMany(requests, window=16)
+            next(partial)
+            self.assertEqual(worker.liquidate('chr1', 7, 8).tolist(), [7])
+
+    def test_pool_starts_one_worker_per_bam(self):
+        pool = utils.LiquidatorPool(self.executable)
+        pool.liquidate('a.bam', 'chr1', 1, 2)
+        pool.liquidate('a.bam', 'chr1', 1, 2)
+        self.assertEqual(pool.liquidate('b.bam', 'chr1', 3, 4, '+', 2).tolist(), [3, 4])
+        self.assertEqual(len(pool._workers), 2)
+        processes = [worker._process for worker in pool._workers.values()]
+        pool.close()
+        self.assertEqual([process.returncode for process in processes], [0, 0])
+
+if __name__ == '__main__':
+    unittest.main()